@@ -9,6 +9,7 @@ from __future__ import annotations
 from sqlalchemy.orm import sessionmaker, joinedload
 
 # ---- builtins / stdlib ----
+import atexit                # 監査バッファの終了時フラッシュで使用
 import base64
 import contextlib            # closing/suppress で使用
 import hmac
@@ -29,13 +30,14 @@ import threading            # 非同期印刷で使用
 import time
 import traceback
 import uuid
-from collections import defaultdict
+from collections import defaultdict, deque
 import random  # ← 合流PIN生成用
 from contextlib import contextmanager
-from datetime import datetime, timedelta, timezone  # ★ timezone を追加
-from functools import wraps
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone  # ★ timezone を追加
+from functools import lru_cache, wraps
 from typing import Any, Dict, List, Optional, Tuple
-from urllib.parse import urlparse     # _is_safe_url で使用
+from urllib.parse import quote, urlparse     # _is_safe_url / menu_page_legacy で使用
 
 # ---- Flask ----
 from flask import (
@@ -45,6 +47,7 @@ from flask import (
     current_app,
     flash,
     g,
+    has_request_context,
     jsonify,
     make_response,
     redirect,
@@ -76,7 +79,16 @@ from sqlalchemy import (
     event,
     exists,
     and_,
+    case,
+    cast,
+    insert,
+    select,
+    update,
+    JSON,
+    LargeBinary,
 )
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
 from sqlalchemy.orm import (
     Session,
@@ -87,6 +99,8 @@ from sqlalchemy.orm import (
     declarative_mixin,
     declared_attr,
     with_loader_criteria,
+    column_property,
+    aliased,
 )
 
 # ★ 追加：履歴作成で使用（既にOK）
@@ -162,50 +176,6 @@ def _needs_work_item(it) -> bool:
         return False
     return not _is_served_item(it)
 
-# --- [ヘルパ] 注文の実売上計算（取り消しを除外） ------------------------
-def _calculate_order_totals(order_items):
-    """
-    OrderItemのリストから、取り消しを除外した実際の売上を計算
-    
-    Args:
-        order_items: OrderItemのリスト
-        
-    Returns:
-        dict: {"subtotal": int, "tax": int, "total": int}
-    """
-    import math
-    subtotal = 0
-    tax = 0
-    
-    for it in order_items:
-        qty = int(getattr(it, "qty", 0) or 0)
-        if qty == 0:
-            continue
-        
-        # 取り消し判定（正数量かつ取消ラベルは除外、負数量は必ず集計）
-        if qty > 0:
-            st = (getattr(it, "status", None) or getattr(it, "状態", None) or "")
-            st_low = str(st).lower()
-            is_cancel_label = (
-                ("取消" in st_low) or ("ｷｬﾝｾﾙ" in st_low) or ("キャンセル" in st_low)
-                or ("cancel" in st_low) or ("void" in st_low)
-            )
-            if is_cancel_label:
-                continue
-        
-        # 金額計算
-        unit_price = int(getattr(it, "unit_price", 0) or 0)
-        excl = unit_price * qty
-        rate = float(getattr(it, "tax_rate", 0.0) or 0.0)
-        item_tax = int(math.floor(excl * rate))
-        
-        subtotal += excl
-        tax += item_tax
-    
-    total = subtotal + tax
-    return {"subtotal": subtotal, "tax": tax, "total": total}
-
-
 # -----------------------------------------------------------------------------
 # 設定値（環境変数で上書き可）
 # -----------------------------------------------------------------------------
@@ -279,9 +249,14 @@ _floor_version = int(time.time() * 1000)
 _floor_lock = threading.Lock()
 _floor_waiters = []
 
-# --- [ヘルパ] フロア更新通知（版数更新 & SSE 待機へ通知） --------------------------------
-def mark_floor_changed():
-    """フロア状態が変わったら呼ぶ（版数を前に進め、SSE 待機中の接続に通知）"""
+# 連続した変更の通知をまとめる間隔（ミリ秒）。0 なら待たずに通知（通知は常に専用スレッドが行う）
+FLOOR_NOTIFY_DEBOUNCE_SEC = max(int(os.getenv("FLOOR_NOTIFY_DEBOUNCE_MS", "500")), 0) / 1000.0
+_floor_dirty = threading.Event()
+_floor_notify_worker = None
+
+
+def _broadcast_floor_change():
+    """版数を前に進め、SSE 待機中の接続に通知"""
     global _floor_version
     with _floor_lock:
         _floor_version = int(time.time() * 1000)
@@ -291,6 +266,28 @@ def mark_floor_changed():
             except Exception:
                 pass
 
+
+def _floor_notify_loop():
+    while True:
+        _floor_dirty.wait()
+        if FLOOR_NOTIFY_DEBOUNCE_SEC > 0:
+            time.sleep(FLOOR_NOTIFY_DEBOUNCE_SEC)  # この間に来た変更は1回の通知にまとめる
+        _floor_dirty.clear()
+        _broadcast_floor_change()
+
+
+# --- [ヘルパ] フロア更新通知（版数更新 & SSE 待機へ通知） --------------------------------
+def mark_floor_changed():
+    """フロア状態が変わったら呼ぶ（通知は専用スレッドが間隔内の変更をまとめて行う。呼び出し側は待たない）"""
+    global _floor_notify_worker
+    if _floor_notify_worker is None:
+        # gunicorn の fork 後（各ワーカー内）で初めて起動させる
+        with _floor_lock:
+            if _floor_notify_worker is None:
+                _floor_notify_worker = threading.Thread(target=_floor_notify_loop, name="floor-notify", daemon=True)
+                _floor_notify_worker.start()
+    _floor_dirty.set()
+
 # ---------------------------------------------------------------------
 # Jinja フィルタ登録（価格表示：¥12,345 形式）
 # ---------------------------------------------------------------------
@@ -310,6 +307,10 @@ def yen(v) -> str:
 _engine_cache = {}
 
 # --- [DB接続] エンジン生成ヘルパ ------------------------------------------------------
+def _compact_json_dumps(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
 def _create_engine(url: str):
     """
     - SQL_ECHO=1 で発行SQLを出力（デバッグ用）
@@ -322,6 +323,8 @@ def _create_engine(url: str):
         "echo": echo_env,
         "future": True,
         "pool_pre_ping": True,        # 接続死活監視
+        # JSON 列（移動履歴スナップショット等）は区切りの空白なし・日本語そのままで保存
+        "json_serializer": _compact_json_dumps,
     }
 
     if url.startswith("sqlite:///"):
@@ -334,7 +337,10 @@ def _create_engine(url: str):
             "client_encoding": "utf8",  # UTF-8エンコーディングを明示
         })
         engine_kwargs.update({
-            "pool_size": int(os.getenv("DB_POOL_SIZE", "3")),  # Heroku向けに削減
+            "poolclass": QueuePool,  # 明示（NullPool だと毎リクエスト接続し直しになる）
+            # 常駐接続数は gunicorn の --threads 4 に合わせる（3 だと同時4件目が毎回 overflow 接続の張り直しになる）
+            #   2 workers × (4 + 5) = 18 で Heroku Postgres の接続上限 20 に収まる
+            "pool_size": int(os.getenv("DB_POOL_SIZE", "4")),
             "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "5")),  # 削減
             "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "300")),  # 5分に短縮
             "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "10")),  # 10秒でタイムアウト
@@ -343,6 +349,19 @@ def _create_engine(url: str):
 
     eng = create_engine(url, **engine_kwargs)
 
+    # SQLite: WAL + synchronous=NORMAL でコミット毎の fsync を削減（SQLITE_WAL=0 で無効化）
+    if url.startswith("sqlite:///") and os.getenv("SQLITE_WAL", "1") == "1":
+        @event.listens_for(eng, "connect")
+        def _sqlite_pragmas(dbapi_conn, conn_record):
+            cur = dbapi_conn.cursor()
+            try:
+                cur.execute("PRAGMA journal_mode=WAL")
+                cur.execute("PRAGMA synchronous=NORMAL")
+                cur.execute("PRAGMA temp_store=MEMORY")
+                cur.execute("PRAGMA mmap_size=268435456")  # 256MB
+            finally:
+                cur.close()
+
     # 起動時に1回だけ簡易診断を出す（失敗してもアプリは継続）
     try:
         with eng.connect() as conn:
@@ -803,6 +822,9 @@ class TenantScoped:
 # --- 現在テナントIDの取得（g > session の順） -----------------------------------
 def _current_tenant_id():
     # g.tenant_id が最優先・なければ session から
+    # リクエスト外（CLI・バッファのワーカースレッド）はテナント未確定として None
+    if not has_request_context():
+        return None
     return getattr(g, "tenant_id", None) or session.get("tenant_id")
 
 
@@ -1301,31 +1323,53 @@ def normalize_price_for_storage(input_price: int, mode: str, effective_rate: flo
 
 
 # --- メニュー表示用の実効税率解決（カテゴリ優先→メニュー既定） ----------------
-def resolve_effective_tax_rate_for_menu(session_db, menu_id: int, menu_default_rate: float) -> float:
-    """表示時に使う実効税率。カテゴリ→メニュー既定の順で拾い、どちらも正規化して返す。"""
+def _to_tax_rate(val):
+    """税率を 0〜1 の Decimal に正規化（10 → 0.10 のような百分率表記も受け付ける）"""
     from decimal import Decimal
+    try:
+        r = Decimal(str(val))
+    except Exception:
+        return Decimal('0.10')
+    if r > 1:
+        r = r / Decimal('100')
+    if r < 0:
+        r = Decimal('0')
+    if r > 1:
+        r = Decimal('1')
+    return r
 
-    def _to_rate(val):
-        try:
-            r = Decimal(str(val))
-        except Exception:
-            return Decimal('0.10')
-        if r > 1:
-            r = r / Decimal('100')
-        if r < 0:
-            r = Decimal('0')
-        if r > 1:
-            r = Decimal('1')
-        return r
 
+def resolve_effective_tax_rate_for_menu(session_db, menu_id: int, menu_default_rate: float) -> float:
+    """表示時に使う実効税率。カテゴリ→メニュー既定の順で拾い、どちらも正規化して返す。"""
     links = (session_db.query(ProductCategoryLink)
              .filter(ProductCategoryLink.product_id == menu_id)
              .order_by(ProductCategoryLink.display_order.asc(), ProductCategoryLink.category_id.asc())
              .all())
     for ln in links:
         if ln.tax_rate is not None:
-            return float(_to_rate(ln.tax_rate))
-    return float(_to_rate(menu_default_rate or 0.0))
+            return float(_to_tax_rate(ln.tax_rate))
+    return float(_to_tax_rate(menu_default_rate or 0.0))
+
+
+def resolve_effective_tax_rates_for_menus(session_db, menus) -> dict:
+    """resolve_effective_tax_rate_for_menu の複数メニュー版。{menu_id: 実効税率} を1回の SELECT で返す。"""
+    menus = list(menus)
+    if not menus:
+        return {}
+    rows = (session_db.query(ProductCategoryLink.product_id, ProductCategoryLink.tax_rate)
+            .filter(ProductCategoryLink.product_id.in_([m.id for m in menus]),
+                    ProductCategoryLink.tax_rate.isnot(None))
+            .order_by(ProductCategoryLink.product_id.asc(),
+                      ProductCategoryLink.display_order.asc(),
+                      ProductCategoryLink.category_id.asc())
+            .all())
+    link_rate = {}
+    for product_id, rate in rows:
+        link_rate.setdefault(product_id, rate)  # 各メニューの先頭（表示順が最小）のみ
+    return {
+        m.id: float(_to_tax_rate(link_rate[m.id] if m.id in link_rate else (m.tax_rate or 0.0)))
+        for m in menus
+    }
 
 
 
@@ -1533,11 +1577,20 @@ class OrderHeader(TenantScoped, Base):
     # ★ 合流PIN（4桁）と有効期限（文字列）
     join_pin = Column("合流PIN", String, nullable=True)
     join_pin_expires_at = Column("PIN有効期限", String, nullable=True)
+    # ★ 状態変更の楽観ロック用版数（状態更新 API で +1、expected_version と食い違えば 409）
+    version = Column("版数", Integer, nullable=False, default=0)
     store = relationship("Store")
     table = relationship("TableSeat", back_populates="orders")
     items = relationship("OrderItem", back_populates="order", cascade="all,delete-orphan")
 
 Index("idx_order_table", OrderHeader.table_id)
+# テーブルのアクティブ注文検索（店舗・テーブル・状態で絞って id 降順の先頭1件）を索引だけで解決
+Index("ix_order_active_lookup", OrderHeader.store_id, OrderHeader.table_id, OrderHeader.status, OrderHeader.id.desc())
+# 売上集計の対象伝票（店舗・状態で絞って会計日時の範囲）を索引の範囲走査で取る
+Index("ix_order_store_status_closed", OrderHeader.store_id, OrderHeader.status, OrderHeader.closed_at)
+# カラム構成は起動後に変わらないので、有無の確認はここで1回だけ行う（リクエストごとに hasattr しない）
+_HAS_STORE_ID = hasattr(OrderHeader, "store_id")
+_HAS_STATUS = hasattr(OrderHeader, "status")
 
 
 # --- [モデル] 注文明細（OrderItem） -------------------------------------------------------
@@ -1560,6 +1613,8 @@ class OrderItem(TenantScoped, Base):
     menu = relationship("Menu")
 
 Index("idx_order_detail_order", OrderItem.order_id)
+# 伝票の明細を id 順に読む（order_id で絞って id 昇順）を索引順のまま返す
+Index("ix_order_item_order_id", OrderItem.order_id, OrderItem.id)
 
 
 # --- [モデル] 商品カテゴリ（Category） ----------------------------------------------------
@@ -2455,7 +2510,8 @@ def build_ticket_with_totals(header, items, table, new_item_ids):
     
     subtotal = 0
     for item in new_items:
-        menu_name = getattr(getattr(item, 'menu', None), 'name', f"不明 (ID:{getattr(item, 'menu_id', 'N/A')})")
+        menu_name = (getattr(item, 'menu_name', None)
+                     or getattr(getattr(item, 'menu', None), 'name', f"不明 (ID:{getattr(item, 'menu_id', 'N/A')})"))
         qty = getattr(item, 'qty', 1) or 1
         unit_price_excl = getattr(item, 'unit_price', 0) or 0  # 税抜単価
         tax_rate = getattr(item, 'tax_rate', 0.10) or 0.10  # 税率
@@ -2516,6 +2572,20 @@ def build_ticket_with_totals(header, items, table, new_item_ids):
     return "\n".join(lines) + "\n"
 
 
+# --- KDS印刷用の明細（ORM から切り離した値オブジェクト） ---------------------------
+@dataclass(slots=True)
+class PrintItem:
+    """コミット/クローズ後も遅延ロードせずに参照できる印刷用の明細"""
+    id: int
+    menu_id: int
+    menu_name: str | None
+    qty: int
+    unit_price: int
+    tax_rate: float
+    memo: str | None
+    added_at: Any
+
+
 # --- KDS印刷処理（印刷ルールに基づく） --------------------------------------------
 def _trigger_kds_print(session_db, order_id, new_items):
     """
@@ -2524,7 +2594,7 @@ def _trigger_kds_print(session_db, order_id, new_items):
     Args:
         session_db: データベースセッション
         order_id: 注文ID
-        new_items: 新しく追加されたOrderItemのリスト
+        new_items: 新しく追加された明細（PrintItem または OrderItem）のリスト
     """
     if not new_items:
         return
@@ -4900,7 +4970,6 @@ def _fetch_items_for_display(s, order_ids, include_cancel=True, include_negative
 # ---------------------------------------------------------------------
 def aggregate_menu_sales_by_menu(s, store_id, dt_from=None, dt_to=None, table_id=None):
     from sqlalchemy import and_
-    import math
 
     Header = OrderHeader
     Item   = OrderItem
@@ -4924,6 +4993,7 @@ def aggregate_menu_sales_by_menu(s, store_id, dt_from=None, dt_to=None, table_id
     rows = q.all()
 
     out = {}  # key: menu_id
+    rate_bp_cache = {}  # 税率 -> 0.01% 単位の整数
     for it, h, m in rows:
         qty  = int(getattr(it, "qty", None) or getattr(it, "数量", None) or 0)
         if qty == 0:
@@ -4948,7 +5018,11 @@ def aggregate_menu_sales_by_menu(s, store_id, dt_from=None, dt_to=None, table_id
                      or getattr(m, "tax_rate", None)
                      or 0.10)
 
-        unit_tax  = math.floor(unit_excl * rate)
+        # 税率は 0.01% 単位の整数にして整数演算で切り捨て（税率ごとに1回だけ換算）
+        rate_bp = rate_bp_cache.get(rate)
+        if rate_bp is None:
+            rate_bp = rate_bp_cache[rate] = int(round(rate * 10000))
+        unit_tax  = unit_excl * rate_bp // 10000
         unit_incl = unit_excl + unit_tax
 
         key = getattr(m, "id")
@@ -5394,6 +5468,44 @@ def progress_seed_if_needed(s, item):
           updated_at = :ts
     """), {"id": item.id, "n": n, "c": c, "sv": sv, "cx": cx, "st": item_status, "ts": _now_iso()})
 
+def progress_seed_many(s, items):
+    # progress_seed_if_needed の一括版（flush 済みで id が確定した明細をまとめて1回の executemany で初期化）
+    # 既存行はカウンタが全て0の場合のみ上書き（単品版の「存在し>0ならスキップ」と同じ判定をSQL側で行う）
+    ts = _now_iso()
+    params = []
+    for item in items:
+        qty = int(_get_any(item, "qty", "数量", default=0))
+        if qty <= 0:
+            continue  # 数量0の明細は初期化しない
+        item_status = str(_get_any(item, "status", "状態", default="新規"))
+        n, c, sv, cx = 0, 0, 0, 0
+        if item_status in ("提供済", "served"):
+            sv = qty
+        elif item_status in ("調理中", "cooking"):
+            c = qty
+        elif item_status in ("取消", "cancel", "キャンセル"):
+            cx = qty
+        else:
+            n = qty
+        params.append({"id": item.id, "n": n, "c": c, "sv": sv, "cx": cx, "st": item_status, "ts": ts})
+    if not params:
+        return 0
+
+    s.execute(text("""
+        INSERT INTO "T_明細進捗"(item_id, qty_new, qty_cooking, qty_served, qty_canceled, status, updated_at)
+        VALUES (:id, :n, :c, :sv, :cx, :st, :ts)
+        ON CONFLICT(item_id) DO UPDATE SET
+          qty_new = excluded.qty_new,
+          qty_cooking = excluded.qty_cooking,
+          qty_served = excluded.qty_served,
+          qty_canceled = excluded.qty_canceled,
+          status = excluded.status,
+          updated_at = excluded.updated_at
+        WHERE "T_明細進捗".qty_new + "T_明細進捗".qty_cooking
+            + "T_明細進捗".qty_served + "T_明細進捗".qty_canceled = 0
+    """), params)
+    return len(params)
+
 def progress_set(s, item_id:int, n=None, c=None, sv=None, cx=None):
     # 任意のカラムだけ更新（status は別管理。ここでは触らない）
     sets, params = [], {"id": item_id, "ts": _now_iso()}
@@ -8267,6 +8379,56 @@ def _recalc_order_amounts(session_db, header: OrderHeader) -> None:
     header.subtotal, header.tax, header.total = int(subtotal), int(taxsum), int(subtotal + taxsum)
 
 
+# --- [SQL Helper] 切り捨て（floor）を CAST と比較で表す --------------------------
+def _sql_floor_int(x):
+    """SQL 式 x を切り捨てた整数式。floor() の無い DB（数学関数なしの SQLite など）でも動き、
+    CAST が切り捨て（SQLite）でも四捨五入（Postgres）でも負数を含めて floor と一致する。"""
+    ix = cast(x, Integer)
+    return case((x < ix, ix - 1), else_=ix)
+
+
+# --- ヘッダ金額を SQL 1文で再集計（明細のネット額／1単位ごとに税を切り捨て） ---
+def _recalc_order_totals_sql(s, order_id: int, order_obj=None, *, unit_tax_fn=None):
+    """
+    UPDATE "T_注文" SET 小計/税額/合計 = (明細から集計) WHERE id = :oid を1往復で実行し、
+    RETURNING で確定値を受け取る（RETURNING 非対応の DB では UPDATE 後に3列を読み戻す）。計算式は _recalc_order_totals_with_negatives_db と同じ
+    （unit*qty の合計、floor(unit*rate)*qty の合計。負数量の取消行も合算）。
+    unit_tax_fn で1単位あたり税額の丸め関数を差し替え可能（既定 func.floor、切り捨て互換なら func.trunc）。
+    order_obj を渡すとセッション上のヘッダへ確定値を反映（dirty にはしない）。
+    戻り: (subtotal, tax, total)
+    """
+    from sqlalchemy import select, update, cast
+    from sqlalchemy.orm.attributes import set_committed_value
+
+    unit_tax_fn = unit_tax_fn or func.floor
+
+    def _sum(expr):
+        return (select(func.coalesce(func.sum(expr), 0))
+                .where(OrderItem.order_id == order_id)
+                .scalar_subquery())
+
+    sub_s = _sum(OrderItem.unit_price * OrderItem.qty)
+    sub_t = _sum(cast(unit_tax_fn(OrderItem.unit_price * OrderItem.tax_rate), Integer) * OrderItem.qty)
+    stmt = (
+        update(OrderHeader)
+        .where(OrderHeader.id == order_id)
+        .values(subtotal=sub_s, tax=sub_t, total=sub_s + sub_t)
+        .execution_options(synchronize_session=False)
+    )
+    totals_cols = (OrderHeader.subtotal, OrderHeader.tax, OrderHeader.total)
+    if s.get_bind().dialect.update_returning:
+        row = s.execute(stmt.returning(*totals_cols)).one()
+    else:
+        s.execute(stmt)
+        row = s.execute(select(*totals_cols).where(OrderHeader.id == order_id)).one()
+    subtotal, tax, total = int(row[0]), int(row[1]), int(row[2])
+    if order_obj is not None:
+        set_committed_value(order_obj, "subtotal", subtotal)
+        set_committed_value(order_obj, "tax", tax)
+        set_committed_value(order_obj, "total", total)
+    return subtotal, tax, total
+
+
 # --- [Menu API] カテゴリ別メニュー一覧 -----------------------------------------
 @app.get("/api/menus/by_category/<int:category_id>", endpoint="api_menus_by_category")
 def api_menus_by_category(category_id: int):
@@ -11307,6 +11469,41 @@ def migrate_payment_method_store_id():
 # テーブル/カテゴリ/プリンタ/印刷ルール（管理者）
 # ---------------------------------------------------------------------
 
+# --- ヘルパ：店舗のテーブル番号一覧（短期キャッシュ） ------------------------------
+#   テーブルの追加・削除・番号変更はまれなので (テナント, 店舗) ごとに TTL 付きで保持する。
+#   このプロセスでの追加/削除時は _invalidate_table_no_cache() で即時に捨てる。
+#   席の状態は頻繁に変わるためキャッシュしない。
+TABLE_NO_CACHE_TTL = float(os.getenv("TABLE_NO_CACHE_TTL", "60"))
+_table_no_cache = {}
+_table_no_cache_lock = threading.Lock()
+
+
+def _table_no_list(s, sid, expect_ids=None):
+    """店舗のテーブルの (id, table_no) 行をテーブル番号順で返す。
+    expect_ids を渡すと、キャッシュの id 集合が一致しない場合（他ワーカーでの追加/削除）は取り直す。
+    """
+    key = (_current_tenant_id(), sid)
+    now = time.monotonic()
+    with _table_no_cache_lock:
+        hit = _table_no_cache.get(key)
+    if hit and hit[0] > now and (expect_ids is None or {r.id for r in hit[1]} == set(expect_ids)):
+        return hit[1]
+    rows = tuple(
+        s.query(TableSeat.id, TableSeat.table_no)
+         .filter(TableSeat.store_id == sid)
+         .order_by(TableSeat.table_no.asc())
+         .all()
+    )
+    with _table_no_cache_lock:
+        _table_no_cache[key] = (now + TABLE_NO_CACHE_TTL, rows)
+    return rows
+
+
+def _invalidate_table_no_cache(sid):
+    with _table_no_cache_lock:
+        _table_no_cache.pop((_current_tenant_id(), sid), None)
+
+
 # --- 画面：テーブル一覧 ---------------------------------------------------------
 @app.route("/admin/tables")
 @require_admin
@@ -11339,6 +11536,7 @@ def admin_tables_new():
         if sid is not None and hasattr(rec, "store_id"):
             rec.store_id = sid                     # ★ 店舗IDを保存
         s.add(rec); s.commit()
+        _invalidate_table_no_cache(sid)
         return redirect(url_for("admin_tables"))
     finally:
         s.close()
@@ -11353,8 +11551,10 @@ def admin_tables_delete(table_id):
     try:
         t = s.get(TableSeat, table_id)
         if t:
+            sid = getattr(t, "store_id", None)
             s.delete(t)
             s.commit()
+            _invalidate_table_no_cache(sid)
         return redirect(url_for("admin_tables"))
     finally:
         s.close()
@@ -13543,7 +13743,6 @@ def api_order():
     POST JSON:
       { "token": "<qr token>", "items": [{"menu_id": 3, "qty": 2, "memo": "辛め"}], "custom_date": "YYYY-MM-DD HH:MM:SS" }
     """
-    import math
     import logging
 
     data = request.get_json(force=True) or {}
@@ -13558,6 +13757,34 @@ def api_order():
     if not token or not isinstance(items, list) or not items:
         return jsonify({"ok": False, "error": "token/items required"}), 400
 
+    # ★ 事前パス：入力を検証し、同一 (menu_id, memo, actual_price) の行は数量を合算
+    #   DB に触れる前（トークン照合・セッション取得より前）に純 Python で済ませ、
+    #   有効な候補が無ければトランザクションを開かずに 400 を返す
+    merged_qty = defaultdict(int)  # 挿入順を保持
+    _dbg = app.logger.isEnabledFor(logging.DEBUG)  # ループ内の debug 呼び出しを無効時は丸ごと省く
+    for it in items:
+        try:
+            mid = int(it.get("menu_id"))
+            qty = int(it.get("qty", 1))
+            memo = (it.get("memo") or "").strip()
+            actual_price = it.get("actual_price")  # 時価商品の実際価格
+            if actual_price is not None:
+                actual_price = int(actual_price)
+        except Exception:
+            if _dbg:
+                app.logger.debug("[api_order] skip item (invalid menu_id/qty): %s", it)
+            continue
+        if qty <= 0:
+            if _dbg:
+                app.logger.debug("[api_order] skip item (qty<=0): %s", it)
+            continue
+        merged_qty[(mid, memo, actual_price)] += qty
+    if not merged_qty:
+        app.logger.warning("[api_order] no valid items (pre-check)")
+        return jsonify({"ok": False, "error": "no valid items"}), 400
+    parsed = [{"mid": mid, "qty": qty, "memo": memo, "actual_price": actual_price}
+              for (mid, memo, actual_price), qty in merged_qty.items()]
+
     # 💡 verify_tokenから取得したtable_idをログに出力
     table_id = verify_token(token)
     app.logger.info(f"DEBUG: verify_tokenから取得したtable_id: {table_id}")
@@ -13571,6 +13798,8 @@ def api_order():
         return jsonify({"ok": False, "error": "invalid table_id"}), 400
 
     s = SessionLocal()
+    # このリクエストではコミット後に ORM 属性を再読込しない（応答はコミット前に確定させる）
+    s.expire_on_commit = False
     try:
         t = s.get(TableSeat, table_id)
         if not t:
@@ -13744,45 +13973,59 @@ def api_order():
         # --- 明細作成に使う store_id は、上で確定した値をそのまま使う ---
         app.logger.debug("[api_order] store_id for order items: %s", store_id)
 
-        subtotal = int(order.subtotal or 0)
-        taxsum   = int(order.tax or 0)
         added    = 0
         new_items_for_print = []
 
         # ★ パフォーマンス最適化: メニューを一括取得してN+1問題を解決
-        menu_ids = []
-        for it in items:
-            try:
-                mid = int(it.get("menu_id"))
-                qty = int(it.get("qty", 1))
-                if qty > 0:
-                    menu_ids.append(mid)
-            except Exception:
-                pass
+        menu_ids = list({p["mid"] for p in parsed})
         
         # 全メニューを一度に取得
         menus = s.query(Menu).filter(Menu.id.in_(menu_ids), Menu.available == 1).all() if menu_ids else []
         menu_map = {m.id: m for m in menus}
-        
-        for it in items:
-            try:
-                mid = int(it.get("menu_id"))
-                qty = int(it.get("qty", 1))
-            except Exception:
-                app.logger.debug("[api_order] skip item (invalid menu_id/qty): %s", it)
-                continue
-            if qty <= 0:
-                app.logger.debug("[api_order] skip item (qty<=0): %s", it)
-                continue
 
-            memo = (it.get("memo") or "").strip()
-            actual_price = it.get("actual_price")  # 時価商品の実際価格
+        # 列の有無はループ中に変わらないので、共通 kwargs と共に1回だけ判定
+        item_base_kwargs = {"order_id": order.id}
+        if store_id is not None and hasattr(OrderItem, "store_id"):
+            item_base_kwargs["store_id"] = store_id
+        has_actual_price = hasattr(OrderItem, "actual_price")
+
+        # 追加日時・状態は同一リクエストの明細で共通（過去日付注文モードもここで1回だけ解釈）
+        added_at_value = datetime.now()
+        item_status = "新規"
+        scheduled_date_value = None
+        date_memo = None
+        if custom_date_str:
+            try:
+                custom_datetime = datetime.strptime(custom_date_str, "%Y-%m-%d %H:%M:%S")
+                added_at_value = custom_datetime
+                item_status = "提供済"  # 過去日付の場合はKDSに表示しない
+                scheduled_date_value = custom_datetime
+                date_memo = f"[登録予定: {custom_date_str}]"
+                app.logger.info(f"[api_order] 過去日付で登録: added_at={added_at_value}, status={item_status}, scheduled_date={scheduled_date_value}")
+            except Exception as parse_err:
+                app.logger.warning("[api_order] custom_date parse failed: %s", parse_err)
+
+        # 実効税率はメニューIDごとに1回だけ解決（同一メニューの複数行で再クエリしない）
+        rate_cache = {}
+
+        def _rate(mid, default):
+            r = rate_cache.get(mid)
+            if r is None:
+                r = rate_cache[mid] = resolve_effective_tax_rate_for_menu(s, mid, default)
+            return r
+        
+        for p in parsed:
+            mid = p["mid"]
+            qty = p["qty"]
+            memo = p["memo"]
+            actual_price = p["actual_price"]
             m = menu_map.get(mid)
             if not m:
-                app.logger.debug("[api_order] skip item (menu not available): id=%s", mid)
+                if _dbg:
+                    app.logger.debug("[api_order] skip item (menu not available): id=%s", mid)
                 continue
 
-            rate = resolve_effective_tax_rate_for_menu(s, mid, m.tax_rate)
+            rate = _rate(mid, m.tax_rate)
             unit = int(m.price)  # 税抜保存単価
             
             # 時価商品の場合、actual_priceを使用
@@ -13790,30 +14033,12 @@ def api_order():
                 unit = int(actual_price)
                 app.logger.info("[api_order] market price item: menu_id=%s actual_price=%s", mid, unit)
 
-            # 過去日付注文モードの処理
-            from datetime import datetime
-            if custom_date_str:
-                try:
-                    custom_datetime = datetime.strptime(custom_date_str, "%Y-%m-%d %H:%M:%S")
-                    added_at_value = custom_datetime
-                    item_status = "提供済"  # 過去日付の場合はKDSに表示しない
-                    scheduled_date_value = custom_datetime
-                    # メモに登録予定日時を追加
-                    date_memo = f"[登録予定: {custom_date_str}]"
-                    memo = f"{date_memo} {memo}".strip() if memo else date_memo
-                    app.logger.info(f"[api_order] 過去日付で登録: added_at={added_at_value}, status={item_status}, scheduled_date={scheduled_date_value}")
-                except Exception as parse_err:
-                    app.logger.warning("[api_order] custom_date parse failed: %s", parse_err)
-                    added_at_value = datetime.now()
-                    item_status = "新規"
-                    scheduled_date_value = None
-            else:
-                added_at_value = datetime.now()
-                item_status = "新規"
-                scheduled_date_value = None
+            # 過去日付注文モード：メモに登録予定日時を追加
+            if date_memo:
+                memo = f"{date_memo} {memo}".strip() if memo else date_memo
 
             new_item = OrderItem(
-                order_id=order.id,
+                **item_base_kwargs,  # order_id / 店舗ID
                 menu_id=mid,
                 qty=qty,
                 unit_price=unit,   # 税抜単価
@@ -13823,26 +14048,11 @@ def api_order():
                 added_at=added_at_value,
                 scheduled_date=scheduled_date_value,
             )
-            # 店舗IDを設定（Pythonの属性名を使用）
-            if store_id is not None and hasattr(new_item, "store_id"):
-                new_item.store_id = store_id
-            
             # actual_priceをOrderItemに保存
-            if actual_price is not None and hasattr(new_item, 'actual_price'):
+            if actual_price is not None and has_actual_price:
                 new_item.actual_price = int(actual_price)
             s.add(new_item)
-            
-            # 進捗データを初期化（新規=数量で開始）
-            try:
-                progress_seed_if_needed(s, new_item)
-            except Exception as e:
-                app.logger.warning("[api_order] progress_seed failed for item %s: %s", new_item.id, e)
-            
             new_items_for_print.append(new_item)
-
-            subtotal += unit * qty
-            per_unit_tax = int(math.floor(unit * rate))
-            taxsum += per_unit_tax * qty
             added  += 1
 
         if added == 0:
@@ -13853,30 +14063,55 @@ def api_order():
         # ★ 全商品追加後に1回だけflushしてIDを確定
         s.flush()
 
-        order.subtotal = subtotal
-        order.tax      = taxsum
-        order.total    = subtotal + taxsum
+        # 進捗データを初期化（新規=数量で開始）：確定した ID でまとめて1回
+        try:
+            with s.begin_nested():
+                progress_seed_many(s, new_items_for_print)
+        except Exception as e:
+            app.logger.warning("[api_order] progress_seed failed for items %s: %s",
+                               [it.id for it in new_items_for_print], e)
+
+        # 印刷用にはコミット前に値を写し取る（コミット後の ORM 属性アクセスで再SELECTしない）
+        print_items = [
+            PrintItem(
+                id=it.id,
+                menu_id=it.menu_id,
+                menu_name=menu_map[it.menu_id].name,
+                qty=it.qty,
+                unit_price=it.unit_price,
+                tax_rate=it.tax_rate,
+                memo=it.memo,
+                added_at=it.added_at,
+            )
+            for it in new_items_for_print
+        ]
+
+        # 合計は明細行から SQL 1文で再集計（Python 側の積算と二重管理しない）
+        subtotal, taxsum, total = _recalc_order_totals_sql(s, order.id, order)
+
+        order_id = order.id
+        result = {
+            "ok": True,
+            "order_id": order_id,
+            "subtotal": subtotal,
+            "tax": taxsum,
+            "total": total,
+            "new_item_ids": [item.id for item in print_items],
+        }
 
         app.logger.debug("[api_order] commit: order_id=%s subtotal=%s tax=%s total=%s",
-                         order.id, order.subtotal, order.tax, order.total)
+                         order_id, subtotal, taxsum, total)
 
         s.commit()
         mark_floor_changed()
 
         # 印刷処理（印刷ルールに基づいてKDS印刷を実行）
         try:
-            _trigger_kds_print(s, order.id, new_items_for_print)
+            _trigger_kds_print(s, order_id, print_items)
         except Exception:
             app.logger.exception("[api_order] KDS print failed (non-fatal)")
 
-        return jsonify({
-            "ok": True,
-            "order_id": order.id,
-            "subtotal": order.subtotal,
-            "tax": order.tax,
-            "total": order.total,
-            "new_item_ids": [item.id for item in new_items_for_print]
-        })
+        return jsonify(result)
     except Exception as e:
         s.rollback()
         app.logger.error("[api_order] error: %s", e, exc_info=True)
@@ -13936,6 +14171,22 @@ class T_店員呼び出し(Base):
 
 class T_テーブル移動履歴(Base):
     __tablename__ = "T_テーブル移動履歴"
+    __table_args__ = (
+        # 履歴一覧（テナント/店舗 + 期間）
+        Index("ix_move_tenant_store_time", "テナントID", "店舗ID", "移動日時"),
+        # 履歴一覧のテーブル絞り込み（移動元 OR 移動先）
+        Index("ix_move_store_from_table", "店舗ID", "移動元テーブルID"),
+        Index("ix_move_store_to_table", "店舗ID", "移動先テーブルID"),
+        # 取消・参照（注文IDから履歴を引く）
+        Index("ix_move_order_id", "注文ID"),
+        Index("ix_move_dest_order_id", "移動先注文ID"),
+        # 未取消の履歴のみ（部分インデックス）
+        Index("ix_move_active", "取消済み", "移動日時",
+              postgresql_where=text('"取消済み" = 0'),
+              sqlite_where=text('"取消済み" = 0')),
+        # ハッシュチェーンの末尾取得・未封印行の抽出
+        Index("ix_move_chain_seq", "チェーン連番"),
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     tenant_id = Column("テナントID", Integer, ForeignKey("M_テナント.id"), nullable=True)
@@ -13964,6 +14215,11 @@ class T_テーブル移動履歴(Base):
     adult_female = Column("大人女性", Integer, nullable=True)
     child_male = Column("子ども男", Integer, nullable=True)
     child_female = Column("子ども女", Integer, nullable=True)
+    # 合計人数（SELECT 時に SQL 側で計算する読み取り専用の列。NULL は 0 扱い）
+    total_people = column_property(
+        func.coalesce(adult_male, 0) + func.coalesce(adult_female, 0)
+        + func.coalesce(child_male, 0) + func.coalesce(child_female, 0)
+    )
     
     # 実行者
     staff_id = Column("スタッフID", Integer, nullable=True)
@@ -13978,30 +14234,633 @@ class T_テーブル移動履歴(Base):
     cancelled_by_staff_id = Column("取消実行者ID", Integer, nullable=True)
     cancelled_by_staff_name = Column("取消実行者名", String, nullable=True)
     
-    # 明細追跡（JSON形式）
-    source_items_snapshot = Column("移動元明細JSON", Text, nullable=True)
-    dest_items_snapshot = Column("移動先明細JSON", Text, nullable=True)
+    # 明細追跡（JSON形式：PostgreSQL は JSONB / SQLite は JSON1 の TEXT）
+    source_items_snapshot = Column("移動元明細JSON", JSON().with_variant(JSONB, "postgresql"), nullable=True)
+    dest_items_snapshot = Column("移動先明細JSON", JSON().with_variant(JSONB, "postgresql"), nullable=True)
     
     # 追加の注文ID情報
     dest_order_id = Column("移動先注文ID", Integer, nullable=True)  # merge/swapの場合
     new_order_id = Column("新規注文ID", Integer, nullable=True)    # merge_newの場合
 
+    # 改ざん検知用ハッシュチェーン（TABLE_MOVE_HISTORY_CHAIN=1 時にバッチで付与）
+    chain_seq = Column("チェーン連番", Integer, nullable=True)
+    prev_hash = Column("前ハッシュ", LargeBinary(32), nullable=True)
+    curr_hash = Column("ハッシュ", LargeBinary(32), nullable=True)
+
+
+# PostgreSQL で新規作成する場合のみ、移動日時の月次 RANGE パーティションで作成する
+TABLE_MOVE_HISTORY_PARTITIONED = os.getenv("TABLE_MOVE_HISTORY_PARTITIONED", "0") == "1"
+
+
+# --- [DDL] T_テーブル移動履歴 をパーティション親テーブルとして作成（PostgreSQL） ----------
+def _create_partitioned_table_move_history(conn):
+    from sqlalchemy.schema import CreateTable
+    ddl = str(CreateTable(T_テーブル移動履歴.__table__).compile(dialect=conn.dialect)).strip()
+    # パーティションキーは主キーに含める必要がある（ORM 側の主キーは id のまま）
+    ddl = ddl.replace("PRIMARY KEY (id)", 'PRIMARY KEY (id, "移動日時")')
+    conn.execute(text(ddl + ' PARTITION BY RANGE ("移動日時")'))
+    # 月次パーティションの作成漏れ時の受け皿
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS "T_テーブル移動履歴_default" PARTITION OF "T_テーブル移動履歴" DEFAULT'
+    ))
+
+
+# --- [DDL] 月次パーティション作成（T_テーブル移動履歴_YYYYMM） -----------------------------
+def create_table_move_history_partition(conn, year: int, month: int) -> str:
+    """
+    指定月のパーティションを作成（既存ならスキップ）して名前を返す。
+    保持期間を過ぎた月は DROP TABLE "T_テーブル移動履歴_YYYYMM" で削除できる。
+    """
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    name = f"T_テーブル移動履歴_{year:04d}{month:02d}"
+    conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "T_テーブル移動履歴" '
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    ))
+    return name
+
+
+# --- [DDL] 当月〜months_ahead ヶ月先のパーティションを保証 ---------------------------------
+def ensure_table_move_history_partitions(eng, months_ahead: int = 1) -> list:
+    if eng is None or eng.dialect.name != "postgresql":
+        return []
+    with eng.begin() as conn:
+        partitioned = conn.execute(text("""
+            SELECT 1 FROM pg_partitioned_table pt
+            JOIN pg_class c ON c.oid = pt.partrelid
+            WHERE c.relname = 'T_テーブル移動履歴'
+        """)).first() is not None
+        if not partitioned:
+            return []
+        now = datetime.now(timezone.utc)
+        year, month = now.year, now.month
+        names = []
+        for _ in range(months_ahead + 1):
+            names.append(create_table_move_history_partition(conn, year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return names
+
+
+# --- [CLI] flask --app app create-move-history-partitions（cron から月次実行） -----------
+@app.cli.command("create-move-history-partitions")
+def _cli_create_move_history_partitions():
+    names = ensure_table_move_history_partitions(_shared_engine_or_none())
+    print(f"[MIGRATE] T_テーブル移動履歴 partitions: {names or 'not partitioned'}")
+
+
+# --- マイグレーション：T_テーブル移動履歴 を保証（JSONB 化 + GIN インデックス） -------
+def _ensure_table_move_history_table():
+    eng = _shared_engine_or_none()
+    if eng is None:
+        return
+    if (eng.dialect.name == "postgresql" and TABLE_MOVE_HISTORY_PARTITIONED
+            and not inspect(eng).has_table("T_テーブル移動履歴")):
+        with eng.begin() as conn:
+            _create_partitioned_table_move_history(conn)
+    else:
+        T_テーブル移動履歴.__table__.create(bind=eng, checkfirst=True)
+    # 既存テーブルに後から追加した列を補完
+    existing_cols = {c["name"] for c in inspect(eng).get_columns("T_テーブル移動履歴")}
+    for col in T_テーブル移動履歴.__table__.columns:
+        if col.name not in existing_cols:
+            with eng.begin() as conn:
+                conn.execute(text(
+                    f'ALTER TABLE "T_テーブル移動履歴" ADD COLUMN "{col.name}" {col.type.compile(eng.dialect)}'
+                ))
+    # 既存テーブルにも __table_args__ のインデックスを補完
+    for idx in T_テーブル移動履歴.__table__.indexes:
+        idx.create(bind=eng, checkfirst=True)
+    if eng.dialect.name != "postgresql":
+        return  # SQLite は TEXT のまま JSON1 関数で参照できる
+    ensure_table_move_history_partitions(eng)
+    with eng.begin() as conn:
+        for col, idx in (("移動元明細JSON", "ix_move_src_items_gin"),
+                         ("移動先明細JSON", "ix_move_dest_items_gin")):
+            typ = conn.execute(text("""
+                SELECT data_type FROM information_schema.columns
+                WHERE table_name = 'T_テーブル移動履歴' AND column_name = :c
+            """), {"c": col}).scalar()
+            if typ and typ != "jsonb":
+                conn.execute(text(
+                    f'ALTER TABLE "T_テーブル移動履歴" ALTER COLUMN "{col}" TYPE JSONB USING "{col}"::jsonb'
+                ))
+            conn.execute(text(
+                f'CREATE INDEX IF NOT EXISTS "{idx}" ON "T_テーブル移動履歴" USING gin ("{col}")'
+            ))
+    _set_snapshot_column_compression(eng)
+
+
+# --- [DDL] スナップショット列の TOAST 圧縮を lz4 に（PostgreSQL 14+ / 以降の書込みに適用） ---
+def _set_snapshot_column_compression(eng):
+    with eng.connect() as conn:
+        if int(conn.execute(text("SHOW server_version_num")).scalar() or 0) < 140000:
+            return
+        rows = conn.execute(text("""
+            SELECT a.attname, a.attcompression FROM pg_attribute a
+            JOIN pg_class c ON c.oid = a.attrelid
+            WHERE c.relname = 'T_テーブル移動履歴' AND a.attname IN ('移動元明細JSON', '移動先明細JSON')
+        """)).fetchall()
+    for col, compression in rows:
+        if compression == "l":
+            continue
+        try:
+            with eng.begin() as conn:
+                conn.execute(text(f'ALTER TABLE "T_テーブル移動履歴" ALTER COLUMN "{col}" SET COMPRESSION lz4'))
+        except Exception as e:
+            # lz4 無しでビルドされたサーバーでは既定（pglz）のまま
+            print(f"[MIGRATE] T_テーブル移動履歴.{col} SET COMPRESSION lz4 skipped: {e}")
+
+
+try:
+    _ensure_table_move_history_table()
+except Exception as e:
+    print(f"[MIGRATE] T_テーブル移動履歴 migration failed: {e}")
+
+
+# --- [起動時] 既存の T_注文 / T_注文明細 にも検索用の複合インデックスを補完 -----------
+_HOT_PATH_INDEXES = (
+    (OrderHeader, "ix_order_active_lookup"),
+    (OrderHeader, "ix_order_store_status_closed"),
+    (OrderItem, "ix_order_item_order_id"),
+)
+
+
+def _ensure_hot_path_indexes():
+    eng = _shared_engine_or_none()
+    if eng is None:
+        return
+    insp = inspect(eng)
+    for model, name in _HOT_PATH_INDEXES:
+        if not insp.has_table(model.__tablename__):
+            continue
+        for idx in model.__table__.indexes:
+            if idx.name == name:
+                try:
+                    idx.create(bind=eng, checkfirst=True)
+                except Exception as e:
+                    print(f"[MIGRATE] {name} creation failed: {e}")
+
+
+try:
+    _ensure_hot_path_indexes()
+except Exception as e:
+    print(f"[MIGRATE] hot path index creation failed: {e}")
+
+
+# --- [ヘルパ] 明細スナップショットの読取（旧 TEXT 行は文字列で返るため吸収） -----------
+def _load_items_snapshot(value):
+    if value is None or isinstance(value, dict):
+        return value
+    return json.loads(value)
 
 
 # ========================================
-# 2. admin_table_move 関数に履歴記録処理を追加
-# （既存の admin_table_move 関数の最後、s.commit() の前に追加）
+# テーブル移動履歴：ハッシュチェーン（改ざん検知）
+#   - TABLE_MOVE_HISTORY_CHAIN=1 のとき、書込み後にバッファのワーカーがまとめて封印する
+#   - curr_hash = sha256(prev_hash + 正規化JSON)。取消列（後から更新される）は対象外
 # ========================================
+TABLE_MOVE_HISTORY_CHAIN = os.getenv("TABLE_MOVE_HISTORY_CHAIN", "0") == "1"
+_CHAIN_GENESIS = b"\x00" * 32
+_CHAIN_FIELDS = (
+    "id", "tenant_id", "store_id", "moved_at", "from_table_id", "to_table_id", "mode",
+    "order_id", "order_status", "item_count", "subtotal", "tax", "total", "paid", "remaining",
+    "adult_male", "adult_female", "child_male", "child_female", "staff_id", "staff_name", "memo",
+    "source_items_snapshot", "dest_items_snapshot", "dest_order_id", "new_order_id",
+)
+_chain_lock = threading.Lock()
+
+
+# --- [ハッシュチェーン] 履歴行の正規化 JSON ------------------------------------------------
+def _table_move_history_canonical(h) -> bytes:
+    payload = {k: getattr(h, k, None) for k in _CHAIN_FIELDS}
+    # 移動日時は UTC の ISO 文字列に固定（str() だと Postgres のセッション TimeZone で表記が変わる）
+    moved_at = payload["moved_at"]
+    if isinstance(moved_at, datetime):
+        if moved_at.tzinfo is None:
+            moved_at = moved_at.replace(tzinfo=timezone.utc)  # SQLite などは UTC のまま naive で返る
+        payload["moved_at"] = moved_at.astimezone(timezone.utc).isoformat()
+    for k in ("source_items_snapshot", "dest_items_snapshot"):
+        payload[k] = _load_items_snapshot(payload[k])
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"),
+                      ensure_ascii=False, default=str).encode("utf-8")
+
+
+# --- [ハッシュチェーン] 未封印行にまとめてハッシュを付与 ----------------------------------
+def seal_table_move_history_chain(bind, batch_size: int = 500) -> int:
+    """未封印（チェーン連番 NULL）の履歴を id 順に封印し、封印した件数を返す"""
+    H = T_テーブル移動履歴
+    sealed = 0
+    with _chain_lock, Session(bind=bind) as s, s.begin():
+        if bind.dialect.name == "postgresql":
+            # 複数ワーカーからの同時封印でチェーンが分岐しないよう直列化
+            s.execute(text("SELECT pg_advisory_xact_lock(hashtext('T_テーブル移動履歴.chain'))"))
+        tip = (s.query(H.chain_seq, H.curr_hash)
+                 .filter(H.chain_seq.isnot(None))
+                 .order_by(H.chain_seq.desc()).first())
+        seq, prev = (tip.chain_seq, tip.curr_hash) if tip else (0, _CHAIN_GENESIS)
+        while True:
+            rows = (s.query(H).filter(H.chain_seq.is_(None))
+                      .order_by(H.id.asc()).limit(batch_size).all())
+            if not rows:
+                break
+            for h in rows:
+                seq += 1
+                h.chain_seq = seq
+                h.prev_hash = prev
+                prev = h.curr_hash = hashlib.sha256(prev + _table_move_history_canonical(h)).digest()
+            s.flush()
+            sealed += len(rows)
+    return sealed
+
+
+# --- [ハッシュチェーン] 検証（オフライン再計算） ------------------------------------------
+def verify_table_move_history_chain(bind) -> list:
+    """チェーンを先頭から再計算し、不整合のあった履歴IDを返す（空なら正常）"""
+    H = T_テーブル移動履歴
+    broken = []
+    prev = _CHAIN_GENESIS
+    with Session(bind=bind) as s:
+        q = (s.query(H).filter(H.chain_seq.isnot(None))
+               .order_by(H.chain_seq.asc()).yield_per(500))
+        for h in q:
+            expected = hashlib.sha256(prev + _table_move_history_canonical(h)).digest()
+            if h.prev_hash != prev or h.curr_hash != expected:
+                broken.append(h.id)
+            prev = h.curr_hash
+    return broken
+
+
+# --- [CLI] flask --app app seal-move-history-chain / verify-move-history-chain -------------
+@app.cli.command("seal-move-history-chain")
+def _cli_seal_move_history_chain():
+    eng = _shared_engine_or_none()
+    if eng is None:
+        print("[CHAIN] shared モード以外は未対応")
+        return
+    print(f"[CHAIN] sealed: {seal_table_move_history_chain(eng)}")
 
-def _record_table_move_history(s, sid, from_table_id, to_table_id, mode, order_from, order_to=None, new_order_id=None):
+
+@app.cli.command("verify-move-history-chain")
+def _cli_verify_move_history_chain():
+    eng = _shared_engine_or_none()
+    if eng is None:
+        print("[CHAIN] shared モード以外は未対応")
+        return
+    broken = verify_table_move_history_chain(eng)
+    print(f"[CHAIN] {'OK' if not broken else f'broken ids: {broken}'}")
+
+
+# ========================================
+# テーブル移動履歴：書き込みバッファ
+#   - AUDIT_TRAIL_BUFFER=1 のときのみ有効（既定は同期 INSERT）
+#   - 複数ワーカー構成では他ワーカーの未フラッシュ分は参照側から見えないため、
+#     取消（直近移動判定）を厳密に運用する場合は無効のままにする
+# ========================================
+AUDIT_TRAIL_BUFFER_ENABLED = os.getenv("AUDIT_TRAIL_BUFFER", "0") == "1"
+AUDIT_TRAIL_BUFFER_FLUSH_INTERVAL = float(os.getenv("AUDIT_TRAIL_BUFFER_FLUSH_INTERVAL", "30"))
+AUDIT_TRAIL_BUFFER_MAX_SIZE = int(os.getenv("AUDIT_TRAIL_BUFFER_MAX_SIZE", "500"))
+AUDIT_TRAIL_BUFFER_MAX_PENDING = int(os.getenv("AUDIT_TRAIL_BUFFER_MAX_PENDING", "1024"))
+
+
+class AuditTrailBuffer:
     """
-    テーブル移動履歴を記録する
-    
-    Args:
-        s: SQLAlchemy session
-        sid: 店舗ID
-        from_table_id: 移動元テーブルID
-        to_table_id: 移動先テーブルID
+    監査行（属性名キーの dict）を溜めて executemany の INSERT でまとめて書き込むバッファ。
+    - append() で積み、件数が max_size に達するか flush_interval 秒ごとにワーカーがフラッシュ
+    - append() はリクエストスレッドで書き込まない
+    - 未書き込みが max_pending に達しているか直近の書き込みが失敗している間は has_room() が False になり、
+      呼び出し側はバッファを使わず移動と同じトランザクションで同期 INSERT する（監査行は捨てない）
+    - 行は書き込み先エンジンごとにまとめる（db-per-tenant 対応）
+    - 書き込みに失敗した行は先頭に戻して次回に再試行
+    - on_flush(bind) を渡すと、行が書き込まれたエンジンごとにフラッシュ後に呼ぶ
+      （同期 INSERT 分は mark_written() で通知）
+    """
+
+    def __init__(self, model, flush_interval: float, max_size: int, on_flush=None, max_pending: int | None = None):
+        self._table = model.__table__
+        # ORM 属性名 → 物理カラムキー（"moved_at" → "移動日時" など）
+        self._colkeys = {p.key: p.columns[0].key for p in inspect(model).column_attrs}
+        self._flush_interval = flush_interval
+        self._max_size = max_size
+        self._max_pending = max(max_pending or 0, max_size)
+        self._on_flush = on_flush
+        self._rows = deque()
+        self._failing = False
+        self._written_binds = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker = None
+
+    def _ensure_worker(self) -> None:
+        # gunicorn の fork 後（各ワーカー内）で初めて起動させる（self._lock 保持中に呼ぶ）
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name="audit-trail-buffer", daemon=True)
+            self._worker.start()
+
+    def has_room(self) -> bool:
+        """新しい行を積んでよいか（満杯・書き込み失敗中は False：呼び出し側で同期 INSERT する）"""
+        with self._lock:
+            return not self._failing and len(self._rows) < self._max_pending
+
+    def append(self, bind, row: dict) -> None:
+        with self._lock:
+            self._rows.append((bind, row))
+            size = len(self._rows)
+            self._ensure_worker()
+        if size >= self._max_size:
+            self._wake.set()  # 書き込みはワーカーに任せてリクエストへ戻る
+
+    def mark_written(self, bind) -> None:
+        """バッファを経由せず書き込まれた行がある（次回フラッシュで on_flush を呼ぶ）"""
+        if self._on_flush is None:
+            return
+        with self._lock:
+            self._written_binds.add(bind)
+            self._ensure_worker()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("[audit_buffer] periodic flush failed")
+
+    def flush(self) -> int:
+        """溜まっている行を書き込み、書き込んだ件数を返す"""
+        with self._flush_lock:
+            with self._lock:
+                pending = list(self._rows)
+                self._rows.clear()
+                written_binds = set(self._written_binds)
+                self._written_binds.clear()
+            if not pending:
+                self._after_flush(written_binds)
+                return 0
+
+            by_bind = defaultdict(list)
+            for bind, row in pending:
+                by_bind[bind].append({self._colkeys.get(k, k): v for k, v in row.items()})
+
+            written = 0
+            failed = False
+            for bind, rows in by_bind.items():
+                try:
+                    with bind.begin() as conn:
+                        conn.execute(self._table.insert(), rows)
+                    written += len(rows)
+                except Exception:
+                    app.logger.exception("[audit_buffer] flush failed (rows=%s); will retry", len(rows))
+                    with self._lock:
+                        self._rows.extendleft((bind, r) for r in reversed(rows))
+                    failed = True
+                    continue
+                written_binds.add(bind)
+            # 失敗中は新しい行を積ませない（has_room() が False になり同期 INSERT へ回る）
+            with self._lock:
+                self._failing = failed
+            self._after_flush(written_binds)
+            return written
+
+    def _after_flush(self, binds) -> None:
+        if self._on_flush is None:
+            return
+        for bind in binds:
+            try:
+                self._on_flush(bind)
+            except Exception:
+                app.logger.exception("[audit_buffer] on_flush failed")
+                with self._lock:
+                    self._written_binds.add(bind)
+
+    def flush_on_shutdown(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+    def append_on_commit(self, s, row: dict | None) -> None:
+        """
+        セッション s のコミット成功時にだけ append する（ロールバック時は破棄）。
+        row=None は同期 INSERT 済みの通知（コミット後に mark_written）。
+        """
+        s.info.setdefault("_audit_trail_rows", []).append((self, s.get_bind(), row))
+
+
+table_move_audit_buffer = AuditTrailBuffer(
+    T_テーブル移動履歴,
+    flush_interval=AUDIT_TRAIL_BUFFER_FLUSH_INTERVAL,
+    max_size=AUDIT_TRAIL_BUFFER_MAX_SIZE,
+    on_flush=seal_table_move_history_chain if TABLE_MOVE_HISTORY_CHAIN else None,
+    max_pending=AUDIT_TRAIL_BUFFER_MAX_PENDING,
+)
+atexit.register(table_move_audit_buffer.flush_on_shutdown)
+
+
+# --- [監査バッファ] コミット確定後にバッファへ移す / ロールバック時は破棄 -----------------
+@event.listens_for(Session, "after_commit")
+def _audit_trail_after_commit(sess):
+    for buf, bind, row in sess.info.pop("_audit_trail_rows", ()):
+        if row is None:
+            buf.mark_written(bind)
+        else:
+            buf.append(bind, row)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _audit_trail_after_rollback(sess, previous_transaction):
+    if not sess.in_transaction():  # SAVEPOINT の巻き戻しでは外側が残るので保持
+        sess.info.pop("_audit_trail_rows", None)
+
+
+
+# ========================================
+# テーブル移動で使うモデル・列名の解決（初回呼び出し時に1回だけ）
+#   T_お客様詳細 などファイル後半で定義されるモデルがあるため import 時ではなく遅延で解決し、
+#   以降はキャッシュを返す（globals().get / hasattr を呼び出し毎に繰り返さない）
+# ========================================
+@dataclass(frozen=True)
+class _TableMoveModels:
+    THistory: Any
+    TOrder: Any
+    TItem: Any
+    TPay: Any
+    TCD: Any
+    TMenu: Any
+    TQR: Any
+    cols: dict
+    has_src_snapshot: bool = False
+    has_dst_snapshot: bool = False
+    history_colkeys: dict | None = None
+
+
+_table_move_models_cache = {}
+
+# テーブル移動でアクティブとみなす注文状態（IN 句は expanding bindparam で渡し、文のキャッシュを効かせる）
+_ACTIVE_STATUSES = ("新規", "調理中", "提供済", "会計中", "open", "pending", "in_progress", "serving", "unpaid")
+
+# 履歴モデルの有無は読み込み時に確定（無い環境では記録処理を呼び出し側で丸ごと省く）
+_HISTORY_ENABLED = globals().get("T_テーブル移動履歴") is not None
+
+
+def _first_attr_name(model, *names):
+    if model is None:
+        return None
+    for n in names:
+        if hasattr(model, n):
+            return n
+    return None
+
+
+def _first_attr_value(obj, *names):
+    # `a or b` と違い 0 を欠損扱いしない（最初に None でない値を返す）
+    for n in names:
+        v = getattr(obj, n, None)
+        if v is not None:
+            return v
+    return None
+
+
+def _int_or_none(v):
+    return int(v) if v is not None else None
+
+
+def _table_move_models() -> _TableMoveModels:
+    m = _table_move_models_cache.get("models")
+    if m is None:
+        g_ = globals()
+        TItem = g_.get("T_注文明細") or g_.get("T_注文詳細") or g_.get("OrderItem")
+        TPay = g_.get("T_支払") or g_.get("PaymentRecord")
+        TMenu = g_.get("Menu") or g_.get("M_メニュー")
+        THistory = g_.get("T_テーブル移動履歴")
+        m = _TableMoveModels(
+            THistory=THistory,
+            TOrder=g_.get("T_注文") or g_.get("OrderHeader"),
+            TItem=TItem,
+            TPay=TPay,
+            TCD=g_.get("T_お客様詳細"),
+            TMenu=TMenu,
+            TQR=g_.get("QrToken"),
+            cols={
+                "item_menu_id": _first_attr_name(TItem, "menu_id", "メニューID"),
+                "item_qty": _first_attr_name(TItem, "qty", "数量"),
+                "item_unit_price": _first_attr_name(TItem, "unit_price", "単価"),
+                "item_tax_rate": _first_attr_name(TItem, "tax_rate", "税率"),
+                "item_status": _first_attr_name(TItem, "status", "状態"),
+                "pay_amount": _first_attr_name(TPay, "amount", "金額"),
+                "pay_method_id": _first_attr_name(TPay, "method_id", "支払方法ID"),
+                "menu_name": _first_attr_name(TMenu, "name", "メニュー名"),
+            },
+            # スナップショット列が無い（未移行の）環境ではスナップショット作成自体を省く
+            has_src_snapshot=hasattr(THistory, "source_items_snapshot"),
+            has_dst_snapshot=hasattr(THistory, "dest_items_snapshot"),
+            # 履歴の ORM 属性名 → 物理カラムキー（Core INSERT 用、AuditTrailBuffer と同じ対応表）
+            history_colkeys=({p.key: p.columns[0].key for p in inspect(THistory).column_attrs}
+                             if THistory is not None else None),
+        )
+        _table_move_models_cache["models"] = m
+    return m
+
+
+# ========================================
+# 移動履歴の明細スナップショット
+#   必要な列だけを SELECT して組み立てる（ORM 実体化・遅延ロードなし）。
+#   明細に確実な変更マーカー（更新日時など）が無く、内容の版を取る集計も同じ表を読むため、
+#   キャッシュはせず毎回その時点の内容から作る。
+# ========================================
+def _snapshot_fetch_rows(s, model, fields, oid, limit=None):
+    """必要な列だけを (キー, 属性名) 指定で SELECT し dict のリストで返す（ORM 実体化・遅延ロードなし）"""
+    cols = [getattr(model, attr).label(key) for key, attr in fields if attr and hasattr(model, attr)]
+    q = s.query(*cols).filter(getattr(model, "order_id") == oid)
+    if limit:
+        q = q.order_by(getattr(model, "id").asc()).limit(limit)
+    return [dict(r._mapping) for r in q.all()]
+
+
+def _build_order_snapshot(s, M, oid):
+    """注文の明細スナップショットをJSON形式で作成"""
+    TItem, TPay, TCD, TMenu = M.TItem, M.TPay, M.TCD, M.TMenu
+    C = M.cols
+    snapshot = {
+        "order_id": oid,
+        "items": [],
+        "customer_detail": {},
+        "payments": []
+    }
+
+    # 明細情報（スナップショットに載せる6列のみ）
+    if TItem:
+        items = _snapshot_fetch_rows(s, TItem, [
+            ("id", "id"),
+            ("menu_id", C["item_menu_id"]),
+            ("qty", C["item_qty"]),
+            ("unit_price", C["item_unit_price"]),
+            ("tax_rate", C["item_tax_rate"]),
+            ("status", C["item_status"]),
+        ], oid)
+
+        # メニュー名は明細の menu_id をまとめて IN で1回だけ取得（id, 名称の2列のみ）
+        menu_ids = {i.get("menu_id") for i in items} - {None}
+        menu_map = {}
+        if TMenu and C["menu_name"] and menu_ids:
+            menu_map = dict(s.query(TMenu.id, getattr(TMenu, C["menu_name"]))
+                             .filter(TMenu.id.in_(menu_ids)).all())
+
+        # メニュー名を付与（解決できた明細のみ）
+        snapshot["items"] = [
+            {**item_data, "menu_name": menu_map[item_data["menu_id"]]}
+            if item_data.get("menu_id") in menu_map else item_data
+            for item_data in items
+        ]
+
+    # お客様詳細（id + 人数4列）
+    if TCD:
+        cd = _snapshot_fetch_rows(s, TCD, [
+            ("id", "id"),
+            ("adult_male", "大人男性"),
+            ("adult_female", "大人女性"),
+            ("child_male", "子ども男"),
+            ("child_female", "子ども女"),
+        ], oid, limit=1)
+        if cd:
+            snapshot["customer_detail"] = cd[0]
+
+    # 支払い情報（id / 金額 / 支払方法ID）
+    #   method はリレーション（PaymentMethod）なので JSON 化できる ID 列を保存
+    if TPay:
+        snapshot["payments"] = _snapshot_fetch_rows(s, TPay, [
+            ("id", "id"),
+            ("amount", C["pay_amount"]),
+            ("method_id", C["pay_method_id"]),
+        ], oid)
+
+    return snapshot
+
+
+def _order_snapshot(s, order_obj):
+    """注文のスナップショットを返す（注文が無ければ None）"""
+    oid = getattr(order_obj, "id", None)
+    if not oid:
+        return None
+    return _build_order_snapshot(s, _table_move_models(), oid)
+
+
+# ========================================
+# 2. admin_table_move 関数に履歴記録処理を追加
+# （既存の admin_table_move 関数の最後、s.commit() の前に追加）
+# ========================================
+
+def _record_table_move_history(s, sid, from_table_id, to_table_id, mode, order_from, order_to=None, new_order_id=None):
+    """
+    テーブル移動履歴を記録する
+    
+    Args:
+        s: SQLAlchemy session
+        sid: 店舗ID
+        from_table_id: 移動元テーブルID
+        to_table_id: 移動先テーブルID
         mode: 移動モード (move/merge/merge_new/swap)
         order_from: 移動元の注文オブジェクト
         order_to: 移動先の注文オブジェクト (merge/swapの場合)
@@ -14010,168 +14869,134 @@ def _record_table_move_history(s, sid, from_table_id, to_table_id, mode, order_f
     Returns:
         history_id: 作成された履歴レコードのID (失敗時はNone)
     """
+    if not _HISTORY_ENABLED:
+        return None
     try:
-        THistory = globals().get("T_テーブル移動履歴")
-        if THistory is None:
-            current_app.logger.warning("[table_move_history] T_テーブル移動履歴 not found")
-            return None
-        
-        TItem = globals().get("T_注文明細") or globals().get("OrderItem")
-        TPay = globals().get("T_支払") or globals().get("PaymentRecord")
-        TCD = globals().get("T_お客様詳細")
-        TMenu = globals().get("Menu") or globals().get("M_メニュー")
+        M = _table_move_models()
+        THistory = M.THistory
+        TItem, TPay, TCD = M.TItem, M.TPay, M.TCD
+        C = M.cols
         
         # 移動元の注文情報を取得
-        order_id = getattr(order_from, "id", None) if order_from else None
-        order_status = getattr(order_from, "status", None) if order_from else None
+        order_id = getattr(order_from, "id", None)
+        order_status = getattr(order_from, "status", None)
         
-        # 明細数を取得
+        # 明細数・既払額・人数を1回の SELECT でまとめて取得
+        #   明細数/既払額はスカラサブクエリ（JOIN による行の掛け算を避ける）、
+        #   お客様詳細は注文ヘッダへの LEFT JOIN で先頭1行の人数列を取る
         item_count = 0
-        if order_id and TItem:
-            item_count = s.query(TItem).filter(getattr(TItem, "order_id") == order_id).count()
-        
-        # 金額情報を取得
-        subtotal = getattr(order_from, "subtotal", None) or getattr(order_from, "小計", None) if order_from else None
-        tax = getattr(order_from, "tax", None) or getattr(order_from, "税額", None) if order_from else None
-        total = getattr(order_from, "total", None) or getattr(order_from, "合計", None) if order_from else None
-        
-        # 既払・残額を取得
         paid = 0
-        if order_id and TPay:
-            from sqlalchemy import func
-            paid = s.query(func.coalesce(func.sum(getattr(TPay, "amount", None) or getattr(TPay, "金額", None)), 0)) \
-                .filter(getattr(TPay, "order_id") == order_id).scalar() or 0
-        
-        remaining = int(total or 0) - int(paid or 0) if total else None
-        
-        # 人数情報を取得
         adult_male = None
         adult_female = None
         child_male = None
         child_female = None
+
+        if order_id:
+            from sqlalchemy import func, select
+            cols = []
+            if TItem:
+                cols.append(select(func.count(getattr(TItem, "id")))
+                            .where(getattr(TItem, "order_id") == order_id)
+                            .scalar_subquery().label("item_count"))
+            if TPay and C["pay_amount"]:
+                cols.append(select(func.coalesce(func.sum(getattr(TPay, C["pay_amount"])), 0))
+                            .where(getattr(TPay, "order_id") == order_id)
+                            .scalar_subquery().label("paid"))
+            cd_keys = [k for k in ("大人男性", "大人女性", "子ども男", "子ども女") if TCD and hasattr(TCD, k)]
+            cols.extend(getattr(TCD, k).label(k) for k in cd_keys)
+
+            if cols:
+                TOrder = type(order_from)
+                stmt = select(*cols).select_from(TOrder).where(getattr(TOrder, "id") == order_id)
+                if cd_keys:
+                    stmt = (stmt.outerjoin(TCD, getattr(TCD, "order_id") == getattr(TOrder, "id"))
+                                .order_by(getattr(TCD, "id").asc()))
+                m = s.execute(stmt.limit(1)).mappings().first() or {}
+                item_count = m.get("item_count") or 0
+                paid = m.get("paid") or 0
+                adult_male = m.get("大人男性")
+                adult_female = m.get("大人女性")
+                child_male = m.get("子ども男")
+                child_female = m.get("子ども女")
+
+        # 金額情報を取得
+        subtotal = _first_attr_value(order_from, "subtotal", "小計")
+        tax = _first_attr_value(order_from, "tax", "税額")
+        total = _first_attr_value(order_from, "total", "合計")
         
-        if TCD and order_id:
-            cd = s.query(TCD).filter(getattr(TCD, "order_id") == order_id).first()
-            if cd:
-                adult_male = getattr(cd, "大人男性", None)
-                adult_female = getattr(cd, "大人女性", None)
-                child_male = getattr(cd, "子ども男", None)
-                child_female = getattr(cd, "子ども女", None)
+        # 残額
+        remaining = int(total) - int(paid or 0) if total is not None else None
         
         # スタッフ情報を取得
         staff_id = session.get("user_id")
         staff_name = session.get("username")
         
-        # ===== 明細スナップショットを作成 =====
-        def _create_snapshot(order_obj):
-            """注文の明細スナップショットをJSON形式で作成"""
-            if not order_obj:
-                return None
-            
-            oid = getattr(order_obj, "id", None)
-            if not oid:
-                return None
-            
-            snapshot = {
-                "order_id": oid,
-                "items": [],
-                "customer_detail": {},
-                "payments": []
-            }
-            
-            # 明細情報
-            if TItem:
-                items = s.query(TItem).filter(getattr(TItem, "order_id") == oid).all()
-                for item in items:
-                    item_data = {
-                        "id": getattr(item, "id", None),
-                        "menu_id": getattr(item, "menu_id", None) or getattr(item, "メニューID", None),
-                        "qty": getattr(item, "qty", None) or getattr(item, "数量", None),
-                        "unit_price": getattr(item, "unit_price", None) or getattr(item, "単価", None),
-                        "tax_rate": getattr(item, "tax_rate", None) or getattr(item, "税率", None),
-                        "status": getattr(item, "status", None) or getattr(item, "状態", None),
-                    }
-                    
-                    # メニュー名を取得
-                    if TMenu and item_data["menu_id"]:
-                        menu = s.get(TMenu, item_data["menu_id"])
-                        if menu:
-                            item_data["menu_name"] = getattr(menu, "name", None) or getattr(menu, "メニュー名", None)
-                    
-                    snapshot["items"].append(item_data)
-            
-            # お客様詳細
-            if TCD:
-                cd = s.query(TCD).filter(getattr(TCD, "order_id") == oid).first()
-                if cd:
-                    snapshot["customer_detail"] = {
-                        "id": getattr(cd, "id", None),
-                        "adult_male": getattr(cd, "大人男性", None),
-                        "adult_female": getattr(cd, "大人女性", None),
-                        "child_male": getattr(cd, "子ども男", None),
-                        "child_female": getattr(cd, "子ども女", None),
-                    }
-            
-            # 支払い情報
-            if TPay:
-                payments = s.query(TPay).filter(getattr(TPay, "order_id") == oid).all()
-                for pay in payments:
-                    snapshot["payments"].append({
-                        "id": getattr(pay, "id", None),
-                        "amount": getattr(pay, "amount", None) or getattr(pay, "金額", None),
-                        "method": getattr(pay, "method", None) or getattr(pay, "支払方法", None),
-                    })
-            
-            return json.dumps(snapshot, ensure_ascii=False)
-        
-        source_snapshot = _create_snapshot(order_from)
-        dest_snapshot = _create_snapshot(order_to) if order_to else None
+        # ===== 明細スナップショット（毎回その時点の明細・支払・お客様詳細から作り直す） =====
+        source_snapshot = _order_snapshot(s, order_from) if M.has_src_snapshot else None
+        dest_snapshot = _order_snapshot(s, order_to) if order_to and M.has_dst_snapshot else None
         
         # 履歴レコードを作成
-        history = THistory()
+        row = {}
         if hasattr(THistory, "tenant_id"):
-            history.tenant_id = session.get("tenant_id")
+            row["tenant_id"] = session.get("tenant_id")
         if hasattr(THistory, "store_id"):
-            history.store_id = sid
-        
-        history.moved_at = datetime.now(timezone.utc)
-        history.from_table_id = from_table_id
-        history.to_table_id = to_table_id
-        history.mode = mode
-        
-        history.order_id = order_id
-        history.order_status = order_status
-        history.item_count = item_count
-        
-        history.subtotal = int(subtotal) if subtotal else None
-        history.tax = int(tax) if tax else None
-        history.total = int(total) if total else None
-        history.paid = int(paid) if paid else None
-        history.remaining = int(remaining) if remaining else None
-        
-        history.adult_male = int(adult_male) if adult_male else None
-        history.adult_female = int(adult_female) if adult_female else None
-        history.child_male = int(child_male) if child_male else None
-        history.child_female = int(child_female) if child_female else None
-        
-        history.staff_id = staff_id
-        history.staff_name = staff_name
-        
+            row["store_id"] = sid
+
+        row["moved_at"] = datetime.now(timezone.utc)
+        row["from_table_id"] = from_table_id
+        row["to_table_id"] = to_table_id
+        row["mode"] = mode
+
+        row["order_id"] = order_id
+        row["order_status"] = order_status
+        row["item_count"] = item_count
+
+        row["subtotal"] = _int_or_none(subtotal)
+        row["tax"] = _int_or_none(tax)
+        row["total"] = _int_or_none(total)
+        row["paid"] = _int_or_none(paid)
+        row["remaining"] = _int_or_none(remaining)
+
+        row["adult_male"] = _int_or_none(adult_male)
+        row["adult_female"] = _int_or_none(adult_female)
+        row["child_male"] = _int_or_none(child_male)
+        row["child_female"] = _int_or_none(child_female)
+
+        row["staff_id"] = staff_id
+        row["staff_name"] = staff_name
+
         # 新しい列を設定
-        history.source_items_snapshot = source_snapshot
-        history.dest_items_snapshot = dest_snapshot
-        history.dest_order_id = getattr(order_to, "id", None) if order_to else None
-        history.new_order_id = new_order_id
-        
-        s.add(history)
-        s.flush()
-        
-        history_id = getattr(history, "id", None)
-        
-        current_app.logger.info("[table_move_history] recorded: id=%s from=%s to=%s mode=%s order=%s dest_order=%s new_order=%s",
-                               history_id, from_table_id, to_table_id, mode, order_id, 
-                               history.dest_order_id, history.new_order_id)
-        
+        if M.has_src_snapshot:
+            row["source_items_snapshot"] = source_snapshot
+        if M.has_dst_snapshot:
+            row["dest_items_snapshot"] = dest_snapshot
+        row["dest_order_id"] = getattr(order_to, "id", None) if order_to else None
+        row["new_order_id"] = new_order_id
+        row["is_cancelled"] = 0
+
+        buffered = AUDIT_TRAIL_BUFFER_ENABLED and table_move_audit_buffer.has_room()
+        if buffered:
+            # バッファ経由：ID は後でまとめて採番されるため None を返す
+            table_move_audit_buffer.append_on_commit(s, row)
+            history_id = None
+        else:
+            # テーブルへの Core INSERT ... RETURNING id の1文で書き込む（ORM 属性計装・unit of work を通さない）
+            #   バッファが満杯・書き込み失敗中のときもこちら（移動と同じトランザクションで確実に残す）
+            tbl = THistory.__table__
+            colkeys = M.history_colkeys
+            stmt = tbl.insert().values({colkeys.get(k, k): v for k, v in row.items()})
+            if s.get_bind().dialect.insert_returning:
+                history_id = s.execute(stmt.returning(tbl.c.id)).scalar()
+            else:  # RETURNING 非対応（SQLite 3.35 未満など）は lastrowid から
+                history_id = s.execute(stmt).inserted_primary_key[0]
+            if TABLE_MOVE_HISTORY_CHAIN:
+                # ハッシュ付与はコミット後にワーカーでまとめて行う
+                table_move_audit_buffer.append_on_commit(s, None)
+
+        current_app.logger.info("[table_move_history] recorded: id=%s from=%s to=%s mode=%s order=%s dest_order=%s new_order=%s buffered=%s",
+                               history_id, from_table_id, to_table_id, mode, order_id,
+                               row["dest_order_id"], row["new_order_id"], buffered)
+
         return history_id
         
     except Exception as e:
@@ -14187,180 +15012,342 @@ def _record_table_move_history(s, sid, from_table_id, to_table_id, mode, order_f
 #   - 直近QRトークンを付替（swap時は相互交換）
 #   - 移動後：元テーブルのお客様詳細をリセット（孤児含む）
 # ---------------------------------------------------------------------
-# --- [スタッフ] テーブル移動：deny / merge / merge_new / swap -------------------
-@app.route("/admin/table/move", methods=["POST"])
-@require_staff
-def admin_table_move():
-    from sqlalchemy import func, and_
-    from datetime import datetime, timezone
-    s = SessionLocal()
+def _get_active_order(s, Model, store_id, table_id):
+    from sqlalchemy import select, bindparam
+    stmt = select(Model).where(getattr(Model, "table_id") == table_id)
+    params = {}
+    if hasattr(Model, "store_id"):
+        stmt = stmt.where(getattr(Model, "store_id") == store_id)
+    if hasattr(Model, "status"):
+        stmt = stmt.where(getattr(Model, "status").in_(bindparam("statuses", expanding=True)))
+        params["statuses"] = _ACTIVE_STATUSES
+    stmt = stmt.order_by(getattr(Model, "id").desc()).limit(1)
+    return s.execute(stmt, params).scalars().first()
+
+
+def _rebind_latest_qr(s, Qr, store_id, from_table_id, to_table_id):
+    if Qr is None:
+        return None
+    changed = None
+    try:
+        if hasattr(Qr, "issued_at"):
+            sub = (s.query(Qr.table_id, func.max(Qr.issued_at).label("mx"))
+                     .filter(Qr.store_id == store_id, Qr.table_id == from_table_id)
+                     .group_by(Qr.table_id)).subquery()
+            latest = (s.query(Qr)
+                        .join(sub, and_(Qr.table_id == sub.c.table_id,
+                                        Qr.issued_at == sub.c.mx))
+                        .filter(Qr.store_id == store_id).first())
+        else:
+            sub = (s.query(Qr.table_id, func.max(Qr.id).label("mx"))
+                     .filter(Qr.store_id == store_id, Qr.table_id == from_table_id)
+                     .group_by(Qr.table_id)).subquery()
+            latest = (s.query(Qr)
+                        .join(sub, and_(Qr.table_id == sub.c.table_id,
+                                        Qr.id == sub.c.mx))
+                        .filter(Qr.store_id == store_id).first())
+        if latest:
+            changed = {"id": getattr(latest, "id", None), "before": from_table_id, "after": to_table_id}
+            latest.table_id = to_table_id
+    except Exception:
+        current_app.logger.exception("[table_move] QR rebind failed (from=%s to=%s)", from_table_id, to_table_id)
+    return changed
 
-    # ===== 内部ヘルパ =====
-    def _models():
-        TOrder = globals().get("T_注文") or globals().get("OrderHeader")
-        TItem  = globals().get("T_注文明細") or globals().get("T_注文詳細") or globals().get("OrderItem")
-        TPay   = globals().get("T_支払") or globals().get("PaymentRecord")
-        TCD    = globals().get("T_お客様詳細")
-        TQR    = globals().get("QrToken")
-        return TOrder, TItem, TPay, TCD, TQR
-
-    def _active_statuses():
-        return ["新規", "調理中", "提供済", "会計中", "open", "pending", "in_progress", "serving", "unpaid"]
-
-    def _get_active_order(Model, store_id, table_id):
-        q = s.query(Model).filter(getattr(Model, "table_id") == table_id)
-        if hasattr(Model, "store_id"):
-            q = q.filter(getattr(Model, "store_id") == store_id)
-        if hasattr(Model, "status"):
-            q = q.filter(getattr(Model, "status").in_(_active_statuses()))
-        return q.order_by(getattr(Model, "id").desc()).first()
-
-    def _rebind_latest_qr(Qr, store_id, from_table_id, to_table_id):
-        if Qr is None:
-            return None
-        changed = None
-        try:
-            if hasattr(Qr, "issued_at"):
-                sub = (s.query(Qr.table_id, func.max(Qr.issued_at).label("mx"))
-                         .filter(Qr.store_id == store_id, Qr.table_id == from_table_id)
-                         .group_by(Qr.table_id)).subquery()
-                latest = (s.query(Qr)
-                            .join(sub, and_(Qr.table_id == sub.c.table_id,
-                                            Qr.issued_at == sub.c.mx))
-                            .filter(Qr.store_id == store_id).first())
-            else:
-                sub = (s.query(Qr.table_id, func.max(Qr.id).label("mx"))
-                         .filter(Qr.store_id == store_id, Qr.table_id == from_table_id)
-                         .group_by(Qr.table_id)).subquery()
-                latest = (s.query(Qr)
-                            .join(sub, and_(Qr.table_id == sub.c.table_id,
-                                            Qr.id == sub.c.mx))
-                            .filter(Qr.store_id == store_id).first())
-            if latest:
-                changed = {"id": getattr(latest, "id", None), "before": from_table_id, "after": to_table_id}
-                latest.table_id = to_table_id
-        except Exception:
-            current_app.logger.exception("[table_move] QR rebind failed (from=%s to=%s)", from_table_id, to_table_id)
-        return changed
-
-    def _reset_customer_detail_for_table(TCD, table_id):
-        if TCD is None:
-            return {"orphans": 0, "by_table": 0}
-        orphans = s.query(TCD).filter(TCD.table_id == table_id, TCD.order_id == None)\
-                   .delete(synchronize_session=False)  # noqa: E711
-        by_table = s.query(TCD).filter(TCD.table_id == table_id)\
-                   .delete(synchronize_session=False)
-        current_app.logger.info("[table_move][cleanup] table_id=%s -> orphans=%s, by_table=%s",
-                                table_id, orphans, by_table)
-        return {"orphans": orphans, "by_table": by_table}
-
-    # ★ 固定：あなたの人数列名に合わせて“必ず合算”する
-    FIXED_CD_NUMERIC_COLS = ["大人男性", "大人女性", "子ども男", "子ども女"]
-
-    # ★ お客様詳細を order_id 単位で 1 行に合算（固定列版）
-    def _coalesce_customer_detail(TCD, *, order_id: int, table_id: int):
-        """
-        同一 order_id の T_お客様詳細 を合算して 1 行にする。
-        対象列は FIXED_CD_NUMERIC_COLS（= 大人男性/大人女性/子ども男/子ども女）。
-        """
-        if TCD is None or not order_id:
-            return {"rows": 0, "into": None, "sums": {}}
 
-        # 対象列の存在チェック
-        numeric_cols = [c for c in FIXED_CD_NUMERIC_COLS if hasattr(TCD, c)]
-        if not numeric_cols:
-            current_app.logger.warning("[table_move][coalesce] no numeric columns found on T_お客様詳細")
-            return {"rows": 0, "into": None, "sums": {}}
+def _reset_customer_detail_for_table(s, TCD, table_id):
+    # table_id 一致を1回の DELETE で削除（order_id IS NULL の孤児もこれに含まれる）
+    if TCD is None:
+        return {"by_table": 0}
+    by_table = s.query(TCD).filter(TCD.table_id == table_id)\
+               .delete(synchronize_session=False)
+    current_app.logger.info("[table_move][cleanup] table_id=%s -> by_table=%s", table_id, by_table)
+    return {"by_table": by_table}
 
-        rows = (s.query(TCD)
-                  .filter(getattr(TCD, "order_id") == order_id)
-                  .order_by(getattr(TCD, "id").asc())
-                  .all())
-        if not rows:
+
+# ★ 固定：あなたの人数列名に合わせて“必ず合算”する
+FIXED_CD_NUMERIC_COLS = ["大人男性", "大人女性", "子ども男", "子ども女"]
+
+
+# ★ お客様詳細を order_id 単位で 1 行に合算（固定列版）
+def _coalesce_customer_detail(s, TCD, *, order_id: int, table_id: int, rows=None):
+    """
+    同一 order_id の T_お客様詳細 を合算して 1 行にする。
+    対象列は FIXED_CD_NUMERIC_COLS（= 大人男性/大人女性/子ども男/子ども女）。
+    rows に (id, 人数列...) の行リスト（付替 UPDATE の RETURNING 結果）が渡された場合は集計 SELECT を省く。
+    """
+    if TCD is None or not order_id:
+        return {"rows": 0, "into": None, "sums": {}}
+
+    # 対象列の存在チェック
+    numeric_cols = [c for c in FIXED_CD_NUMERIC_COLS if hasattr(TCD, c)]
+    if not numeric_cols:
+        current_app.logger.warning("[table_move][coalesce] no numeric columns found on T_お客様詳細")
+        return {"rows": 0, "into": None, "sums": {}}
+
+    from sqlalchemy import select, update, delete
+
+    cd_id = getattr(TCD, "id")
+    cd_order_id = getattr(TCD, "order_id")
+    if rows is None:
+        # 件数・最終行ID・各列の合計を1回の集計 SELECT で取得
+        agg = s.execute(
+            select(func.count(cd_id), func.max(cd_id),
+                   *[func.coalesce(func.sum(getattr(TCD, k)), 0) for k in numeric_cols])
+            .where(cd_order_id == order_id)
+        ).one()
+        n_rows, base_id = int(agg[0] or 0), agg[1]
+        if not n_rows:
+            return {"rows": 0, "into": None, "sums": {}}
+        sums = {k: int(v or 0) for k, v in zip(numeric_cols, agg[2:])}
+    else:
+        # 受け取った行（数行程度）をそのまま Python 側で合算
+        n_rows = len(rows)
+        if not n_rows:
             return {"rows": 0, "into": None, "sums": {}}
+        base_id = max(r[0] for r in rows)
+        sums = {k: sum(int(r[i] or 0) for r in rows) for i, k in enumerate(numeric_cols, 1)}
 
-        sums = {k: 0 for k in numeric_cols}
-        for r in rows:
-            for k in numeric_cols:
-                try:
-                    sums[k] += int(getattr(r, k) or 0)
-                except Exception:
-                    pass
+    # 最後の1行（id 最大）に合算結果を書き戻す
+    values = dict(sums)
+    if table_id is not None and hasattr(TCD, "table_id"):
+        values["table_id"] = table_id
+    s.execute(update(TCD).where(cd_id == base_id).values(**values)
+              .execution_options(synchronize_session=False))
 
-        base = rows[-1]  # 最後の1行に合算結果を書き戻す
-        setattr(base, "order_id", order_id)
-        if table_id is not None and hasattr(base, "table_id"):
-            setattr(base, "table_id", table_id)
-        for k, v in sums.items():
-            try:
-                setattr(base, k, int(v))
-            except Exception:
-                pass
+    # その他の行は一括削除
+    if n_rows > 1:
+        s.execute(delete(TCD).where(cd_order_id == order_id, cd_id != base_id)
+                  .execution_options(synchronize_session=False))
 
-        # その他の行は削除
-        for r in rows[:-1]:
-            s.delete(r)
+    current_app.logger.info(
+        "[table_move][coalesce] order=%s table=%s rows=%s -> into_id=%s sums=%s",
+        order_id, table_id, n_rows, base_id, sums
+    )
+    return {"rows": n_rows, "into": base_id, "sums": sums}
 
-        s.flush()
-        current_app.logger.info(
-            "[table_move][coalesce] order=%s table=%s rows=%s -> into_id=%s sums=%s",
-            order_id, table_id, len(rows), getattr(base, "id", None), sums
-        )
-        return {"rows": len(rows), "into": getattr(base, "id", None), "sums": sums}
 
-    # 合計を明細から再計算してヘッダへ反映
-    def _recalc_order_totals_from_items(order_id, TOrder, TItem):
-        if not (TOrder and TItem and order_id):
-            return None
-        items = s.query(TItem).filter(getattr(TItem, "order_id") == order_id).all()
+# 合計を明細から再計算してヘッダへ反映（SQL 側で集計し UPDATE ... RETURNING の1往復）
+def _recalc_order_totals_from_items(s, order_id, TOrder, TItem):
+    if not (TOrder and TItem and order_id):
+        return None
+    # 1単位あたりの税は int() と同じゼロ方向切り捨て（trunc）
+    h = s.identity_map.get(s.identity_key(TOrder, order_id))
+    sub, tax, tot = _recalc_order_totals_sql(s, order_id, h, unit_tax_fn=func.trunc)
+    current_app.logger.info("[table_move][recalc] order=%s subtotal=%s tax=%s total=%s",
+                            order_id, sub, tax, tot)
+    return {"小計": int(sub), "税額": int(tax), "合計": tot}
 
-        def _num(x, default=0):
-            try:
-                return int(x)
-            except Exception:
-                try:
-                    return float(x or 0)
-                except Exception:
-                    return default
 
-        sub = 0
-        tax = 0
-        for it in items:
-            unit = (_num(getattr(it, "unit_price", None)) or _num(getattr(it, "単価", None)))
-            qty  = (_num(getattr(it, "qty", None))         or _num(getattr(it, "数量", None), 1))
-            rate = (getattr(it, "tax_rate", None) if hasattr(it, "tax_rate") else getattr(it, "税率", None))
-            rate = float(rate or 0)
-            sub += unit * qty
-            tax += int(unit * rate) * qty
-        tot = int(sub + tax)
+# 統合済み伝票の状態を1回の UPDATE でまとめて変更（セッション上の値も同期、dirty にはしない）
+def _mark_orders_merged(s, TOrder, *orders):
+    if not hasattr(TOrder, "status"):
+        return
+    from sqlalchemy import update
+    from sqlalchemy.orm.attributes import set_committed_value
+    ids = [getattr(o, "id") for o in orders]
+    s.execute(update(TOrder).where(getattr(TOrder, "id").in_(ids))
+              .values(status="会計済(統合)")
+              .execution_options(synchronize_session=False))
+    for o in orders:
+        set_committed_value(o, "status", "会計済(統合)")
+
+
+# NOT NULL なら table_id を None にしない
+def _set_table_id_nullable_safe(model_obj, model_cls, table_id_or_none, fallback_id):
+    if not hasattr(model_cls, "table_id"):
+        return
+    try:
+        col = getattr(model_cls, "table_id").property.columns[0]
+        is_nullable = getattr(col, "nullable", True)
+    except Exception:
+        is_nullable = True
+    setattr(model_obj, "table_id", table_id_or_none if is_nullable else fallback_id)
+
+
+@dataclass
+class _TableMoveContext:
+    """admin_table_move の各モード処理に渡す入力一式"""
+    sid: int
+    from_table_id: int
+    to_table_id: int
+    mode: str
+    src_order: Any
+    dst_order: Any
+    models: _TableMoveModels
+    seat_src: Any
+    seat_dst: Any
+    result: dict
+    new_order_id: Optional[int] = None
+
+
+# ===== merge：to 側に集約（既存の伝票を残したまま） =====
+def _do_merge(s, ctx: _TableMoveContext) -> dict:
+    M = ctx.models
+    TOrder, TItem, TPay, TCD = M.TOrder, M.TItem, M.TPay, M.TCD
+    src_oid = getattr(ctx.src_order, "id")
+    dst_oid = getattr(ctx.dst_order, "id")
+
+    # 明細/支払 to 側へ
+    if TItem is not None:
+        s.query(TItem).filter(getattr(TItem, "order_id") == src_oid)\
+            .update({getattr(TItem, "order_id"): dst_oid}, synchronize_session=False)
+    if TPay is not None:
+        s.query(TPay).filter(getattr(TPay, "order_id") == src_oid)\
+            .update({getattr(TPay, "order_id"): dst_oid}, synchronize_session=False)
+    # お客様詳細：to 側へ付替 + 合算
+    if TCD is not None:
+        s.query(TCD).filter(getattr(TCD, "order_id") == src_oid)\
+            .update({getattr(TCD, "table_id"): ctx.to_table_id,
+                     getattr(TCD, "order_id"): dst_oid}, synchronize_session=False)
+        _reset_customer_detail_for_table(s, TCD, ctx.from_table_id)
+        ctx.result["customer_detail"] = _coalesce_customer_detail(s, TCD, order_id=dst_oid, table_id=ctx.to_table_id)
+
+    # src をクローズ（table_id None 禁止対策）
+    _mark_orders_merged(s, TOrder, ctx.src_order)
+    _set_table_id_nullable_safe(ctx.src_order, TOrder, None, ctx.from_table_id)
+
+    # to 代表維持 + 合計再計算
+    setattr(ctx.dst_order, "table_id", ctx.to_table_id)
+    _recalc_order_totals_from_items(s, dst_oid, TOrder, TItem)
+    return {"merged_to": dst_oid}
+
+
+# ===== merge_new：新しい注文IDを発行して両方を統合 =====
+def _do_merge_new(s, ctx: _TableMoveContext) -> dict:
+    M = ctx.models
+    TOrder, TItem, TPay, TCD = M.TOrder, M.TItem, M.TPay, M.TCD
+    src_oid = getattr(ctx.src_order, "id")
+    dst_oid = getattr(ctx.dst_order, "id")
+
+    # 新規ヘッダを作成
+    new_h = TOrder()
+    if hasattr(TOrder, "store_id"):
+        setattr(new_h, "store_id", ctx.sid)
+    setattr(new_h, "table_id", ctx.to_table_id)
+    if hasattr(TOrder, "status"):
+        setattr(new_h, "status", getattr(ctx.dst_order, "status", None) or "新規")
+    now = datetime.now(timezone.utc)
+    for attr in ("opened_at", "created_at", "作成日時", "開始日時"):
+        if hasattr(TOrder, attr):
+            setattr(new_h, attr, now)
+    s.add(new_h)
+    s.flush()
+    new_oid = getattr(new_h, "id")
+
+    # src/dst の明細・支払・お客様詳細を新IDへ付替 + 合算
+    if TItem is not None:
+        s.query(TItem).filter(getattr(TItem, "order_id").in_([src_oid, dst_oid]))\
+            .update({getattr(TItem, "order_id"): new_oid}, synchronize_session=False)
+    if TPay is not None:
+        s.query(TPay).filter(getattr(TPay, "order_id").in_([src_oid, dst_oid]))\
+            .update({getattr(TPay, "order_id"): new_oid}, synchronize_session=False)
+    if TCD is not None:
+        # 付替 UPDATE の RETURNING で人数列を受け取り、合算時の集計 SELECT を省く
+        from sqlalchemy import update
+        stmt = (update(TCD).where(getattr(TCD, "order_id").in_([src_oid, dst_oid]))
+                .values(order_id=new_oid, table_id=ctx.to_table_id)
+                .execution_options(synchronize_session=False))
+        cd_rows = None
+        if s.get_bind().dialect.update_returning:
+            numeric_cols = [c for c in FIXED_CD_NUMERIC_COLS if hasattr(TCD, c)]
+            cd_rows = s.execute(stmt.returning(getattr(TCD, "id"),
+                                               *[getattr(TCD, c) for c in numeric_cols])).all()
+        else:
+            s.execute(stmt)
+        _reset_customer_detail_for_table(s, TCD, ctx.from_table_id)
+        ctx.result["customer_detail"] = _coalesce_customer_detail(
+            s, TCD, order_id=new_oid, table_id=ctx.to_table_id, rows=cd_rows)
+
+    # 旧2伝票を会計済(統合)へ（1文で両方）
+    _mark_orders_merged(s, TOrder, ctx.src_order, ctx.dst_order)
+    _set_table_id_nullable_safe(ctx.src_order, TOrder, None, ctx.from_table_id)
+    _set_table_id_nullable_safe(ctx.dst_order, TOrder, None, ctx.to_table_id)
+
+    # 新規ヘッダに合計を反映
+    setattr(new_h, "table_id", ctx.to_table_id)
+    _recalc_order_totals_from_items(s, new_oid, TOrder, TItem)
+
+    # 履歴には新規注文IDも記録
+    ctx.new_order_id = new_oid
+    return {"merged_new": True, "new_order_id": new_oid}
+
+
+# ===== swap：2つのアクティブ注文を入替 =====
+def _do_swap(s, ctx: _TableMoveContext) -> dict:
+    TCD = ctx.models.TCD
+    src_oid = getattr(ctx.src_order, "id")
+    dst_oid = getattr(ctx.dst_order, "id")
+
+    setattr(ctx.src_order, "table_id", ctx.to_table_id)
+    setattr(ctx.dst_order, "table_id", ctx.from_table_id)
+
+    if TCD is not None:
+        s.query(TCD).filter(getattr(TCD, "order_id") == src_oid)\
+            .update({getattr(TCD, "table_id"): ctx.to_table_id}, synchronize_session=False)
+        s.query(TCD).filter(getattr(TCD, "order_id") == dst_oid)\
+            .update({getattr(TCD, "table_id"): ctx.from_table_id}, synchronize_session=False)
+        _reset_customer_detail_for_table(s, TCD, ctx.from_table_id)
+        _reset_customer_detail_for_table(s, TCD, ctx.to_table_id)
+    return {"swapped": True}
+
+
+# ===== 通常 move =====
+def _do_move(s, ctx: _TableMoveContext) -> dict:
+    TCD = ctx.models.TCD
+    setattr(ctx.src_order, "table_id", ctx.to_table_id)
+
+    if TCD is not None:
+        s.query(TCD).filter(getattr(TCD, "order_id") == getattr(ctx.src_order, "id"))\
+            .update({getattr(TCD, "table_id"): ctx.to_table_id}, synchronize_session=False)
+        _reset_customer_detail_for_table(s, TCD, ctx.from_table_id)
+    return {"moved_to": ctx.to_table_id}
+
+
+# 移動先に先客がいる場合のモード別処理（先客なしは常に通常 move）
+_MODE_HANDLERS = {
+    "merge": _do_merge,
+    "merge_new": _do_merge_new,
+    "swap": _do_swap,
+    "deny": _do_move,
+}
 
-        h = s.get(TOrder, order_id)
-        if h:
-            for attr in ("subtotal", "小計"):
-                if hasattr(TOrder, attr):
-                    setattr(h, attr, int(sub))
-            for attr in ("tax", "税額"):
-                if hasattr(TOrder, attr):
-                    setattr(h, attr, int(tax))
-            for attr in ("total", "合計"):
-                if hasattr(TOrder, attr):
-                    setattr(h, attr, tot)
-            s.flush()
-            current_app.logger.info("[table_move][recalc] order=%s subtotal=%s tax=%s total=%s",
-                                    order_id, sub, tax, tot)
-        return {"小計": int(sub), "税額": int(tax), "合計": tot}
 
-    # NOT NULL なら table_id を None にしない
-    def _set_table_id_nullable_safe(model_obj, model_cls, table_id_or_none, fallback_id):
-        if not hasattr(model_cls, "table_id"):
-            return
-        try:
-            col = getattr(model_cls, "table_id").property.columns[0]
-            is_nullable = getattr(col, "nullable", True)
-        except Exception:
-            is_nullable = True
-        setattr(model_obj, "table_id", table_id_or_none if is_nullable else fallback_id)
+def _finalize_move(s, ctx: _TableMoveContext, extra: dict) -> dict:
+    """QR付替・席状態・履歴記録・commit をモード共通で行い、応答 dict を返す（フロア通知は呼び出し側）"""
+    swap = ctx.mode == "swap" and ctx.dst_order is not None
+    TQR = ctx.models.TQR
+    _rebind_latest_qr(s, TQR, ctx.sid, ctx.from_table_id, ctx.to_table_id)
+    if swap:
+        _rebind_latest_qr(s, TQR, ctx.sid, ctx.to_table_id, ctx.from_table_id)
 
+    src, dst = ctx.seat_src, ctx.seat_dst
+    try:
+        if swap:
+            if hasattr(src, "status") and hasattr(dst, "status"):
+                src.status, dst.status = dst.status, src.status
+        else:
+            if hasattr(src, "status"): src.status = "空席"
+            if hasattr(dst, "status"): dst.status = "着席"
+    except Exception:
+        pass
+
+    # 履歴記録
+    result = ctx.result
+    result["history_id"] = _record_table_move_history(
+        s, ctx.sid, ctx.from_table_id, ctx.to_table_id, ctx.mode,
+        ctx.src_order, ctx.dst_order, new_order_id=ctx.new_order_id,
+    ) if _HISTORY_ENABLED else None
+
+    s.commit()
+    result.update(extra)
+    return result
+
+
+# --- [スタッフ] テーブル移動：deny / merge / merge_new / swap -------------------
+@app.route("/admin/table/move", methods=["POST"])
+@require_staff
+def admin_table_move():
+    s = SessionLocal()
     try:
         sid = current_store_id()
         if sid is None:
@@ -14373,7 +15360,7 @@ def admin_table_move():
 
         if not from_table_id or not to_table_id or from_table_id == to_table_id:
             return jsonify({"ok": False, "error": "invalid table ids"}), 400
-        if mode not in ("deny", "merge", "merge_new", "swap"):
+        if mode not in _MODE_HANDLERS:
             return jsonify({"ok": False, "error": "invalid mode"}), 400
 
         src = s.get(TableSeat, from_table_id)
@@ -14383,191 +15370,32 @@ def admin_table_move():
         if getattr(src, "store_id", None) != sid or getattr(dst, "store_id", None) != sid:
             return jsonify({"ok": False, "error": "cross-store move not allowed"}), 403
 
-        TOrder, TItem, TPay, TCD, TQR = _models()
+        M = _table_move_models()
 
-        src_order = _get_active_order(TOrder, sid, from_table_id)
+        src_order = _get_active_order(s, M.TOrder, sid, from_table_id)
         if not src_order:
             return jsonify({"ok": False, "error": "no active order on source table"}), 404
-        dst_order = _get_active_order(TOrder, sid, to_table_id)
+        dst_order = _get_active_order(s, M.TOrder, sid, to_table_id)
 
         # deny: 先客がいれば拒否
         if mode == "deny" and dst_order:
             return jsonify({"ok": False, "error": "destination already has active order",
                             "dest_order_id": getattr(dst_order, "id", None)}), 409
 
-        result = {
-            "ok": True,
-            "mode": mode,
-            "from": from_table_id,
-            "to": to_table_id,
-            "src_order_id": getattr(src_order, "id", None),
-            "dst_order_id": getattr(dst_order, "id", None),
-        }
-
-        # ===== merge：to 側に集約（既存の伝票を残したまま） =====
-        if mode == "merge" and dst_order:
-            src_oid = getattr(src_order, "id")
-            dst_oid = getattr(dst_order, "id")
-
-            # 明細/支払 to 側へ
-            if TItem is not None:
-                s.query(TItem).filter(getattr(TItem, "order_id") == src_oid)\
-                    .update({getattr(TItem, "order_id"): dst_oid}, synchronize_session=False)
-            if TPay is not None:
-                s.query(TPay).filter(getattr(TPay, "order_id") == src_oid)\
-                    .update({getattr(TPay, "order_id"): dst_oid}, synchronize_session=False)
-            # お客様詳細：to 側へ付替 + 合算
-            if TCD is not None:
-                s.query(TCD).filter(getattr(TCD, "order_id") == src_oid)\
-                    .update({getattr(TCD, "table_id"): to_table_id,
-                             getattr(TCD, "order_id"): dst_oid}, synchronize_session=False)
-                _reset_customer_detail_for_table(TCD, from_table_id)
-                result["customer_detail"] = _coalesce_customer_detail(TCD, order_id=dst_oid, table_id=to_table_id)
-
-            # src をクローズ（table_id None 禁止対策）
-            if hasattr(TOrder, "status"):
-                setattr(src_order, "status", "会計済(統合)")
-            _set_table_id_nullable_safe(src_order, TOrder, None, from_table_id)
-
-            # to 代表維持 + 合計再計算
-            setattr(dst_order, "table_id", to_table_id)
-            _recalc_order_totals_from_items(dst_oid, TOrder, TItem)
-
-            _rebind_latest_qr(TQR, sid, from_table_id, to_table_id)
-            try:
-                if hasattr(src, "status"): src.status = "空席"
-                if hasattr(dst, "status"): dst.status = "着席"
-            except Exception:
-                pass
-
-            # 履歴記録
-            history_id = _record_table_move_history(s, sid, from_table_id, to_table_id, mode, src_order, dst_order)
-            result["history_id"] = history_id
-
-            s.commit()
-            mark_floor_changed()
-            result["merged_to"] = dst_oid
-            return jsonify(result)
-
-        # ===== merge_new：新しい注文IDを発行して両方を統合 =====
-        if mode == "merge_new" and dst_order:
-            src_oid = getattr(src_order, "id")
-            dst_oid = getattr(dst_order, "id")
-
-            # 新規ヘッダを作成
-            new_h = TOrder()
-            if hasattr(TOrder, "store_id"):
-                setattr(new_h, "store_id", sid)
-            setattr(new_h, "table_id", to_table_id)
-            if hasattr(TOrder, "status"):
-                setattr(new_h, "status", getattr(dst_order, "status", None) or "新規")
-            now = datetime.now(timezone.utc)
-            for attr in ("opened_at", "created_at", "作成日時", "開始日時"):
-                if hasattr(TOrder, attr):
-                    setattr(new_h, attr, now)
-            s.add(new_h)
-            s.flush()
-            new_oid = getattr(new_h, "id")
-
-            # src/dst の明細・支払・お客様詳細を新IDへ付替 + 合算
-            if TItem is not None:
-                s.query(TItem).filter(getattr(TItem, "order_id").in_([src_oid, dst_oid]))\
-                    .update({getattr(TItem, "order_id"): new_oid}, synchronize_session=False)
-            if TPay is not None:
-                s.query(TPay).filter(getattr(TPay, "order_id").in_([src_oid, dst_oid]))\
-                    .update({getattr(TPay, "order_id"): new_oid}, synchronize_session=False)
-            if TCD is not None:
-                s.query(TCD).filter(getattr(TCD, "order_id").in_([src_oid, dst_oid]))\
-                    .update({getattr(TCD, "order_id"): new_oid,
-                             getattr(TCD, "table_id"): to_table_id}, synchronize_session=False)
-                _reset_customer_detail_for_table(TCD, from_table_id)
-                result["customer_detail"] = _coalesce_customer_detail(TCD, order_id=new_oid, table_id=to_table_id)
-
-            # 旧2伝票を会計済(統合)へ
-            if hasattr(TOrder, "status"):
-                setattr(src_order, "status", "会計済(統合)")
-                setattr(dst_order, "status", "会計済(統合)")
-            _set_table_id_nullable_safe(src_order, TOrder, None, from_table_id)
-            _set_table_id_nullable_safe(dst_order, TOrder, None, to_table_id)
-
-            # 新規ヘッダに合計を反映
-            setattr(new_h, "table_id", to_table_id)
-            _recalc_order_totals_from_items(new_oid, TOrder, TItem)
-
-            _rebind_latest_qr(TQR, sid, from_table_id, to_table_id)
-            try:
-                if hasattr(src, "status"): src.status = "空席"
-                if hasattr(dst, "status"): dst.status = "着席"
-            except Exception:
-                pass
-
-            # 履歴記録（merge_newの場合は新規注文IDも記録）
-            history_id = _record_table_move_history(s, sid, from_table_id, to_table_id, mode, src_order, dst_order, new_order_id=new_oid)
-            result["history_id"] = history_id
-
-            s.commit()
-            mark_floor_changed()
-            result.update({"merged_new": True, "new_order_id": new_oid})
-            return jsonify(result)
-
-        # ===== swap：2つのアクティブ注文を入替 =====
-        if mode == "swap" and dst_order:
-            src_oid = getattr(src_order, "id")
-            dst_oid = getattr(dst_order, "id")
-
-            setattr(src_order, "table_id", to_table_id)
-            setattr(dst_order, "table_id", from_table_id)
-
-            if TCD is not None:
-                s.query(TCD).filter(getattr(TCD, "order_id") == src_oid)\
-                    .update({getattr(TCD, "table_id"): to_table_id}, synchronize_session=False)
-                s.query(TCD).filter(getattr(TCD, "order_id") == dst_oid)\
-                    .update({getattr(TCD, "table_id"): from_table_id}, synchronize_session=False)
-                _reset_customer_detail_for_table(TCD, from_table_id)
-                _reset_customer_detail_for_table(TCD, to_table_id)
-
-            _rebind_latest_qr(TQR, sid, from_table_id, to_table_id)
-            _rebind_latest_qr(TQR, sid, to_table_id, from_table_id)
-
-            try:
-                if hasattr(src, "status") and hasattr(dst, "status"):
-                    src.status, dst.status = dst.status, src.status
-            except Exception:
-                pass
-
-            # 履歴記録
-            history_id = _record_table_move_history(s, sid, from_table_id, to_table_id, mode, src_order, dst_order)
-            result["history_id"] = history_id
-
-            s.commit()
-            mark_floor_changed()
-            result["swapped"] = True
-            return jsonify(result)
-
-        # ===== 通常 move =====
-        setattr(src_order, "table_id", to_table_id)
-
-        if TCD is not None:
-            s.query(TCD).filter(getattr(TCD, "order_id") == getattr(src_order, "id"))\
-                .update({getattr(TCD, "table_id"): to_table_id}, synchronize_session=False)
-            _reset_customer_detail_for_table(TCD, from_table_id)
-
-        _rebind_latest_qr(TQR, sid, from_table_id, to_table_id)
-
-        try:
-            if hasattr(src, "status"): src.status = "空席"
-            if hasattr(dst, "status"): dst.status = "着席"
-        except Exception:
-            pass
-
-        # 履歴記録
-        history_id = _record_table_move_history(s, sid, from_table_id, to_table_id, mode, src_order, dst_order)
-        result["history_id"] = history_id
-
-        s.commit()
-        mark_floor_changed()
-        result["moved_to"] = to_table_id
-        return jsonify(result)
+        ctx = _TableMoveContext(
+            sid=sid, from_table_id=from_table_id, to_table_id=to_table_id, mode=mode,
+            src_order=src_order, dst_order=dst_order, models=M, seat_src=src, seat_dst=dst,
+            result={
+                "ok": True,
+                "mode": mode,
+                "from": from_table_id,
+                "to": to_table_id,
+                "src_order_id": getattr(src_order, "id", None),
+                "dst_order_id": getattr(dst_order, "id", None),
+            },
+        )
+        handler = _MODE_HANDLERS[mode] if dst_order else _do_move
+        result = _finalize_move(s, ctx, handler(s, ctx))
 
     except Exception as e:
         s.rollback()
@@ -14577,21 +15405,42 @@ def admin_table_move():
         s.close()
         SessionLocal.remove()
 
+    # commit 済みのセッションを返却してから通知・応答する（接続を待機中の通知処理に拘束しない）
+    mark_floor_changed()
+    return jsonify(result)
+
 
 
 # ========================================
 # 3. テーブル移動履歴ページのルート
 # ========================================
 
+# 履歴画面で使う列はモデル定義から一度だけ解決しておく（リクエスト毎の hasattr/getattr/inspect を避ける）
+#   一覧に出す列だけを選ぶ（明細/お客様のスナップショット JSON などは読まない）
+_HIST_LIST_KEYS = (
+    "id", "mode", "order_id", "order_status", "item_count",
+    "adult_male", "adult_female", "child_male", "child_female", "total_people",
+    "total", "paid", "remaining",
+    "staff_name", "is_cancelled", "cancelled_by_staff_name",
+)
+if _HISTORY_ENABLED:
+    _HIST_SELECT_COLS = tuple(
+        getattr(T_テーブル移動履歴, k).label(k)
+        for k in _HIST_LIST_KEYS
+        if hasattr(T_テーブル移動履歴, k)
+    )
+    _HIST_STORE_COL = getattr(T_テーブル移動履歴, "store_id", None)
+    _HIST_MOVED_AT_COL = getattr(T_テーブル移動履歴, "moved_at", None)
+else:
+    _HIST_SELECT_COLS = ()
+    _HIST_STORE_COL = _HIST_MOVED_AT_COL = None
+
 @app.route("/admin/table_move_history")
 @require_store_admin
 def admin_table_move_history():
     """
     テーブル移動履歴を表示するページ
     """
-    from datetime import datetime, timezone, timedelta
-    from sqlalchemy import or_, func
-    
     sid = current_store_id()
     if sid is None:
         return redirect(url_for("admin_login"))
@@ -14601,20 +15450,19 @@ def admin_table_move_history():
     to_date_str = request.args.get("to_date")
     table_id = request.args.get("table_id", type=int)
     
+    utc = timezone.utc
+
     def _parse_date(s):
+        # YYYY-MM-DD は C 実装の ISO パーサで読む（strptime の書式解析を通さない）
         try:
-            return datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            return datetime.combine(date.fromisoformat(s), datetime.min.time(), tzinfo=utc)
         except Exception:
             return None
     
     from_date = _parse_date(from_date_str) if from_date_str else None
     to_date = _parse_date(to_date_str) + timedelta(days=1) if to_date_str else None
     
-    # モデル取得
-    THistory = globals().get("T_テーブル移動履歴")
-    TableSeat = globals().get("TableSeat") or globals().get("T_テーブル席")
-    
-    if THistory is None:
+    if not _HISTORY_ENABLED:
         return render_template(
             "admin_table_move_history.html",
             title="テーブル移動履歴",
@@ -14625,62 +15473,49 @@ def admin_table_move_history():
             sid=sid,
         )
     
+    # バッファ中の履歴を先に書き込む（自ワーカー分）
+    table_move_audit_buffer.flush()
+
     s = SessionLocal()
     try:
-        # テーブル一覧を取得
-        tables = []
-        if TableSeat:
-            qt = s.query(TableSeat)
-            if hasattr(TableSeat, "store_id"):
-                qt = qt.filter(getattr(TableSeat, "store_id") == sid)
-            tables = qt.order_by(getattr(TableSeat, "table_no", TableSeat.id).asc()).all()
-        
-        # 履歴を取得
-        q = s.query(THistory)
-        if hasattr(THistory, "store_id"):
-            q = q.filter(getattr(THistory, "store_id") == sid)
+        # テーブル一覧を取得（絞り込み用。店舗ごとのキャッシュから）
+        tables = _table_no_list(s, sid)
+        
+        # 履歴を取得（一覧に出す列とテーブル番号だけを SQL 側で組み立てて1回で取得）
+        #   移動元/移動先のテーブルは別名で2回 LEFT JOIN、合計人数はモデルの total_people 列
+        THistory = T_テーブル移動履歴
+        from_tid = THistory.from_table_id
+        to_tid = THistory.to_table_id
+        FromT = aliased(TableSeat)
+        ToT = aliased(TableSeat)
+        from_no = func.coalesce(func.nullif(FromT.table_no, ""), cast(from_tid, String))
+        to_no = func.coalesce(func.nullif(ToT.table_no, ""), cast(to_tid, String))
+        q = (
+            s.query(
+                *_HIST_SELECT_COLS,
+                from_no.label("from_table_no"),
+                case((to_tid.is_(None), "-"), else_=to_no).label("to_table_no"),
+            )
+            .select_from(THistory)
+            .outerjoin(FromT, from_tid == FromT.id)
+            .outerjoin(ToT, to_tid == ToT.id)
+        )
+        if _HIST_STORE_COL is not None:
+            q = q.filter(_HIST_STORE_COL == sid)
         
         # 期間フィルター
-        if from_date and hasattr(THistory, "moved_at"):
-            q = q.filter(getattr(THistory, "moved_at") >= from_date)
-        if to_date and hasattr(THistory, "moved_at"):
-            q = q.filter(getattr(THistory, "moved_at") < to_date)
+        if _HIST_MOVED_AT_COL is not None:
+            if from_date:
+                q = q.filter(_HIST_MOVED_AT_COL >= from_date)
+            if to_date:
+                q = q.filter(_HIST_MOVED_AT_COL < to_date)
         
         # テーブルフィルター
         if table_id:
-            q = q.filter(
-                or_(
-                    getattr(THistory, "from_table_id") == table_id,
-                    getattr(THistory, "to_table_id") == table_id
-                )
-            )
+            q = q.filter(or_(from_tid == table_id, to_tid == table_id))
         
         # 並び順（新しい順）
-        histories = q.order_by(getattr(THistory, "moved_at").desc()).limit(500).all()
-        
-        # テーブル番号マップを作成
-        table_no_map = {}
-        if TableSeat:
-            for t in tables:
-                tid = getattr(t, "id", None)
-                tno = getattr(t, "table_no", None) or getattr(t, "テーブル番号", None) or str(tid)
-                table_no_map[tid] = tno
-        
-        # 履歴に テーブル番号を追加
-        for h in histories:
-            from_tid = getattr(h, "from_table_id", None)
-            to_tid = getattr(h, "to_table_id", None)
-            
-            setattr(h, "from_table_no", table_no_map.get(from_tid, str(from_tid)))
-            setattr(h, "to_table_no", table_no_map.get(to_tid, str(to_tid)) if to_tid else "-")
-            
-            # 合計人数を計算
-            total_people = 0
-            for attr in ("adult_male", "adult_female", "child_male", "child_female"):
-                val = getattr(h, attr, None)
-                if val:
-                    total_people += int(val)
-            setattr(h, "total_people", total_people)
+        histories = q.order_by(_HIST_MOVED_AT_COL.desc()).limit(500).all()
         
         # 統計情報
         total_moves = len(histories)
@@ -14690,7 +15525,6 @@ def admin_table_move_history():
             title="テーブル移動履歴",
             histories=histories,
             tables=tables,
-            table_no_map=table_no_map,
             current_table_id=table_id,
             from_date=from_date_str or "",
             to_date=to_date_str or "",
@@ -14710,10 +15544,9 @@ def admin_table_move_history():
 # スタッフ用 UI / ルーティング
 # ---------------------------------------------------------------------
 # --- [スタッフ] ルート：/staff → /staff/floor に転送 -----------------------------------------
-@app.route("/staff")
-@require_staff
-def staff_root():
-    return redirect(url_for("staff_floor"))
+#   URL マッチの段階で Werkzeug が転送する（ビュー関数・require_staff を通さない）
+#   未ログインなら転送先の /staff/floor 側で staff_login へ回される
+app.add_url_rule("/staff", endpoint="staff_root", redirect_to="/staff/floor")
 
 
 # --- [スタッフ] 注文ページ：時価商品の価格入力対応 -----------------------------------
@@ -14734,17 +15567,16 @@ def staff_order(table_id):
         if not t or (hasattr(t, "store_id") and t.store_id != sid):
             return "Table not found", 404
         
-        # 進行中の注文を取得
-        order_id = None
-        q = s.query(OrderHeader).filter(OrderHeader.table_id == table_id)
-        if hasattr(OrderHeader, "store_id"):
-            q = q.filter(OrderHeader.store_id == sid)
-        orders = q.order_by(OrderHeader.id.desc()).all()
-        for o in orders:
-            status = getattr(o, "status", "")
-            if status not in ["会計済", "closed", "paid"]:
-                order_id = o.id
-                break
+        # 進行中の注文を取得（未会計の最新1件の id だけを SQL で取る）
+        order_id = (
+            s.query(OrderHeader.id)
+             .filter(OrderHeader.table_id == table_id,
+                     OrderHeader.store_id == sid,
+                     OrderHeader.status.notin_(["会計済", "closed", "paid"]))
+             .order_by(OrderHeader.id.desc())
+             .limit(1)
+             .scalar()
+        )
         
         # スタッフ名を取得
         staff_name = session.get("username", "Unknown")
@@ -14766,20 +15598,27 @@ def staff_order(table_id):
 # ---------------------------------------------------------------------
 # スタッフ用フロア画面（店舗縛り＋詳細デバッグ付き）
 # ---------------------------------------------------------------------
+# フロア画面の伝票ごとの集計（フォールバック）で、明細の税込合計を SQL 集計で求める（0 で従来の Python ループ）
+STAFF_FLOOR_SQL_TOTALS = os.getenv("STAFF_FLOOR_SQL_TOTALS", "1") == "1"
+
+# 未会計として扱うステータス（フロア画面の order["状態"] の表示/ボタン判定に使用）
+ACTIVE_ORDER_STATUSES: frozenset = frozenset({
+    "open", "pending", "in_progress", "serving", "unpaid",
+    "新規", "調理中", "提供済", "会計中"
+})
+
+
 # --- [スタッフ] フロア画面：T_注文/T_注文明細 ベースで現在合計を表示 ------------------------------
 @app.route("/staff/floor")
 @require_staff
 def staff_floor():
-    from sqlalchemy import func
     sid = current_store_id()
     if sid is None:
         return redirect(url_for("staff_login"))
 
-    # 未会計として扱うステータス（order["状態"] の表示/ボタン判定に使用）
-    ACTIVE_ORDER_STATUSES = {
-        "open", "pending", "in_progress", "serving", "unpaid",
-        "新規", "調理中", "提供済", "会計中"
-    }
+    # 集計デバッグログの要否はリクエストごとに1回だけ判定（伝票ごとに config/ロガーを引かない）
+    debug_totals = (bool(current_app.config.get("DEBUG_TOTALS", False))
+                    and current_app.logger.isEnabledFor(logging.DEBUG))
 
     # --- ローカルフォールバック: 取消（負数量）を含めたサマリをDBから算出 ---
     def __financials_including_negatives(s, order_id: int):
@@ -14789,17 +15628,29 @@ def staff_floor():
         既払=支払記録合計（返金はマイナス）
         残額=合計-既払
         """
-        import math
-        Item   = globals().get("OrderItem")
-        Pay    = globals().get("PaymentRecord") or globals().get("T_支払")
-        Header = globals().get("OrderHeader")
+        Item, Pay = OrderItem, PaymentRecord
 
         total_incl = 0
-        if Item is not None:
+        if STAFF_FLOOR_SQL_TOTALS:
+            # 明細を実体化せず、同じ判定の税込ネット合計を1つのスカラ集計で求める
+            #   floor() の無い DB でも動くよう、floor は _sql_floor_int（CAST と比較）で表す
+            st_low = func.lower(func.coalesce(Item.status, ""))
+            is_cancel_label = or_(*[st_low.like(f"%{w}%") for w in ("取消", "ｷｬﾝｾﾙ", "キャンセル", "cancel", "void")])
+            unit_excl = func.coalesce(Item.unit_price, 0)
+            unit_tax = _sql_floor_int(unit_excl * func.coalesce(func.nullif(Item.tax_rate, 0), 0.10))
+            qty = Item.qty
+            total_incl = int(
+                s.query(func.coalesce(func.sum(
+                    case((and_(qty > 0, is_cancel_label), 0), else_=(unit_excl + unit_tax) * qty)
+                ), 0))
+                 .filter(Item.order_id == order_id)
+                 .scalar() or 0
+            )
+        else:
             items = (
                 s.query(Item)
-                 .filter(getattr(Item, "order_id") == order_id)
-                 .order_by(getattr(Item, "id").asc())
+                 .filter(Item.order_id == order_id)
+                 .order_by(Item.id.asc())
                  .all()
             )
             for d in items or []:
@@ -14827,28 +15678,19 @@ def staff_floor():
                 total_incl += unit_incl * qty
 
         # 既払（返金はマイナス）
-        paid = 0
-        if Pay is not None:
-            col_amount = getattr(Pay, "amount", None) or getattr(Pay, "金額", None)
-            if col_amount is not None:
-                agg = (
-                    s.query(func.coalesce(func.sum(col_amount), 0))
-                     .filter(getattr(Pay, "order_id") == order_id)
-                )
-                if hasattr(Pay, "store_id") and sid is not None:
-                    agg = agg.filter(getattr(Pay, "store_id") == sid)
-                paid = int(agg.scalar() or 0)
+        agg = (
+            s.query(func.coalesce(func.sum(Pay.amount), 0))
+             .filter(Pay.order_id == order_id)
+        )
+        if sid is not None:
+            agg = agg.filter(Pay.store_id == sid)
+        paid = int(agg.scalar() or 0)
 
         remaining = int(total_incl) - int(paid)
 
-        # （任意）ヘッダへも反映して整合を保つ（副作用を避けたい場合はコメントアウト可）
-        if Header is not None:
-            h = s.get(Header, order_id)
-            if h:
-                if hasattr(h, "total"): h.total = int(total_incl)
-                if hasattr(h, "合計"):  setattr(h, "合計", int(total_incl))
+        # 読み取り専用の集計なのでヘッダ（合計）は書き換えない（反映は注文/会計の更新側で行う）
 
-        if bool(current_app.config.get("DEBUG_TOTALS", False)):
+        if debug_totals:
             current_app.logger.debug(
                 "[staff.fin] order_id=%s total=%s paid=%s remaining=%s",
                 order_id, int(total_incl), int(paid), int(remaining)
@@ -14856,25 +15698,86 @@ def staff_floor():
 
         return {"total": int(total_incl), "paid": int(paid), "remaining": int(remaining)}
 
+    # --- 店舗の最新アクティブ伝票（テーブルごとに1件）を1回の SELECT で取得 ---
+    def __latest_active_orders(s):
+        """{table_id: (order_id, 状態)}（_calc_order_summary_from_T と同じ判定をテーブル横断で）"""
+        latest = (
+            s.query(func.max(OrderHeader.id).label("oid"))
+             .filter(OrderHeader.store_id == sid,
+                     OrderHeader.status.in_(["新規", "調理中", "提供済", "会計中"]))
+             .group_by(OrderHeader.table_id)
+        ).subquery()
+        rows = (
+            s.query(OrderHeader.table_id, OrderHeader.id, OrderHeader.status)
+             .join(latest, OrderHeader.id == latest.c.oid)
+             .all()
+        )
+        return {tid: (oid, st) for tid, oid, st in rows}
+
+    # --- __financials_including_negatives の複数伝票版（明細・支払をそれぞれ GROUP BY で1回ずつ） ---
+    def __financials_batch(s, order_ids):
+        if not order_ids:
+            return {}
+        Item = OrderItem
+        # 取消ラベル判定（日本語/英語いずれも）
+        st_low = func.lower(func.coalesce(Item.status, ""))
+        is_cancel_label = or_(*[st_low.like(f"%{w}%") for w in ("取消", "ｷｬﾝｾﾙ", "キャンセル", "cancel", "void")])
+        unit_excl = func.coalesce(Item.unit_price, 0)
+        rate = func.coalesce(func.nullif(Item.tax_rate, 0), 0.10)
+        unit_incl = unit_excl + _sql_floor_int(unit_excl * rate)  # floor() の無い DB でも一括集計できるように
+        # 正数量かつ取消ラベルは除外、負数量（監査用）はネットに含める
+        line_incl = case((and_(Item.qty > 0, is_cancel_label), 0), else_=unit_incl * Item.qty)
+        totals = dict(
+            s.query(Item.order_id, func.coalesce(func.sum(line_incl), 0))
+             .filter(Item.order_id.in_(order_ids))
+             .group_by(Item.order_id)
+             .all()
+        )
+        paids = dict(
+            s.query(PaymentRecord.order_id, func.coalesce(func.sum(PaymentRecord.amount), 0))
+             .filter(PaymentRecord.order_id.in_(order_ids), PaymentRecord.store_id == sid)
+             .group_by(PaymentRecord.order_id)
+             .all()
+        )
+        out = {}
+        for oid in order_ids:
+            total_incl = int(totals.get(oid) or 0)
+            paid = int(paids.get(oid) or 0)
+            out[oid] = {"total": total_incl, "paid": paid, "remaining": total_incl - paid}
+        return out
+
+    # 以下の内部ヘルパーはすべてこのセッション s を受け取って使う（別セッションは開かない）
+    #   SessionLocal は autoflush=False、この画面は読み取りのみで commit もしない
     s = SessionLocal()
     try:
         # テーブル一覧（店舗スコープ）
-        qt = s.query(TableSeat)
-        if hasattr(TableSeat, "store_id"):
-            qt = qt.filter(TableSeat.store_id == sid)
-        tables = qt.order_by(getattr(TableSeat, "table_no", TableSeat.id).asc()).all()
+        #   状態は毎回 id と状態の2列だけ取得し、番号と並び順は店舗ごとのキャッシュを使う
+        status_by_id = dict(
+            s.query(TableSeat.id, TableSeat.status).filter(TableSeat.store_id == sid).all()
+        )
+        tables = _table_no_list(s, sid, expect_ids=status_by_id.keys())
+
+        # 伝票の存在と金額はテーブル横断でまとめて取得（テーブルごとの N+1 を避ける）
+        active_by_table = __latest_active_orders(s)
+        try:
+            fin_by_order = __financials_batch(s, [oid for oid, _ in active_by_table.values()])
+        except Exception:
+            # 一括集計に失敗した場合：伝票ごとの集計にフォールバック
+            current_app.logger.warning("[staff.fin] batch aggregate failed; falling back per order", exc_info=True)
+            s.rollback()
+            fin_by_order = {}
 
         out = []
         for seat in tables:
             tdict = {
-                "id": getattr(seat, "id"),
-                "テーブル番号": getattr(seat, "table_no", None) or getattr(seat, "テーブル番号", None) or getattr(seat, "id"),
-                "状態": getattr(seat, "status", "") or getattr(seat, "状態", "") or "空席",
+                "id": seat.id,
+                "テーブル番号": seat.table_no or seat.id,
+                "状態": status_by_id.get(seat.id) or "空席",
                 "order": None,
             }
 
-            # 既存ヘルパから“伝票の存在”だけ把握
-            summary = _calc_order_summary_from_T(s, store_id=sid, table_id=getattr(seat, "id"))
+            active = active_by_table.get(seat.id)
+            summary = {"id": active[0], "状態": active[1]} if active else None
 
             if summary:
                 st_label = summary.get("状態")
@@ -14883,12 +15786,13 @@ def staff_floor():
                 if is_active:
                     # 取消（正数量の取消ラベルは除外、負数量は反映）で再集計
                     fin = None
-                    try:
-                        inc = globals().get("_order_financials_including_negatives")
-                        if callable(inc):
-                            fin = inc(s, int(summary["id"]))
-                    except Exception:
-                        fin = None
+                    if _FIN_FN is not None:
+                        try:
+                            fin = _FIN_FN(s, int(summary["id"]))
+                        except Exception:
+                            fin = None
+                    if not fin:
+                        fin = fin_by_order.get(int(summary["id"]))
                     if not fin:
                         fin = __financials_including_negatives(s, int(summary["id"]))
 
@@ -14997,8 +15901,6 @@ def staff_api_order():
       { "table_id": 1, "items": [{"menu_id": 3, "qty": 2, "memo": "辛め"}], "custom_date": "2024-01-01 12:00:00" }
     - custom_date: 過去日付注文モード用（オプション）
     """
-    import math  # floor を使うため（ローカルインポート）
-
     data = request.get_json(force=True) or {}
     table_id_raw = data.get("table_id")
     items = data.get("items") or []
@@ -15031,21 +15933,14 @@ def staff_api_order():
         except Exception:
             pass
 
-        # ★ お客様詳細モデルを柔軟に解決（T_お客様詳細 / M_顧客詳細 / CustomerDetail）
-        TCustomerDetail = (
-            globals().get("T_お客様詳細")
-            or globals().get("M_顧客詳細")
-            or globals().get("CustomerDetail")
-        )
+        # ★ お客様詳細モデル（T_お客様詳細 / M_顧客詳細 / CustomerDetail は読み込み時に解決済み）
+        TCustomerDetail = _CD_MODEL
         if TCustomerDetail is None:
             app.logger.warning("[staff_api_order] TCustomerDetail model not found (T_お客様詳細 / M_顧客詳細 / CustomerDetail)")
         else:
             app.logger.debug(
                 "[staff_api_order] TCustomerDetail resolved: %s (has order_id? %s, has table_id? %s, has store_id? %s)",
-                getattr(TCustomerDetail, "__tablename__", str(TCustomerDetail)),
-                hasattr(TCustomerDetail, "order_id"),
-                hasattr(TCustomerDetail, "table_id"),
-                hasattr(TCustomerDetail, "store_id"),
+                TCustomerDetail.__tablename__, _CD_HAS_ORDER_ID, _CD_HAS_TABLE_ID, _CD_HAS_STORE_ID,
             )
 
         # ★ 店舗IDの取得（なければ None）
@@ -15056,15 +15951,35 @@ def staff_api_order():
         app.logger.debug("[staff_api_order] resolved store_id=%s", store_id)
 
         # 既存オーダー検索（日本語ステータス）
-        order = (
+        order_q = (
             s.query(OrderHeader)
              .filter(
                  OrderHeader.table_id == table_id,
                  OrderHeader.status.in_(["新規", "調理中", "提供済", "会計中"])
              )
-             .order_by(OrderHeader.id.desc())
-             .first()
         )
+        # 紐付け候補のお客様詳細も LEFT JOIN で同じ SELECT で取る
+        #   優先順：この注文の行（id 降順）→ このテーブルの孤児行（order_id IS NULL, id 昇順）
+        cd_hit = None
+        cd_joined = _CD_HAS_ORDER_ID and _CD_HAS_TABLE_ID
+        if cd_joined:
+            cd_id = TCustomerDetail.id
+            cd_order_id = TCustomerDetail.order_id
+            is_own = cd_order_id == OrderHeader.id
+            row = (
+                order_q.add_entity(TCustomerDetail)
+                 .outerjoin(TCustomerDetail, or_(
+                     is_own,
+                     and_(cd_order_id.is_(None), TCustomerDetail.table_id == table_id),
+                 ))
+                 .order_by(OrderHeader.id.desc(),
+                           case((is_own, 0), else_=1),
+                           case((is_own, -cd_id), else_=cd_id))
+                 .first()
+            )
+            order, cd_hit = row if row else (None, None)
+        else:
+            order = order_q.order_by(OrderHeader.id.desc()).first()
         app.logger.debug("[staff_api_order] active order found? %s", bool(order))
 
         new_order_created = False
@@ -15095,28 +16010,32 @@ def staff_api_order():
         bound_cd_id = None
         if TCustomerDetail is not None:
             try:
-                # 1) order_id で既存を探す
-                cd = None
-                if hasattr(TCustomerDetail, "order_id"):
+                # 0) 注文検索時の JOIN で見つかっていればそれを使う
+                cd = cd_hit
+
+                # 1) order_id で既存を探す（JOIN できない構成のみ）
+                if cd is not None or cd_joined:
+                    pass
+                elif _CD_HAS_ORDER_ID:
                     cd = (
                         s.query(TCustomerDetail)
-                         .filter(getattr(TCustomerDetail, "order_id") == order.id)
-                         .order_by(getattr(TCustomerDetail, "id").desc())
+                         .filter(TCustomerDetail.order_id == order.id)
+                         .order_by(TCustomerDetail.id.desc())
                          .first()
                     )
                     app.logger.debug("[staff_api_order] search by order_id=%s -> %s", order.id, "hit" if cd else "none")
                 else:
                     app.logger.warning("[staff_api_order] TCustomerDetail has no order_id column!")
 
-                # 2) なければ table_id 孤児を拾う
-                if cd is None:
+                # 2) なければ table_id 孤児を拾う（既存注文なら JOIN で確認済み）
+                if cd is None and (new_order_created or not cd_joined):
                     q = s.query(TCustomerDetail).filter(
-                        getattr(TCustomerDetail, "table_id") == table_id
+                        TCustomerDetail.table_id == table_id
                     )
-                    if hasattr(TCustomerDetail, "order_id"):
-                        q = q.filter(getattr(TCustomerDetail, "order_id") == None)  # noqa: E711
+                    if _CD_HAS_ORDER_ID:
+                        q = q.filter(TCustomerDetail.order_id == None)  # noqa: E711
                         app.logger.debug("[staff_api_order] searching orphan rows for table_id=%s", table_id)
-                    cd = q.order_by(getattr(TCustomerDetail, "id").asc()).first()
+                    cd = q.order_by(TCustomerDetail.id.asc()).first()
                     app.logger.debug("[staff_api_order] search orphan by table_id=%s -> %s", table_id, "hit" if cd else "none")
 
                 # 3) まだ無ければ新規作成
@@ -15124,30 +16043,28 @@ def staff_api_order():
                 if cd is None:
                     cd = TCustomerDetail()
                     created_new_cd = True
-                    if hasattr(TCustomerDetail, "store_id") and store_id is not None:
-                        setattr(cd, "store_id", store_id)
-                    if hasattr(TCustomerDetail, "table_id"):
-                        setattr(cd, "table_id", table_id)
+                    if _CD_HAS_STORE_ID and store_id is not None:
+                        cd.store_id = store_id
+                    if _CD_HAS_TABLE_ID:
+                        cd.table_id = table_id
                     # 人数列の初期化（存在する列だけ）
-                    for col in ("大人男性", "大人女性", "子ども男", "子ども女", "合計人数"):
-                        if hasattr(TCustomerDetail, col):
-                            setattr(cd, col, 0)
+                    for col in _CD_PEOPLE_COLS:
+                        setattr(cd, col, 0)
                     s.add(cd)
                     app.logger.info("[staff_api_order] created new TCustomerDetail (table_id=%s)", table_id)
 
                 # 4) 最終セット
-                if hasattr(TCustomerDetail, "order_id"):
-                    before = getattr(cd, "order_id", None)
-                    setattr(cd, "order_id", order.id)
-                    after = getattr(cd, "order_id", None)
-                    app.logger.debug("[staff_api_order] set cd.order_id: %s -> %s", before, after)
+                if _CD_HAS_ORDER_ID:
+                    before = cd.order_id
+                    cd.order_id = order.id
+                    app.logger.debug("[staff_api_order] set cd.order_id: %s -> %s", before, cd.order_id)
                 else:
                     app.logger.warning("[staff_api_order] cannot set order_id because column not present")
 
-                if hasattr(TCustomerDetail, "table_id"):
-                    setattr(cd, "table_id", table_id)
-                if hasattr(TCustomerDetail, "store_id") and store_id is not None:
-                    setattr(cd, "store_id", store_id)
+                if _CD_HAS_TABLE_ID:
+                    cd.table_id = table_id
+                if _CD_HAS_STORE_ID and store_id is not None:
+                    cd.store_id = store_id
 
                 s.flush()
                 bound_cd_id = getattr(cd, "id", None)
@@ -15160,8 +16077,22 @@ def staff_api_order():
         taxsum   = int(order.tax or 0)
         added    = 0
 
-        # ★ 新しく追加される明細を保持するリスト
-        new_items_for_print = []
+        # ★ 新しく追加される明細（INSERT 用の行 dict）。ループ後に1文でまとめて INSERT する
+        #   一括 INSERT は flush を通らないため、tenant_id / store_id はここで埋める
+        new_item_rows = []
+        item_tenant_id = _current_tenant_id()
+        item_tenant_id = int(item_tenant_id) if item_tenant_id not in (None, 0, "") else None
+        item_store_id = getattr(order, "store_id", None) or store_id
+
+        # 提供中メニューと実効税率をまとめて取得（明細ごとに SELECT しない）
+        mids = set()
+        for it in items:
+            try:
+                mids.add(int(it.get("menu_id")))
+            except Exception:
+                pass
+        menus = {m.id: m for m in s.query(Menu).filter(Menu.id.in_(mids), Menu.available == 1)} if mids else {}
+        rates = resolve_effective_tax_rates_for_menus(s, menus.values())
 
         for it in items:
             # アイテムバリデーション
@@ -15177,12 +16108,12 @@ def staff_api_order():
 
             memo = (it.get("memo") or "").strip()
             actual_price = it.get("actual_price")  # 時価商品の実際価格
-            m = s.get(Menu, mid)
-            if not (m and m.available == 1):
+            m = menus.get(mid)
+            if not m:
                 app.logger.debug("[staff_api_order] skip item (menu not available): id=%s", mid)
                 continue
 
-            rate = resolve_effective_tax_rate_for_menu(s, mid, m.tax_rate)  # 例: 0.10
+            rate = rates[mid]  # 例: 0.10
             unit = int(m.price)  # 税抜保存単価
             
             # 時価商品の場合、actual_priceを使用
@@ -15191,7 +16122,6 @@ def staff_api_order():
                 app.logger.info("[staff_api_order] market price item: menu_id=%s actual_price=%s", mid, unit)
 
             # 過去日付注文モードの処理
-            from datetime import datetime
             if custom_date_str:
                 try:
                     custom_datetime = datetime.strptime(custom_date_str, "%Y-%m-%d %H:%M:%S")
@@ -15212,7 +16142,9 @@ def staff_api_order():
                 item_status = "新規"
                 scheduled_date_value = None
 
-            new_item = OrderItem(
+            new_item_rows.append(dict(
+                tenant_id=item_tenant_id,
+                store_id=item_store_id,
                 order_id=order.id,
                 menu_id=mid,
                 qty=qty,
@@ -15222,13 +16154,9 @@ def staff_api_order():
                 status=item_status,
                 added_at=added_at_value,
                 scheduled_date=scheduled_date_value,
-            )
-            
-            # actual_priceをOrderItemに保存
-            if actual_price is not None and hasattr(new_item, 'actual_price'):
-                new_item.actual_price = int(actual_price)
-            s.add(new_item)
-            new_items_for_print.append(new_item)  # ★ 新しい明細をリストに追加
+                # actual_priceをOrderItemに保存
+                actual_price=int(actual_price) if actual_price is not None else None,
+            ))
 
             # 金額集計（1個ごと端数処理）
             subtotal += unit * qty
@@ -15242,6 +16170,21 @@ def staff_api_order():
             s.rollback()
             return jsonify({"ok": False, "error": "no valid items"}), 400
 
+        # 明細を1文で一括 INSERT（RETURNING 対応 DB は採番 ID も同時に受け取る）
+        item_insert = insert(OrderItem)
+        if s.get_bind().dialect.insert_executemany_returning:
+            new_item_ids = list(s.scalars(
+                item_insert.returning(OrderItem.id, sort_by_parameter_order=True), new_item_rows
+            ))
+        else:
+            s.execute(item_insert, new_item_rows)
+            new_item_ids = sorted(s.scalars(
+                select(OrderItem.id)
+                .where(OrderItem.order_id == order.id)
+                .order_by(OrderItem.id.desc())
+                .limit(len(new_item_rows))
+            ))
+
         order.subtotal = subtotal
         order.tax      = taxsum
         order.total    = subtotal + taxsum
@@ -15255,7 +16198,7 @@ def staff_api_order():
 
         # 💡 ブラウザ側で印刷処理を行うため、サーバー側の印刷処理は削除
         # try:
-        #     trigger_print_job(order.id, items_to_print=new_items_for_print)
+        #     trigger_print_job(order.id, items_to_print=new_item_ids)
         # except Exception:
         #     app.logger.exception("[staff_api_order] failed to print")
 
@@ -15265,7 +16208,7 @@ def staff_api_order():
             "subtotal": order.subtotal,
             "tax": order.tax,
             "total": order.total,
-            "new_item_ids": [item.id for item in new_items_for_print]
+            "new_item_ids": new_item_ids
         })
     except Exception as e:
         s.rollback()
@@ -15284,23 +16227,22 @@ def staff_api_progress_update(item_id: int):
     return _progress_update_core(item_id)
 
 
+# 日本語・表記ゆれ → cooking / served / cancel / new
+_STATUS_MAP = {
+    "調理中": "cooking", "cooking": "cooking",
+    "提供済": "served", "served": "served",
+    "取消": "cancel", "ｷｬﾝｾﾙ": "cancel", "キャンセル": "cancel", "cancel": "cancel", "void": "cancel",
+    "新規": "new", "new": "new",
+}
+
+
 def _norm_status(st: str) -> str:
     """UIから来る多様な表記を cooking / served / cancel / new の4種に正規化"""
     s = (st or "").strip().lower()
-    # 日本語・表記ゆれを吸収
-    if s in ("調理中", "cooking"):
-        return "cooking"
-    if s in ("提供済", "served"):
-        return "served"
-    if s in ("取消", "ｷｬﾝｾﾙ", "キャンセル", "cancel", "void"):
-        return "cancel"
-    if s in ("新規", "new"):
-        return "new"
-    return s  # その他（不明）はそのまま返す
+    return _STATUS_MAP.get(s, s)  # その他（不明）はそのまま返す
 
 
 def _progress_update_core(item_id: int):
-    from datetime import datetime
     s = SessionLocal()
     try:
         app.logger.info("[DEBUG-CANCEL] Step 1: Starting _progress_update_core for item_id=%s", item_id)
@@ -15446,54 +16388,147 @@ def _progress_update_core(item_id: int):
 
 
 # --- 伝票( OrderHeader )の状態を更新するAPI：管理者のみ許可 -----------------------------------
+# 受け付ける状態（日本語/英語）と、会計日時を記録する「閉じた」状態
+_ALLOWED_STATUS = frozenset({
+    "新規", "調理中", "提供済", "会計中", "会計済",
+    "open", "in_progress", "serving", "unpaid", "closed", "paid"
+})
+_CLOSED_STATUS = frozenset({"会計済", "closed", "paid"})
+# 会計日時を記録するカラム（起動時に1回だけ確認）
+_CLOSED_FIELDS = tuple(f for f in ("closed_at", "精算日時") if hasattr(OrderHeader, f))
+
+# 「この店舗（テナント）には無い伝票」と分かった番号を短時間だけ覚える
+#   同じ番号への再送・探索で UPDATE と確認の SELECT を繰り返さない。存在する伝票は覚えない
+ORDER_MISS_CACHE_TTL = float(os.getenv("ORDER_MISS_CACHE_TTL", "2"))
+ORDER_MISS_CACHE_MAX = 4096
+_order_miss_cache = {}
+_order_miss_cache_lock = threading.Lock()
+
+
+# 固定のエラー応答は本文（jsonify と同じ形の JSON バイト列）を1回だけ作っておく
+#   Response はリクエストごとに新しく作る（後段で Cookie などのヘッダが付くため共有しない）
+_ORDER_STATUS_ERROR_BODIES = {
+    msg: json.dumps({"ok": False, "error": msg}, separators=(",", ":"), sort_keys=True).encode("utf-8") + b"\n"
+    for msg in ("invalid json", "invalid status", "invalid expected_version", "order not found", "internal error")
+}
+
+
+def _order_status_error(msg, status):
+    return Response(_ORDER_STATUS_ERROR_BODIES[msg], status=status, mimetype="application/json")
+
+
+def _order_miss_cached(key):
+    with _order_miss_cache_lock:
+        exp = _order_miss_cache.get(key)
+    return exp is not None and exp > time.monotonic()
+
+
+def _remember_order_miss(key):
+    if ORDER_MISS_CACHE_TTL <= 0:
+        return
+    with _order_miss_cache_lock:
+        if len(_order_miss_cache) >= ORDER_MISS_CACHE_MAX:
+            _order_miss_cache.clear()
+        _order_miss_cache[key] = time.monotonic() + ORDER_MISS_CACHE_TTL
+
+
 @app.route("/staff/api/order/<int:order_id>/status", methods=["POST"])
 @require_store_admin   # ★ 管理者（店舗管理者）以上のみ
 def staff_update_order_status(order_id):
     """
-    JSON: { "status": "新規|調理中|提供済|会計中|会計済" ... }
+    JSON: { "status": "新規|調理中|提供済|会計中|会計済", "expected_version": 3 (任意) ... }
     ※ 管理者以上のみ利用可能
+    ※ expected_version を付けると、その版数のときだけ更新（他の管理者が先に変えていれば 409）
     """
-    data = request.get_json(force=True) or {}
-    new_label = (data.get("status") or "").strip()
-    ALLOWED = {
-        "新規", "調理中", "提供済", "会計中", "会計済",
-        "open", "in_progress", "serving", "unpaid", "closed", "paid"
-    }
-    if new_label not in ALLOWED:
-        return jsonify({"ok": False, "error": "invalid status"}), 400
-
-    s = SessionLocal()
+    # 本文は小さな JSON 1つだけなので、Content-Type を見ずに直接デコードする（本文はキャッシュしない）
+    body = request.get_data(cache=False)
     try:
-        h = s.get(OrderHeader, order_id)
-        if not h:
-            return jsonify({"ok": False, "error": "order not found"}), 404
-
-        sid = current_store_id()
-        if hasattr(OrderHeader, "store_id") and sid is not None:
-            if getattr(h, "store_id", None) != sid:
-                return jsonify({"ok": False, "error": "forbidden"}), 403
-
-        # ステータス更新
-        if hasattr(h, "status"):
-            h.status = new_label
+        data = json.loads(body) if body else {}
+    except ValueError:
+        return _order_status_error("invalid json", 400)
+    if not isinstance(data, dict):
+        return _order_status_error("invalid json", 400)
+
+    new_label = data.get("status")
+    if not isinstance(new_label, str):
+        new_label = ""
+    if new_label not in _ALLOWED_STATUS:
+        # 前後の空白付きなどはここで正規化（通常はそのまま一致する）
+        new_label = new_label.strip()
+        if new_label not in _ALLOWED_STATUS:
+            return _order_status_error("invalid status", 400)
+
+    expected_version = data.get("expected_version")
+    if expected_version is not None:
+        try:
+            expected_version = int(expected_version)
+        except (TypeError, ValueError):
+            return _order_status_error("invalid expected_version", 400)
 
-        # 会計済にしたら閉鎖日時を記録（該当カラムがあれば）
-        from datetime import datetime, timezone
-        if new_label in {"会計済", "closed", "paid"}:
-            for f in ("closed_at", "精算日時"):
-                if hasattr(h, f):
-                    setattr(h, f, datetime.now(timezone.utc))
+    sid = current_store_id()
+    tenant_id = _current_tenant_id()
+    if session.get("role") == "sysadmin":
+        tenant_id = None
+    miss_key = (order_id, sid if _HAS_STORE_ID else None, tenant_id)
+    if _order_miss_cached(miss_key):
+        return _order_status_error("order not found", 404)
 
-        s.commit()
-        mark_floor_changed()
-        return jsonify({"ok": True})
+    # セッションの取得・後始末は get_db_session、コミット／ロールバックは s.begin() に任せる
+    try:
+        with get_db_session() as s, s.begin():
+            # ステータス更新（会計済にしたら閉鎖日時も。該当カラムがあれば）
+            values = {"version": OrderHeader.version + 1}
+            if _HAS_STATUS:
+                values["status"] = new_label
+            if new_label in _CLOSED_STATUS:
+                # 日時は DB 側の now() で記録（トランザクション開始時刻で揃う）
+                for f in _CLOSED_FIELDS:
+                    values[f] = func.now()
+
+            # 行を読まずに1文の UPDATE で書き換える（店舗・テナントの絞り込みも WHERE に含める）
+            #   UPDATE には自動のテナント条件が付かないので、SELECT 時と同じ条件を明示する
+            owner_conds = [OrderHeader.id == order_id]
+            if _HAS_STORE_ID and sid is not None:
+                owner_conds.append(OrderHeader.store_id == sid)
+            if tenant_id is not None:
+                owner_conds.append(OrderHeader.tenant_id == tenant_id)
+            conds = list(owner_conds)
+            if expected_version is not None:
+                conds.append(OrderHeader.version == expected_version)
+            if _HAS_STATUS:
+                # 既に同じ状態なら書き込まない（再送・二度押しで UPDATE を発行しない）
+                conds.append(OrderHeader.status != new_label)
+            stmt = (
+                update(OrderHeader)
+                .where(*conds)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            if s.get_bind().dialect.update_returning:
+                new_version = s.execute(stmt.returning(OrderHeader.version)).scalar_one_or_none()
+                updated = new_version is not None
+            else:
+                updated = s.execute(stmt).rowcount > 0
+                new_version = expected_version + 1 if expected_version is not None and updated else None
+            if not updated:
+                # 更新 0 件のときだけ、同じ店舗・テナント条件で現在の状態を読み直して返し分ける
+                #   他店舗の伝票も「存在しない」と同じ 404 にする（伝票番号の探索に使わせない）
+                h = s.execute(
+                    select(OrderHeader.status, OrderHeader.version).where(*owner_conds)
+                ).first()
+                if h is None:
+                    _remember_order_miss(miss_key)
+                    return _order_status_error("order not found", 404)
+                if _HAS_STATUS and h.status == new_label:
+                    return jsonify({"ok": True, "unchanged": True, "version": h.version})
+                return jsonify({"ok": False, "error": "conflict",
+                                "status": h.status, "version": h.version}), 409
     except Exception as e:
-        s.rollback()
         app.logger.exception("[staff_update_order_status] %s", e)
-        return jsonify({"ok": False, "error": "internal error"}), 500
-    finally:
-        s.close()
-        SessionLocal.remove()
+        return _order_status_error("internal error", 500)
+
+    mark_floor_changed()
+    return jsonify({"ok": True, "version": new_version})
 
 
 
@@ -15502,6 +16537,15 @@ def staff_update_order_status(order_id):
 # レガシーURLアダプタ（/menu, /menu/<token> → 正規ルートへ転送）
 # ---------------------------------------------------------------------
 # --- レガシーURLアダプタ（menu_page_legacy） ------------------------------------
+# 転送先は固定のルート /t/<tenant_slug>/m/<token>（menu_page）なので、url_for（URL マップの逆引き）を使わず組み立てる
+#   各部分のエスケープは Werkzeug の URL 変換と同じ安全文字で行う
+_LEGACY_MENU_SAFE = "!$&'()*+,/:;=@"
+
+
+def _legacy_menu_url(script_root, slug, token):
+    return f"{script_root}/t/{quote(slug, safe=_LEGACY_MENU_SAFE)}/m/{quote(token, safe=_LEGACY_MENU_SAFE)}"
+
+
 @app.route("/menu")
 @app.route("/menu/<token>")
 def menu_page_legacy(token=None):
@@ -15511,17 +16555,15 @@ def menu_page_legacy(token=None):
         slug = g.tenant.get("slug")
 
     if not slug:
-        app.logger.warning("[menu_page_legacy] tenant_slug missing; session=%r g.tenant=%r",
-                           dict(session), getattr(g, "tenant", None))
+        # セッションの中身は記録しない（キー名だけ）
+        app.logger.warning("[menu_page_legacy] tenant_slug missing; session_keys=%r g.tenant=%r",
+                           list(session.keys()), getattr(g, "tenant", None))
         return "tenant_slug が不明です。ログインし直してください。", 400
 
-    # エンドポイント 'menu_page' に合わせて転送
-    try:
-        return redirect(url_for("menu_page", tenant_slug=slug, token=token))
-    except Exception as e:
-        app.logger.error("[menu_page_legacy] url_for(menu_page, tenant_slug=%s, token=%s) failed: %s",
-                         slug, token, e)
-        return redirect(f"/{slug}/menu" + (f"?token={token}" if token else ""))
+    # エンドポイント 'menu_page' に合わせて転送（トークン無しは menu_page に当たらないので従来の転送先へ）
+    if not token:
+        return redirect(f"/{slug}/menu")
+    return redirect(_legacy_menu_url(request.script_root, slug, token))
 
 
 
@@ -15529,9 +16571,8 @@ def menu_page_legacy(token=None):
 # 初期化画面（無効化告知）
 # ---------------------------------------------------------------------
 # --- 初期化画面（admin_initdb） --------------------------------------------------
-@app.route("/admin/initdb")
-def admin_initdb():
-    return render_template_string("""
+# テンプレートは読み込み時に1回だけコンパイル（毎リクエストの字句解析・コンパイルを省く）
+_INITDB_TEMPLATE = app.jinja_env.from_string("""
 <!doctype html><html lang="ja"><head>
 <meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">
 <title>初期化(無効)</title>
@@ -15542,7 +16583,29 @@ def admin_initdb():
   <p>DATABASE_URL: <code>***hidden***</code></p>
   <p><a href="{{ url_for('floor') }}">フロアへ戻る</a></p>
 </body></html>
-    """, db_url=DATABASE_URL), 403
+    """)
+
+
+# 入力が固定なので描画結果（UTF-8 バイト列）と ETag も使い回す
+#   リンク先 URL は script_root に依存するので、それごとに初回だけ描画
+_initdb_body_cache = {}
+# 応答にはセッションの Set-Cookie が付くことがあるので共有キャッシュには載せない（ブラウザのみ）
+_INITDB_CACHE_CONTROL = "private, max-age=3600"
+
+
+@app.route("/admin/initdb")
+def admin_initdb():
+    cached = _initdb_body_cache.get(request.script_root)
+    if cached is None:
+        body = _INITDB_TEMPLATE.render(db_url=DATABASE_URL).encode("utf-8")
+        etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+        cached = _initdb_body_cache[request.script_root] = (body, etag)
+    body, etag = cached
+    headers = {"ETag": f'"{etag}"', "Cache-Control": _INITDB_CACHE_CONTROL}
+    # 同じ内容を持っているブラウザには本文を返さない
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, status=403, mimetype="text/html", headers=headers)
 
 
 
@@ -15550,19 +16613,29 @@ def admin_initdb():
 # 売上集計機能：日付ヘルパ
 # =============================================================================
 # --- 日付ヘルパ：今日の文字列（_today_str） --------------------------------------
+@lru_cache(maxsize=8)
+def _local_date_str(epoch_sec: int, days_back: int = 0) -> str:
+    """epoch 秒（ローカル時刻）から days_back 日前の 'YYYY-MM-DD'（同じ秒の呼び出しはキャッシュを返す）"""
+    return (datetime.fromtimestamp(epoch_sec) - timedelta(days=days_back)).strftime("%Y-%m-%d")
+
 def _today_str():
-    return datetime.now().strftime("%Y-%m-%d")
+    return _local_date_str(int(time.time()))
+
+# --- 日付ヘルパ：日付文字列化（_day_str） ----------------------------------------
+def _day_str(v) -> str:
+    """日時（datetime / 文字列）を 'YYYY-MM-DD' にする（datetime は全体を文字列化せずに日付部分だけ）"""
+    return v.date().isoformat() if isinstance(v, datetime) else str(v)[:10]
 
 # --- 日付ヘルパ：期間取得（_range_from_params） -----------------------------------
 def _range_from_params(start_key="start", end_key="end", default_days=30):
     """クエリ文字列から [start, end] を取り、未指定なら過去 default_days を返す（YYYY-MM-DD）"""
-    end = (request.args.get(end_key) or _today_str()).strip()
-    start = (request.args.get(start_key) or (_today_str())).strip()
-    if not request.args.get(start_key) or not request.args.get(end_key):
+    start_arg = request.args.get(start_key)
+    end_arg = request.args.get(end_key)
+    if not start_arg or not end_arg:
         # どちらか欠けたら過去 default_days に丸める
-        end = _today_str()
-        start = (datetime.now() - timedelta(days=default_days)).strftime("%Y-%m-%d")
-    return start, end
+        now = int(time.time())
+        return _local_date_str(now, default_days), _local_date_str(now)
+    return start_arg.strip(), end_arg.strip()
 
 # --- 日付ヘルパ：終端時刻付与（_end_of_day） --------------------------------------
 def _end_of_day(end_date_str: str) -> str:
@@ -15571,6 +16644,79 @@ def _end_of_day(end_date_str: str) -> str:
 
 
 
+# --- 売上集計ヘルパ：注文ごとの実売上（SQL で集計） ----------------------------------
+#   規則：数量0は除外、正数量で状態に取消ラベル（取消/ｷｬﾝｾﾙ/キャンセル/cancel/void）を含む明細は除外、
+#   負数量（取消の監査行）は必ず集計、税は明細ごとに（単価×数量×税率を）切り捨て。
+#   これを WHERE / SUM に落として、明細を読み込まずに DB 側で合計する
+_CANCEL_LABEL_PATTERNS = ("%取消%", "%ｷｬﾝｾﾙ%", "%キャンセル%", "%cancel%", "%void%")
+
+
+def _sales_item_conds():
+    """売上に数える明細の条件（数量0と、正数量の取消ラベルを除く）"""
+    st_low = func.lower(func.coalesce(OrderItem.status, ""))
+    is_cancel_label = or_(*[st_low.like(p) for p in _CANCEL_LABEL_PATTERNS])
+    return (OrderItem.qty != 0, not_(and_(OrderItem.qty > 0, is_cancel_label)))
+
+
+def _sales_item_sums():
+    """(税抜合計, 税額合計) の集計式（税は明細ごとに切り捨て。floor() の無い DB でも動く）"""
+    excl = OrderItem.unit_price * OrderItem.qty
+    return func.sum(excl), func.sum(_sql_floor_int(excl * OrderItem.tax_rate))
+
+
+def _order_totals_by_order(s, order_ids):
+    """{order_id: (subtotal, tax, total)} を返す（明細の無い注文は含まない）"""
+    if not order_ids:
+        return {}
+    excl_sum, tax_sum = _sales_item_sums()
+    rows = (
+        s.query(OrderItem.order_id, excl_sum.label("subtotal"), tax_sum.label("tax"))
+        .filter(OrderItem.order_id.in_(order_ids), *_sales_item_conds())
+        .group_by(OrderItem.order_id)
+        .all()
+    )
+    out = {}
+    for oid, sub, tax in rows:
+        sub, tax = int(sub or 0), int(tax or 0)
+        out[oid] = (sub, tax, sub + tax)
+    return out
+
+
+# --- 売上集計ヘルパ：伝票ごとの最新の人数レコード ------------------------------------
+def _latest_per_order_subquery(q, model, *cols, sort_cols=("created_at", "updated_at")):
+    """q（model の行のクエリ）の cols に order_id ごとの新しさ順位 rn（1 が最新）を付けたサブクエリ。
+    新しさは sort_cols の順（NULL は後回し）→ id の大きい順。
+    """
+    order_by = [getattr(model, c).desc().nulls_last() for c in sort_cols if hasattr(model, c)]
+    order_by.append(model.id.desc())
+    rn = func.row_number().over(partition_by=model.order_id, order_by=order_by).label("rn")
+    return q.with_entities(*cols, rn).subquery()
+
+
+def _latest_rows_per_order(s, q, model, sort_cols=("created_at", "updated_at")):
+    """q（model の行のクエリ）から order_id ごとに最新の1行だけを DB 側で選んで返す。"""
+    ranked = _latest_per_order_subquery(q, model, model.id.label("id"), sort_cols=sort_cols)
+    return s.query(model).join(ranked, model.id == ranked.c.id).filter(ranked.c.rn == 1).all()
+
+
+def _guest_count_col(model):
+    """お客様詳細系モデルの1行あたりの人数を表す SQL 式。
+    合計人数（total / 人数）が正ならそれ、無ければ内訳の合算、それでも 0 以下なら 1 人扱い。
+    """
+    total_nm = next((nm for nm in ("合計人数", "total", "人数") if hasattr(model, nm)), None)
+    parts = [func.coalesce(getattr(model, nm), 0)
+             for nm in ("大人男性", "adult_male", "men",
+                        "大人女性", "adult_female", "women",
+                        "子ども男", "boys", "子供男",
+                        "子ども女", "girls", "子供女")
+             if hasattr(model, nm)]
+    n = sum(parts[1:], parts[0]) if parts else cast(0, Integer)
+    if total_nm is not None:
+        total = getattr(model, total_nm)
+        n = case((total > 0, total), else_=n)
+    return case((n > 0, n), else_=1)
+
+
 # ---------------------------------------------------------------------
 # 売上集計（HTMLダッシュボード）※ endpoint 名は "sales_report"
 # ---------------------------------------------------------------------
@@ -15582,7 +16728,7 @@ def _end_of_day(end_date_str: str) -> str:
 def sales_report():
     s = SessionLocal()
     try:
-        import math, json
+        import json
         from collections import defaultdict
 
         # 期間（未指定なら当月1日〜本日）
@@ -15595,18 +16741,20 @@ def sales_report():
         sid = current_store_id()
 
         # ===== 期間内の伝票（統合済は除外、会計済みのみ） =====
-        q = s.query(OrderHeader).filter(
+        # 使う列だけを取得（テンプレート側の再集計も status / subtotal / tax / total だけ）
+        q = s.query(OrderHeader.id, OrderHeader.status, OrderHeader.closed_at,
+                    OrderHeader.subtotal, OrderHeader.tax, OrderHeader.total).filter(
             OrderHeader.closed_at.isnot(None),
             OrderHeader.closed_at >= start,
             OrderHeader.closed_at <= end_dt
         )
-        if hasattr(OrderHeader, "status"):
+        if _HAS_STATUS:
             q = q.filter(OrderHeader.status == "会計済")
             q = q.filter(~OrderHeader.status.in_(EXCLUDED))
-        if hasattr(OrderHeader, "store_id") and sid is not None:
+        if _HAS_STORE_ID and sid is not None:
             q = q.filter(OrderHeader.store_id == sid)
         orders = q.all()
-        order_ids = [getattr(o, "id", None) for o in orders if getattr(o, "id", None) is not None]
+        order_ids = [o.id for o in orders]
 
         # ===== デバッグ用入れ物 =====
         dbg = {
@@ -15663,31 +16811,17 @@ def sales_report():
 
             if hasattr(Hist, "order_id"):
                 qh = qh.filter(Hist.order_id.in_(order_ids))
-            elif hasattr(Hist, "table_id"):
-                tbl_ids = list({getattr(o, "table_id", None) for o in orders if getattr(o, "table_id", None) is not None})
-                if tbl_ids:
-                    qh = qh.filter(Hist.table_id.in_(tbl_ids))
-                    dbg["note"].append("order_id が履歴に無いので table_id でフォールバックしています。")
-
-            rows = qh.all()
+                # 同一 order_id の最新（created_at > id）だけを DB 側で選ぶ
+                rows = _latest_rows_per_order(s, qh, Hist, sort_cols=("created_at",))
+            else:
+                # order_id が無い履歴は伝票に紐づけられないので人数には使えない
+                rows = []
+                dbg["note"].append("order_id が履歴に無いので人数は履歴から取得できません。")
             dbg["hist_rows_scanned"] = len(rows)
             app.logger.debug("[sales_report] Hist rows scanned: %s", len(rows))
 
-            # 同一 order_id の最新を採用
-            latest = {}
-            for r in rows:
-                oid = getattr(r, "order_id", None)
-                if oid is None:
-                    continue
-                # ソートキー：created_at > id
-                if hasattr(r, "created_at") and getattr(r, "created_at", None):
-                    skey = str(getattr(r, "created_at"))
-                else:
-                    skey = f"{getattr(r, 'id', 0):08d}"
-                if (oid not in latest) or (skey > latest[oid][0]):
-                    latest[oid] = (skey, r)
-
-            for oid, (_k, r) in latest.items():
+            latest = {r.order_id: r for r in rows if r.order_id is not None}
+            for oid, r in latest.items():
                 # 1) 合計人数があれば優先
                 total = None
                 if hasattr(r, "合計人数"):
@@ -15718,8 +16852,7 @@ def sales_report():
         # guests を最終決定（履歴が無いものは最低 1 名）
         guests_total = 0
         for o in orders:
-            oid = getattr(o, "id", None)
-            g = guests_map.get(oid)
+            g = guests_map.get(o.id)
             if g is None:
                 g = 1
             guests_total += max(0, int(g))
@@ -15727,31 +16860,24 @@ def sales_report():
         app.logger.debug("[sales_report] guests_total=%s / orders=%s", guests_total, len(orders))
 
         # ===== 概要（OrderItemから再計算：取り消しを除外） =====
-        # 全注文の明細を取得
-        qi_all = (
-            s.query(OrderItem)
-             .filter(OrderItem.order_id.in_(order_ids))
-             .all()
-        )
-        
-        # 注文IDごとに明細をグループ化
-        from collections import defaultdict
+        # 注文ごとの実売上は DB 側で集計（明細の ORM オブジェクトは作らない）
+        totals_by_order = _order_totals_by_order(s, order_ids)
+        total_subtotal = sum(sub for sub, _tax, _tot in totals_by_order.values())
+        total_tax = sum(tax for _sub, tax, _tot in totals_by_order.values())
+        total_total = total_subtotal + total_tax
+
+        # 日別は明細の計上日ごとに振り分けるので、必要な列だけをタプルで取得
         items_by_order = defaultdict(list)
-        for it in qi_all:
-            oid = getattr(it, "order_id", None)
-            if oid:
-                items_by_order[oid].append(it)
-        
-        # 各注文の実売上を計算
-        total_subtotal = 0
-        total_tax = 0
-        total_total = 0
-        for oid in order_ids:
-            items = items_by_order.get(oid, [])
-            totals = _calculate_order_totals(items)
-            total_subtotal += totals["subtotal"]
-            total_tax += totals["tax"]
-            total_total += totals["total"]
+        if order_ids:
+            qi_all = (
+                s.query(OrderItem.order_id, OrderItem.status, OrderItem.scheduled_date, OrderItem.added_at,
+                        OrderItem.qty, OrderItem.unit_price, OrderItem.tax_rate)
+                 .filter(OrderItem.order_id.in_(order_ids))
+                 .all()
+            )
+            for it in qi_all:
+                if it.order_id:
+                    items_by_order[it.order_id].append(it)
         
         overview = {
             "count_orders": len(orders),
@@ -15780,12 +16906,10 @@ def sales_report():
         normal_count = 0
         
         for o in orders:
-            oid = getattr(o, "id", None)
-            if not oid:
-                continue
+            oid = o.id
             
             # この注文の会計完了日時を取得
-            closed_at = getattr(o, "closed_at", None)
+            closed_at = o.closed_at
             
             # この注文の明細を取得
             items = items_by_order.get(oid, [])
@@ -15815,7 +16939,7 @@ def sales_report():
                     normal_count += 1
                 
                 if date_value:
-                    day = str(date_value)[:10] if isinstance(date_value, datetime) else str(date_value)[:10]
+                    day = _day_str(date_value)
                 else:
                     continue
                 
@@ -15849,7 +16973,8 @@ def sales_report():
 
         # avg_per_guest を付与してテンプレへ
         days = []
-        for k, v in sorted(daily.items()):
+        for k in sorted(daily):
+            v = daily[k]
             guests = int(v.get("guests", 0) or 0)
             avg = (int(v["total"]) // guests) if guests > 0 else 0
             days.append({
@@ -15863,48 +16988,27 @@ def sales_report():
             })
 
         # ===== メニュー別 =====
-        qi = (
-            s.query(OrderItem, OrderHeader)
-             .join(OrderHeader, OrderItem.order_id == OrderHeader.id)
-             .filter(OrderHeader.opened_at >= start,
-                     OrderHeader.opened_at <= end_dt)
+        # 概要・日別と同じ伝票（会計済・期間は会計日時）を対象に、DB 側でメニューごとに集計
+        order_ids_subq = q.with_entities(OrderHeader.id).subquery()
+        excl_sum, tax_sum = _sales_item_sums()
+        menu_rows = (
+            s.query(OrderItem.menu_id, Menu.name, func.sum(OrderItem.qty), excl_sum, tax_sum)
+             .outerjoin(Menu, Menu.id == OrderItem.menu_id)
+             .filter(OrderItem.order_id.in_(select(order_ids_subq.c.id)), *_sales_item_conds())
+             .group_by(OrderItem.menu_id, Menu.name)
+             .all()
         )
-        if hasattr(OrderHeader, "status"):
-            qi = qi.filter(~OrderHeader.status.in_(EXCLUDED))
-        if hasattr(OrderHeader, "store_id") and sid is not None:
-            qi = qi.filter(OrderHeader.store_id == sid)
-        item_rows = qi.all()
 
+        # 同名メニューは1行にまとめる（従来どおり名前単位）
         agg = defaultdict(lambda: {"qty": 0, "excl": 0, "tax": 0, "incl": 0})
-        for it, _oh in item_rows:
-            # ★★★ 追加: 取消判定ロジック ★★★
-            qty = int(getattr(it, "qty", 0) or 0)
-            if qty == 0:
-                continue  # 数量0はスキップ
-
-            # 明細の状態を取得（status または 状態）
-            st = (getattr(it, "status", None) or getattr(it, "状態", None) or "")
-            st_low = str(st).lower()
-            is_cancel_label = (
-                ("取消" in st_low) or ("ｷｬﾝｾﾙ" in st_low) or ("キャンセル" in st_low)
-                or ("cancel" in st_low) or ("void" in st_low)
-            )
-
-            # 正数量かつ取消ラベルは集計除外。負数量は "取消" でも必ず集計。
-            if qty > 0 and is_cancel_label:
-                continue
-            # ★★★ ここまで追加 ★★★
-
-            name = (getattr(getattr(it, "menu", None), "name", None) or f"#{getattr(it, 'menu_id', '')}")
-            excl = int(getattr(it, "unit_price", 0) or 0) * qty
-            rate = float(getattr(it, "tax_rate", 0.0) or 0.0)
-            tax  = int(math.floor(excl * rate))
-            a = agg[name]
-            a["qty"]  += qty
+        for menu_id, menu_name, qty, excl, tax in menu_rows:
+            excl, tax = int(excl or 0), int(tax or 0)
+            a = agg[menu_name or f"#{menu_id}"]
+            a["qty"]  += int(qty or 0)
             a["excl"] += excl
             a["tax"]  += tax
             a["incl"] += excl + tax
-        by_menu = [{"name": k, **v} for k, v in sorted(agg.items())]
+        by_menu = [{"name": k, **agg[k]} for k in sorted(agg)]
 
         # orders も渡す（テンプレ側の保険で使用可）
         return render_template(
@@ -15931,7 +17035,6 @@ def sales_report():
 @require_store_admin
 def api_sales_daily():
     from collections import defaultdict
-    from datetime import datetime
     s = SessionLocal()
     try:
         sid = current_store_id()
@@ -15943,86 +17046,60 @@ def api_sales_daily():
 
         # ---- 期間内の会計済み伝票を取得（closed_atベース）
         q = (
-            s.query(OrderHeader)
+            s.query(OrderHeader.id, OrderHeader.closed_at, OrderHeader.opened_at)
              .filter(
                  OrderHeader.closed_at.isnot(None),
                  OrderHeader.closed_at >= start,
                  OrderHeader.closed_at <= end_dt
              )
         )
-        if hasattr(OrderHeader, "store_id") and sid is not None:
+        if _HAS_STORE_ID and sid is not None:
             q = q.filter(OrderHeader.store_id == sid)
-        if hasattr(OrderHeader, "status"):
+        if _HAS_STATUS:
             q = q.filter(OrderHeader.status == "会計済")
             q = q.filter(~OrderHeader.status.in_(list(EXCLUDED_STATUSES)))
 
         orders = q.all()
 
-        def _ival(x):
-            try:
-                return int(x or 0)
-            except Exception:
-                try:
-                    return int(float(x or 0))
-                except Exception:
-                    return 0
-
-        # 日別集計の土台（売上・件数）
-        daily = defaultdict(lambda: {
-            "order_count": 0,
-            "total_sales": 0,
-            "subtotal":    0,
-            "tax_amount":  0,
-            "guests":      0,   # ← あとで埋める
-        })
+        # 日別集計の土台（売上・件数）：項目ごとの day -> 値 のカウンタ（来客数はあとで埋める）
+        d_orders, d_sales, d_sub, d_tax, d_guests = (defaultdict(int) for _ in range(5))
 
         order_day = {}   # order_id -> 'YYYY-MM-DD'
-        order_ids = []
-        for o in orders:
-            oid = getattr(o, "id", None)
-            if oid is None:
-                continue
-            order_ids.append(oid)
+        order_ids = [o.id for o in orders]
         
-        # 全注文の明細を取得してscheduled_dateをチェック
+        # 明細は読み込まず、計上日（過去日付モード）のある明細の (order_id, scheduled_date) だけを取得
+        #   注文ごとに最初の明細（id 順）の計上日を採用
+        scheduled_by_order = {}
         if order_ids:
-            qi_all_temp = s.query(OrderItem).filter(OrderItem.order_id.in_(order_ids)).all()
-            items_by_order_temp = defaultdict(list)
-            for it in qi_all_temp:
-                oid_temp = getattr(it, "order_id", None)
-                if oid_temp:
-                    items_by_order_temp[oid_temp].append(it)
+            sched_rows = (
+                s.query(OrderItem.order_id, OrderItem.scheduled_date)
+                 .filter(OrderItem.order_id.in_(order_ids), OrderItem.scheduled_date.isnot(None))
+                 .order_by(OrderItem.id)
+                 .all()
+            )
+            for oid, sd in sched_rows:
+                scheduled_by_order.setdefault(oid, sd)
             
             # 各注文の日付を決定（scheduled_date優先、なければclosed_at）
             for o in orders:
-                oid = getattr(o, "id", None)
-                if oid is None:
-                    continue
-                    
-                # scheduled_dateをチェック
-                items_temp = items_by_order_temp.get(oid, [])
-                scheduled_date = None
-                for it in items_temp:
-                    sd = getattr(it, "scheduled_date", None)
-                    if sd:
-                        scheduled_date = sd
-                        break
+                oid = o.id
+                scheduled_date = scheduled_by_order.get(oid)
                 
                 if scheduled_date:
                     # scheduled_dateがある場合はそれを使用
-                    day = str(scheduled_date)[:10] if isinstance(scheduled_date, datetime) else str(scheduled_date)[:10]
+                    day = _day_str(scheduled_date)
                 else:
                     # scheduled_dateがない場合は従来通りclosed_atを使用
-                    closed_at = getattr(o, "closed_at", None)
+                    closed_at = o.closed_at
                     if closed_at:
-                        day = str(closed_at)[:10] if isinstance(closed_at, datetime) else str(closed_at)[:10]
+                        day = _day_str(closed_at)
                     else:
                         day = ""
                     if not day:
                         # closed_atが無い/壊れている場合は opened_at にフォールバック
-                        opened_at = getattr(o, "opened_at", None)
+                        opened_at = o.opened_at
                         if opened_at:
-                            day = str(opened_at)[:10] if isinstance(opened_at, datetime) else str(opened_at)[:10]
+                            day = _day_str(opened_at)
                         else:
                             day = ""
                         if not day:
@@ -16030,155 +17107,66 @@ def api_sales_daily():
                 
                 order_day[oid] = day
         
-        # 全注文の明細を取得してOrderItemから再計算（取り消しを除外）
+        # OrderItemから再計算（取り消しを除外）：注文ごとの実売上は DB 側で集計し、日別には足し込むだけ
         if order_ids:
-            qi_all = s.query(OrderItem).filter(OrderItem.order_id.in_(order_ids)).all()
-            items_by_order = defaultdict(list)
-            for it in qi_all:
-                oid = getattr(it, "order_id", None)
-                if oid:
-                    items_by_order[oid].append(it)
-            
-            # 各注文の実売上を計算して日別に集計
+            totals_by_order = _order_totals_by_order(s, order_ids)
             for oid in order_ids:
                 day = order_day.get(oid)
                 if not day:
                     continue
-                items = items_by_order.get(oid, [])
-                totals = _calculate_order_totals(items)
+                sub, tax, tot = totals_by_order.get(oid, (0, 0, 0))
                 
-                d = daily[day]
-                d["order_count"] += 1
-                d["total_sales"] += totals["total"]
-                d["subtotal"]    += totals["subtotal"]
-                d["tax_amount"]  += totals["tax"]
+                d_orders[day] += 1
+                d_sales[day]  += tot
+                d_sub[day]    += sub
+                d_tax[day]    += tax
 
         # ---- 来客者数集計（重複防止：各伝票につき1レコードのみ採用）
-        # 1) 履歴テーブルがあれば「最新」を採用
+        #   履歴テーブルの最新 → 現在値の最新 → 1 人 のフォールバックを DB 側で1クエリにまとめる
         GHist = (globals().get("GuestDetailHistory")
                  or globals().get("TCustomerDetailHistory")
                  or globals().get("CustomerInfoHistory")
                  or globals().get("VisitHistory")
                  or globals().get("T_お客様詳細履歴"))
+        GCur = globals().get("GuestDetail") or globals().get("T_お客様詳細")
 
-        def _best_key(r):
-            """最新判定キー（created_at > updated_at > id）"""
-            for nm in ("created_at", "updated_at"):
-                if hasattr(r, nm) and getattr(r, nm, None):
-                    try:
-                        # 文字列/Datetime どちらでも文字列比較で安定するように
-                        return str(getattr(r, nm))
-                    except Exception:
-                        pass
-            return f"{getattr(r, 'id', 0):020d}"
-
-        used_orders = set()
-        if GHist is not None and order_ids:
-            qg = s.query(GHist).filter(getattr(GHist, "order_id").in_(order_ids))
-            if hasattr(GHist, "store_id") and sid is not None:
-                qg = qg.filter(getattr(GHist, "store_id") == sid)
-            # 期間で緩く絞る（created_at があれば）
-            if hasattr(GHist, "created_at"):
-                qg = qg.filter(getattr(GHist, "created_at") >= start,
-                               getattr(GHist, "created_at") <= end_dt)
-
-            latest = {}  # order_id -> record
-            for r in qg.all():
-                oid = getattr(r, "order_id", None)
-                if oid not in order_day:
-                    continue
-                key = _best_key(r)
-                if (oid not in latest) or (key > _best_key(latest[oid])):
-                    latest[oid] = r
-
-            for oid, r in latest.items():
-                day = order_day.get(oid)
-                if not day:
+        if order_day:
+            gq = q.with_entities(OrderHeader.id)
+            guest_cols = []
+            for G in (GHist, GCur):
+                if G is None:
                     continue
-                # 合計人数を優先
-                total = 0
-                for nm in ("合計人数", "total", "人数"):
-                    if hasattr(r, nm):
-                        try:
-                            total = int(getattr(r, nm) or 0)
-                            break
-                        except Exception:
-                            pass
-                # 無ければ内訳合算
-                if total <= 0:
-                    for nm in ("大人男性","adult_male","men",
-                               "大人女性","adult_female","women",
-                               "子ども男","boys","子供男",
-                               "子ども女","girls","子供女"):
-                        if hasattr(r, nm):
-                            total += _ival(getattr(r, nm))
-                # 未記録は安全側で 1 人扱い
-                if total <= 0:
-                    total = 1
-                daily[day]["guests"] += total
-                used_orders.add(oid)
-
-        # 2) 履歴が無い or 拾えなかった伝票は「現在値」から補完（同様に1件/伝票）
-        remaining = [oid for oid in order_ids if oid not in used_orders]
-        if remaining:
-            GCur = globals().get("GuestDetail") or globals().get("T_お客様詳細")
-            if GCur is not None:
-                qg2 = s.query(GCur).filter(getattr(GCur, "order_id").in_(remaining))
-                if hasattr(GCur, "store_id") and sid is not None:
-                    qg2 = qg2.filter(getattr(GCur, "store_id") == sid)
-
-                # 最新（updated_at or id）で1件/伝票を選ぶ
-                chosen = {}
-                for r in qg2.all():
-                    oid = getattr(r, "order_id", None)
-                    if oid not in order_day:
-                        continue
-                    key = _best_key(r)
-                    if (oid not in chosen) or (key > _best_key(chosen[oid])):
-                        chosen[oid] = r
-
-                for oid, r in chosen.items():
-                    day = order_day.get(oid)
-                    if not day:
-                        continue
-                    total = 0
-                    for nm in ("合計人数", "total", "人数"):
-                        if hasattr(r, nm):
-                            try:
-                                total = int(getattr(r, nm) or 0); break
-                            except Exception:
-                                pass
-                    if total <= 0:
-                        for nm in ("大人男性","adult_male","men",
-                                   "大人女性","adult_female","women",
-                                   "子ども男","boys","子供男",
-                                   "子ども女","girls","子供女"):
-                            if hasattr(r, nm):
-                                total += _ival(getattr(r, nm))
-                    if total <= 0:
-                        total = 1
-                    daily[day]["guests"] += total
-                    used_orders.add(oid)
-
-        # 3) それでも人数が入らなかった伝票は 1 人で埋める
-        for oid in order_ids:
-            if oid not in used_orders:
+                qg = s.query(G).filter(getattr(G, "order_id").in_(order_ids))
+                if hasattr(G, "store_id") and sid is not None:
+                    qg = qg.filter(getattr(G, "store_id") == sid)
+                # 履歴は期間で緩く絞る（created_at があれば）
+                if G is GHist and hasattr(G, "created_at"):
+                    qg = qg.filter(getattr(G, "created_at") >= start,
+                                   getattr(G, "created_at") <= end_dt)
+                # order_id ごとの最新（created_at > updated_at > id）
+                latest = _latest_per_order_subquery(
+                    qg, G, G.order_id.label("order_id"), _guest_count_col(G).label("guests"))
+                gq = gq.outerjoin(latest, and_(latest.c.order_id == OrderHeader.id, latest.c.rn == 1))
+                guest_cols.append(latest.c.guests)
+
+            # 未記録の伝票は安全側で 1 人扱い
+            for oid, guests in gq.add_columns(func.coalesce(*guest_cols, 1)).all():
                 day = order_day.get(oid)
                 if day:
-                    daily[day]["guests"] += 1
+                    d_guests[day] += guests
 
         # ---- 出力成形（客単価: total_sales / guests の整数割）
         out = []
-        for k in sorted(daily.keys()):
-            v = daily[k]
-            guests = int(v.get("guests", 0))
-            avg = (int(v["total_sales"]) // guests) if guests > 0 else 0
+        # 来客数は日付の決まった伝票にしか付かないので、日付は d_orders のキーで尽くされる
+        for k in sorted(d_orders):
+            guests = d_guests[k]
+            avg = (d_sales[k] // guests) if guests > 0 else 0
             out.append({
                 "date": k,
-                "order_count": v["order_count"],
-                "subtotal": v["subtotal"],
-                "tax_amount": v["tax_amount"],
-                "total_sales": v["total_sales"],
+                "order_count": d_orders[k],
+                "subtotal": d_sub[k],
+                "tax_amount": d_tax[k],
+                "total_sales": d_sales[k],
                 "guests": guests,
                 "avg_sales_per_guest": avg,  # 客単価（税込）
             })
@@ -16219,7 +17207,7 @@ def api_check_active_past_orders():
              )
         )
         
-        if hasattr(OrderHeader, "store_id") and sid is not None:
+        if _HAS_STORE_ID and sid is not None:
             q = q.filter(OrderHeader.store_id == sid)
         
         # 少なくとも1件でもあればTrue
@@ -16254,50 +17242,42 @@ def api_sales_monthly():
     try:
         year = str(request.args.get("year", datetime.now().year))
 
-        rows = (s.query(OrderHeader)
-                  .filter(OrderHeader.closed_at.isnot(None),
-                          (OrderHeader.closed_at >= f"{year}-01-01"),
-                          (OrderHeader.closed_at <= f"{year}-12-31 23:59:59"),
-                          OrderHeader.status == "会計済")
-                  .all())
+        # 対象伝票（会計済・closed_at が当年）の条件
+        order_conds = (
+            OrderHeader.closed_at.isnot(None),
+            OrderHeader.closed_at >= f"{year}-01-01",
+            OrderHeader.closed_at <= f"{year}-12-31 23:59:59",
+            OrderHeader.status == "会計済",
+        )
 
-        # 注文IDを収集
-        order_ids = [getattr(o, "id", None) for o in rows if getattr(o, "id", None) is not None]
-        order_month = {}  # order_id -> 'YYYY-MM'
-        for o in rows:
-            oid = getattr(o, "id", None)
-            if oid:
-                month = (str(o.closed_at or ""))[:7]  # YYYY-MM
-                order_month[oid] = month
-        
-        # 全注文の明細を取得してOrderItemから再計算（取り消しを除外）
-        monthly = defaultdict(lambda: {"order_count":0, "total_sales":0, "subtotal":0, "tax_amount":0})
-        if order_ids:
-            qi_all = s.query(OrderItem).filter(OrderItem.order_id.in_(order_ids)).all()
-            items_by_order = defaultdict(list)
-            for it in qi_all:
-                oid = getattr(it, "order_id", None)
-                if oid:
-                    items_by_order[oid].append(it)
-            
-            # 各注文の実売上を計算して月別に集計
-            for oid in order_ids:
-                month = order_month.get(oid)
-                if not month:
-                    continue
-                items = items_by_order.get(oid, [])
-                totals = _calculate_order_totals(items)
-                
-                m = monthly[month]
-                m["order_count"] += 1
-                m["total_sales"] += totals["total"]
-                m["subtotal"]    += totals["subtotal"]
-                m["tax_amount"]  += totals["tax"]
+        # 伝票ごとの実売上（取り消しを除外）を DB 側で集計し、月（closed_at の先頭 'YYYY-MM'）ごとに合算
+        #   closed_at は文字列カラムなので、日付関数ではなく先頭7文字で月を取る
+        excl_sum, tax_sum = _sales_item_sums()
+        totals = (
+            s.query(OrderItem.order_id.label("order_id"), excl_sum.label("subtotal"), tax_sum.label("tax"))
+             .filter(OrderItem.order_id.in_(select(OrderHeader.id).where(*order_conds)), *_sales_item_conds())
+             .group_by(OrderItem.order_id)
+             .subquery()
+        )
+        month = func.substr(OrderHeader.closed_at, 1, 7)
+        rows = (
+            s.query(month, func.count(OrderHeader.id),
+                    func.coalesce(func.sum(totals.c.subtotal), 0),
+                    func.coalesce(func.sum(totals.c.tax), 0))
+             .outerjoin(totals, totals.c.order_id == OrderHeader.id)
+             .filter(*order_conds)
+             .group_by(month)
+             .order_by(month)
+             .all()
+        )
 
         out = []
-        for k in sorted(monthly.keys()):
-            v = monthly[k]
-            out.append({"month": k, **v})
+        for k, cnt, sub, tax in rows:
+            if not k:
+                continue
+            sub, tax = int(sub), int(tax)
+            out.append({"month": k, "order_count": int(cnt), "total_sales": sub + tax,
+                        "subtotal": sub, "tax_amount": tax})
 
         return jsonify({"status":"success","data":out,"year":year})
     except Exception as e:
@@ -16313,7 +17293,15 @@ def api_sales_monthly():
 # ---------------------------------------------------------------------
 # --- API：商品別売上（/api/sales/products） --------------------------------------
 from collections import defaultdict
-import math
+
+# 取消系ラベル（状態・メモ）の判定語。英語は大文字小文字を区別しない
+#   明細ごとに語を1つずつ探さず、1本の正規表現で1回だけ走査する
+_SALES_CANCEL_WORDS_JA = ("取消", "ｷｬﾝｾﾙ", "キャンセル", "削除")
+_SALES_CANCEL_WORDS_EN = ("cancel", "void", "voided")
+_SALES_CANCEL_RE = re.compile(
+    "|".join(map(re.escape, _SALES_CANCEL_WORDS_JA + _SALES_CANCEL_WORDS_EN)), re.IGNORECASE
+)
+_SALES_CANCEL_LIKE = tuple(f"%{w}%" for w in _SALES_CANCEL_WORDS_JA + _SALES_CANCEL_WORDS_EN)
 
 @app.route("/api/sales/products")
 @require_store_admin
@@ -16327,7 +17315,6 @@ def api_sales_products():
     /api/sales/products?debug=1 で詳細ログ＋レスポンスにデバッグを含める
     """
     from collections import defaultdict
-    import math
 
     # 入口ログ
     try:
@@ -16365,11 +17352,16 @@ def api_sales_products():
                  OrderHeader.closed_at <= end_dt,
              )
         )
-        if hasattr(OrderHeader, "status"):
+        if _HAS_STATUS:
             q = q.filter(OrderHeader.status.in_(["会計済", "closed", "paid"])) \
                  .filter(~OrderHeader.status.in_(["統合済", "integrated", "merged"]))
-        if hasattr(OrderHeader, "store_id") and sid is not None:
+        if _HAS_STORE_ID and sid is not None:
             q = q.filter(OrderHeader.store_id == sid)
+        if not debug_mode:
+            # 数量0・正数量の取消明細は DB 側で落とす（debug 時は除外理由を数えるので全件取得）
+            texts = [func.lower(func.coalesce(c, "")) for c in (OrderItem.status, OrderItem.memo)]
+            is_cancel = or_(*[tx.like(p) for tx in texts for p in _SALES_CANCEL_LIKE])
+            q = q.filter(OrderItem.qty != 0, not_(and_(OrderItem.qty > 0, is_cancel)))
 
         rows = q.all()
 
@@ -16387,8 +17379,6 @@ def api_sales_products():
             "count_unit_price": 0,
         })
 
-        cancel_words_ja = ("取消", "ｷｬﾝｾﾙ", "キャンセル", "削除")
-        cancel_words_en = ("cancel", "void", "voided")
 
         dbg = {
             "seen": 0,
@@ -16401,6 +17391,7 @@ def api_sales_products():
         }
         EXAMPLE_LIMIT = 20
 
+        rate_bp_cache = {}  # 税率 -> 0.01% 単位の整数
         for it, oh, m in rows:
             dbg["seen"] += 1
 
@@ -16423,8 +17414,7 @@ def api_sales_products():
             st  = (getattr(it, "status", None) or getattr(it, "状態", None) or "")
             mm  = (getattr(it, "memo",   None) or getattr(it, "メモ",   None) or "")
             s_all = f"{st} {mm}"
-            is_cancel = (any(w in s_all for w in cancel_words_ja)
-                         or any(w in s_all.lower() for w in cancel_words_en))
+            is_cancel = _SALES_CANCEL_RE.search(s_all) is not None
 
             if qty > 0 and is_cancel:
                 dbg["excluded_cancel_posqty"] += 1
@@ -16455,15 +17445,18 @@ def api_sales_products():
             )
             rate = float(
                 getattr(it, "tax_rate", None)
-                or getattr(getattr(it, "menu", None), "tax_rate", None)
                 or getattr(m, "tax_rate", None)
                 or 0.10
             )
-            unit_tax  = math.floor(unit_excl * rate)
+            # 税率は 0.01% 単位の整数にして整数演算で切り捨て（税率ごとに1回だけ換算）
+            rate_bp = rate_bp_cache.get(rate)
+            if rate_bp is None:
+                rate_bp = rate_bp_cache[rate] = int(round(rate * 10000))
+            unit_tax  = unit_excl * rate_bp // 10000
             unit_incl = unit_excl + unit_tax
 
+            # m は JOIN 済みの it.menu そのもの（リレーションは辿らない）
             name = (getattr(m, "name", None)
-                    or getattr(getattr(it, "menu", None), "name", None)
                     or f"#{getattr(it, 'menu_id', None)}")
 
             a = agg[name]
@@ -16517,7 +17510,7 @@ def api_sales_products():
             resp["debug"] = {
                 "summary": dbg | {"examples_count": len(dbg["examples"])},
                 "examples": dbg["examples"],
-                "cancel_words": {"ja": cancel_words_ja, "en": cancel_words_en},
+                "cancel_words": {"ja": _SALES_CANCEL_WORDS_JA, "en": _SALES_CANCEL_WORDS_EN},
             }
         return jsonify(resp)
 
@@ -16632,29 +17625,27 @@ def export_daily_sales():
         start, end = _range_from_params("start_date", "end_date", default_days=30)
         end_dt = _end_of_day(end)
 
-        rows = (s.query(OrderHeader)
+        rows = (s.query(OrderHeader.closed_at, OrderHeader.total, OrderHeader.subtotal, OrderHeader.tax)
                   .filter(OrderHeader.closed_at.isnot(None),
                           OrderHeader.closed_at >= start,
                           OrderHeader.closed_at <= end_dt,
                           OrderHeader.status == "会計済")
                   .all())
 
-        daily = defaultdict(lambda: {"order_count":0, "total_sales":0, "subtotal":0, "tax_amount":0})
+        d_orders, d_sales, d_sub, d_tax = (defaultdict(int) for _ in range(4))
         for o in rows:
             day = (o.closed_at or "")[:10]
-            d = daily[day]
-            d["order_count"] += 1
-            d["total_sales"] += int(o.total or 0)
-            d["subtotal"]    += int(o.subtotal or 0)
-            d["tax_amount"]  += int(o.tax or 0)
+            d_orders[day] += 1
+            d_sales[day]  += int(o.total or 0)
+            d_sub[day]    += int(o.subtotal or 0)
+            d_tax[day]    += int(o.tax or 0)
 
         import csv, io
         output = io.StringIO()
         w = csv.writer(output)
         w.writerow(["日付","注文数","売上合計","税抜合計","税額"])
-        for k in sorted(daily.keys()):
-            v = daily[k]
-            w.writerow([k, v["order_count"], v["total_sales"], v["subtotal"], v["tax_amount"]])
+        for k in sorted(d_orders):
+            w.writerow([k, d_orders[k], d_sales[k], d_sub[k], d_tax[k]])
 
         resp = make_response(output.getvalue())
         resp.headers["Content-Type"] = "text/csv; charset=utf-8"
@@ -16681,8 +17672,9 @@ def export_products_sales():
         end_dt = _end_of_day(end)
 
         item_rows = (
-            s.query(OrderItem, OrderHeader)
+            s.query(OrderItem, Menu.name)
              .join(OrderHeader, OrderItem.order_id == OrderHeader.id)
+             .outerjoin(Menu, Menu.id == OrderItem.menu_id)
              .filter(OrderHeader.closed_at.isnot(None),
                      OrderHeader.closed_at >= start,
                      OrderHeader.closed_at <= end_dt,
@@ -16691,8 +17683,8 @@ def export_products_sales():
         )
 
         agg = defaultdict(lambda: {"total_qty":0, "total_sales":0, "sum_unit_price":0, "count_unit_price":0})
-        for it, _oh in item_rows:
-            name = it.menu.name if it.menu else f"#{it.menu_id}"
+        for it, menu_name in item_rows:
+            name = menu_name or f"#{it.menu_id}"
             qty  = int(it.qty or 0)
             unit = int(it.unit_price or 0)
             agg[name]["total_qty"]       += qty
@@ -17056,7 +18048,7 @@ def admin_reopen_order(order_id: int):
         h = s.get(OrderHeader, order_id)
         if not h:
             return jsonify({"ok": False, "error": "order not found"}), 404
-        if hasattr(OrderHeader, "store_id") and sid is not None:
+        if _HAS_STORE_ID and sid is not None:
             if getattr(h, "store_id", None) != sid:
                 return jsonify({"ok": False, "error": "forbidden"}), 403
 
@@ -17082,9 +18074,9 @@ def admin_reopen_order(order_id: int):
             OrderHeader.table_id == table_id,
             OrderHeader.id != order_id
         )
-        if hasattr(OrderHeader, "store_id") and sid is not None:
+        if _HAS_STORE_ID and sid is not None:
             q_active = q_active.filter(OrderHeader.store_id == sid)
-        if hasattr(OrderHeader, "status"):
+        if _HAS_STATUS:
             q_active = q_active.filter(OrderHeader.status.in_(list(ACTIVE_ORDER_STATUSES)))
 
         other_active_exists = bool(s.query(q_active.exists()).scalar())
@@ -17340,6 +18332,21 @@ except NameError:
         更新日時 = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
 
+# --- お客様詳細モデルと列構成（staff_api_order 用。リクエスト毎に解決しない） ---
+_CD_MODEL = (
+    globals().get("T_お客様詳細")
+    or globals().get("M_顧客詳細")
+    or globals().get("CustomerDetail")
+)
+_CD_HAS_ORDER_ID = _CD_MODEL is not None and hasattr(_CD_MODEL, "order_id")
+_CD_HAS_TABLE_ID = _CD_MODEL is not None and hasattr(_CD_MODEL, "table_id")
+_CD_HAS_STORE_ID = _CD_MODEL is not None and hasattr(_CD_MODEL, "store_id")
+_CD_PEOPLE_COLS = tuple(
+    c for c in ("大人男性", "大人女性", "子ども男", "子ども女", "合計人数")
+    if _CD_MODEL is not None and hasattr(_CD_MODEL, c)
+)
+
+
 # ===== 履歴テーブルモデル（未定義なら定義） =====
 try:
     T_お客様詳細履歴  # 既にあるならこのブロックはスキップ
@@ -18141,7 +19148,7 @@ def _restore_merge(s, sid, history):
     if not source_snapshot_json:
         raise ValueError("移動元の明細スナップショットがありません")
     
-    source_snapshot = json.loads(source_snapshot_json)
+    source_snapshot = _load_items_snapshot(source_snapshot_json)
     source_item_ids = [item["id"] for item in source_snapshot.get("items", [])]
     
     # 移動元の明細を元の注文IDに戻す
@@ -18237,8 +19244,8 @@ def _restore_merge_new(s, sid, history):
     if not source_snapshot_json or not dest_snapshot_json:
         raise ValueError("明細スナップショットがありません")
     
-    source_snapshot = json.loads(source_snapshot_json)
-    dest_snapshot = json.loads(dest_snapshot_json)
+    source_snapshot = _load_items_snapshot(source_snapshot_json)
+    dest_snapshot = _load_items_snapshot(dest_snapshot_json)
     
     source_item_ids = [item["id"] for item in source_snapshot.get("items", [])]
     dest_item_ids = [item["id"] for item in dest_snapshot.get("items", [])]
@@ -18294,7 +19301,7 @@ def _restore_merge_new(s, sid, history):
                 # 移動先の元のステータスを復元（スナップショットから）
                 dest_status = "新規"
                 if dest_snapshot_json:
-                    dest_order_data = json.loads(dest_snapshot_json)
+                    dest_order_data = dest_snapshot
                     # ここでは簡易的に新規に設定
                 setattr(dest_order, "status", dest_status)
             _recalc_order_totals_from_items_simple(s, dest_order_id, TOrder, TItem)
@@ -18531,6 +19538,11 @@ def admin_table_move_cancel():
         if THistory is None:
             return jsonify({"ok": False, "error": "履歴テーブルが存在しません"}), 500
         
+        # 直近移動判定のため、バッファ中の履歴を先に書き込む
+        #   ※ 書き込めるのはこのワーカーのバッファ分だけ。他ワーカーに残っている履歴は見えないため、
+        #     複数ワーカーで取消を厳密に運用する場合は AUDIT_TRAIL_BUFFER を無効（同期 INSERT）のままにする
+        table_move_audit_buffer.flush()
+        
         # 履歴を取得
         history = s.get(THistory, history_id)
         if not history:
@@ -18613,6 +19625,11 @@ def admin_table_move_cancel_check(history_id):
         if THistory is None:
             return jsonify({"ok": False, "error": "履歴テーブルが存在しません"}), 500
         
+        # 直近移動判定のため、バッファ中の履歴を先に書き込む
+        #   ※ 書き込めるのはこのワーカーのバッファ分だけ。他ワーカーに残っている履歴は見えないため、
+        #     複数ワーカーで取消を厳密に運用する場合は AUDIT_TRAIL_BUFFER を無効（同期 INSERT）のままにする
+        table_move_audit_buffer.flush()
+        
         history = s.get(THistory, history_id)
         if not history:
             return jsonify({"ok": False, "error": "履歴が見つかりません"}), 404
@@ -19053,6 +20070,13 @@ def invoice_print(order_id):
         SessionLocal.remove()
 
 
+# --- [起動時] フロア画面の伝票集計フック（定義されていれば優先）を1回だけ解決 -----------
+#   モジュール末尾で解決するので、どこで定義されていても拾える。無ければ None
+_FIN_FN = globals().get("_order_financials_including_negatives")
+if not callable(_FIN_FN):
+    _FIN_FN = None
+
+
 if __name__ == "__main__":
     # 既存のDBに不足しているカラムを追加する処理
     print("Migrating schema to add new columns...")